@@ -1,19 +1,28 @@
 import sys
+import os
 
-#import eventlet
-#eventlet.monkey_patch()
+# Production runs under gunicorn's eventlet worker (see Procfile) with ASYNC_MODE=eventlet, so
+# idle Socket.IO and SSE connections cost a greenlet rather than a thread. The stdlib and psycopg2
+# must be made cooperative before anything else imports them.
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+    from psycogreen.eventlet import patch_psycopg
+    patch_psycopg()
 
 import warnings
 warnings.filterwarnings("ignore", message="Can not find any timezone configuration")
 
 from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash, abort, Response, stream_with_context
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, join_room
 from authlib.integrations.flask_client import OAuth
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy import func, text
-from models import db, Main, Segment, User, temp_segments, summaries
+from models import db, Main, Segment, User, temp_segments, summaries, user_timezone, local_day_and_hour
 from config import Config
+from database import init_database
 import logging
 from datetime import datetime, timedelta
 import traceback
@@ -22,6 +31,8 @@ import nltk
 import os
 import requests
 import json
+import queue
+import threading
 from google.oauth2 import id_token
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport import requests as google_requests
@@ -35,11 +46,27 @@ from sqlalchemy import and_, or_
 import emoji
 import time
 from pytz import timezone as pytz_timezone
-from summarization_handler import summarization_task, cleanup_locked_segments
+from summarization_handler import set_summary_publisher
+from jobs import RUN_SCHEDULER, add_jobs
+from fair_scheduler import pending_backlogs
+from summarization import llm_router
+from rate_limiter import limiters_snapshot
+from search import search_segments, search_summaries
+from related import related_summaries
+from digests import get_digest
+from text_processing import count_words, word_cloud_data, word_frequencies
+from cooperative import cooperative
+from raw_payloads import encode_payload
+from response_cache import cache, cached_day_view, invalidate_user_day
+from replica import replica_reads
+from transcripts import fetch_turns, merge_turns, summary_segments
+from export import EXPORT_FORMATS, EXPORT_INCLUDES, export_stream
+from archive import ARCHIVE_AFTER_DAYS, archived_day_rows, merge_with_live, read_archived_segments
+from notifications import SUMMARY_EVENTS, listen_summary_events, notify_summary_event
+from idempotency import delivery_key, seen_recently, claim_delivery, record_delivery
+from instrumentation import init_instrumentation, job_last_runs, render_prometheus, metrics_snapshot
 from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.interval import IntervalTrigger
 import atexit
-from sqlalchemy.orm import sessionmaker
 
 # Add these lines near the top of the file, after the imports
 nltk.download('punkt')
@@ -49,7 +76,7 @@ nltk.download('maxent_ne_chunker')
 nltk.download('words')
 
 # Set up logging
-logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+logging.basicConfig(stream=sys.stderr, level=os.environ.get('LOG_LEVEL', 'DEBUG').upper())
 logger = logging.getLogger(__name__)
 
 # Reduce logging noise from other libraries
@@ -64,8 +91,10 @@ try:
     app = Flask(__name__)
     app.config.from_object(Config)
     app.config['TIMEZONE'] = pytz.timezone('UTC')
-    db.init_app(app)
-    socketio = SocketIO(app)
+    init_database(app)
+    cache.init_app(app)
+    init_instrumentation(app)
+    socketio = SocketIO(app, async_mode=ASYNC_MODE)
     # ... rest of your initialization code ...
 except Exception as e:
     logger.error(f"Error during app initialization: {e}", exc_info=True)
@@ -123,43 +152,44 @@ flow = Flow.from_client_secrets_file(
     redirect_uri="https://soundbrain-2dce81400d7f.herokuapp.com/login/google/authorized"
 )
 
+def user_room(user_id):
+    return f"user_{user_id}"
+
+# user_id -> queues of the /summary_updates streams open on this process
+summary_listeners = {}
+summary_listeners_lock = threading.Lock()
+SSE_KEEPALIVE_SECONDS = 25  # below the 30s-55s idle timeouts of Heroku's router and most proxies
+
+def publish_summary_to_user(user_id, event, data):
+    """Push a summary event, from whichever process wrote it, to the user's open dashboards."""
+    socketio.emit(event, data, to=user_room(user_id))
+    if event in SUMMARY_EVENTS:
+        with summary_listeners_lock:
+            listeners = list(summary_listeners.get(user_id, ()))
+        for listener in listeners:
+            try:
+                listener.put_nowait(data)
+            except queue.Full:
+                logger.warning(f"Dropping summary update for a stalled stream of User {user_id}")
+
+# The summarizer publishes through Postgres so that every web process hears it
+set_summary_publisher(notify_summary_event)
+socketio.start_background_task(listen_summary_events, app, publish_summary_to_user)
+
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
-# Initialize the scheduler
+# Initialize the scheduler. In production the jobs run in worker.py instead (see jobs.py),
+# and this one stays empty so /scheduler_status still answers.
 scheduler = BackgroundScheduler()
 
 def init_scheduler():
-    if scheduler.running:
+    if scheduler.running or not RUN_SCHEDULER:
         return
 
+    add_jobs(scheduler, app)
     scheduler.start()
-
-    def summarization_task_wrapper():
-        with app.app_context():
-            Session = sessionmaker(bind=db.engine)
-            with Session() as session:
-                summarization_task()
-
-    def cleanup_locked_segments_wrapper():
-        with app.app_context():
-            cleanup_locked_segments()
-
-    scheduler.add_job(
-        func=summarization_task_wrapper,
-        trigger=IntervalTrigger(minutes=5),
-        id='summarization_job',
-        name='Generate summaries every 5 minutes',
-        replace_existing=True)
-
-    scheduler.add_job(
-        func=cleanup_locked_segments_wrapper,
-        trigger=IntervalTrigger(minutes=15),
-        id='cleanup_locked_segments_job',
-        name='Cleanup locked segments every 15 minutes',
-        replace_existing=True)
-
     atexit.register(lambda: scheduler.shutdown())
 
 # Initialize scheduler
@@ -177,7 +207,8 @@ def scheduler_status():
             'id': job.id,
             'name': job.name,
             'next_run_time': str(job.next_run_time),
-            'trigger': str(job.trigger)
+            'trigger': str(job.trigger),
+            'last_run': job_last_runs.get(job.id)
         })
     
     return jsonify({
@@ -185,6 +216,43 @@ def scheduler_status():
         'jobs': jobs
     })
 
+@app.route('/metrics')
+def metrics():
+    """
+    Prometheus-style metrics for this process.
+    Scrapers authenticate with METRICS_TOKEN as a bearer token; admins can view it when logged in.
+    """
+    metrics_token = os.environ.get('METRICS_TOKEN')
+    authorized = metrics_token and request.headers.get('Authorization') == f"Bearer {metrics_token}"
+    if not authorized and not (current_user.is_authenticated and current_user.is_admin):
+        abort(403)
+
+    return Response(render_prometheus(), content_type='text/plain; version=0.0.4')
+
+@app.route('/admin/metrics')
+@login_required
+def admin_metrics():
+    if not current_user.is_admin:
+        abort(403)
+
+    return jsonify({
+        'metrics': metrics_snapshot(),
+        'jobs': job_last_runs,
+        'llm_providers': llm_router.snapshot()
+    })
+
+@app.route('/admin/llm_providers')
+@login_required
+def llm_provider_status():
+    if not current_user.is_admin:
+        abort(403)
+
+    return jsonify({
+        'hedging': llm_router.hedge,
+        'providers': llm_router.snapshot(),
+        'rate_limits': limiters_snapshot()
+    })
+
 # Route handlers for various endpoints
 
 @app.route('/')
@@ -316,60 +384,86 @@ def admin():
                            profile_picture=current_user.profile_picture,
                            timezone=current_user.timezone)
 
+def user_day(date_str):
+    """(local date, tz, utc_start, utc_end) for a YYYY-MM-DD date in the current user's timezone."""
+    tz = user_timezone(current_user.timezone)
+    day = datetime.strptime(date_str, '%Y-%m-%d')
+    utc_start = tz.localize(day).astimezone(pytz.UTC)
+    utc_end = tz.localize(day + timedelta(days=1)).astimezone(pytz.UTC)
+    return day.date(), tz, utc_start, utc_end
+
 @app.route('/get_transcripts', methods=['GET'])
 @login_required
+@replica_reads
 def get_transcripts():
     date_str = request.args.get('date')
     page = int(request.args.get('page', 1))
     per_page = int(request.args.get('per_page', 200))
     hour = request.args.get('hour')
+    # 'segments' (raw rows) or 'turns' (consecutive same-speaker segments merged, paged by turn)
+    response_format = request.args.get('format', 'segments')
 
     if not date_str or date_str == 'Invalid Date':
         return jsonify({'error': 'Invalid or missing date parameter'}), 400
+    if response_format not in ('segments', 'turns'):
+        return jsonify({'error': 'format must be segments or turns'}), 400
     
     try:
-        pacific_tz = pytz.timezone('US/Pacific')
-        selected_date = datetime.strptime(date_str, '%Y-%m-%d')
-        selected_date = pacific_tz.localize(selected_date)
-        
-        utc_start = selected_date.astimezone(pytz.UTC)
-        utc_end = (selected_date + timedelta(days=1)).astimezone(pytz.UTC)
+        local_date, tz, utc_start, utc_end = user_day(date_str)
 
         query = db.session.query(Segment).join(Main).filter(
             Main.uid == current_user.uid,
-            Segment.timestamp >= utc_start,
-            Segment.timestamp < utc_end
+            Segment.local_date == local_date
         )
 
+        range_start, range_end = utc_start, utc_end
         if hour is not None:
             hour = int(hour)
-            hour_start = utc_start + timedelta(hours=hour)
-            hour_end = hour_start + timedelta(hours=1)
-            query = query.filter(
-                Segment.timestamp >= hour_start,
-                Segment.timestamp < hour_end
-            )
+            query = query.filter(Segment.local_hour == hour)
+            local_hour_start = datetime.combine(local_date, datetime.min.time()) + timedelta(hours=hour)
+            range_start = tz.localize(local_hour_start).astimezone(pytz.UTC)
+            range_end = tz.localize(local_hour_start + timedelta(hours=1)).astimezone(pytz.UTC)
 
         query = query.order_by(Segment.timestamp.asc())
 
-        total_segments = query.count()
+        archived = read_archived_segments(current_user.id, range_start, range_end)
+        if response_format == 'turns':
+            if archived:
+                turns = merge_turns(merge_with_live(archived, [segment.to_dict() for segment in query.all()]))
+                total_turns = len(turns)
+                turns = turns[(page - 1) * per_page:page * per_page]
+            else:
+                turns, total_turns = fetch_turns(current_user.uid, local_date, hour,
+                                                 per_page, (page - 1) * per_page)
+            return jsonify({
+                'turns': turns,
+                'timezone': tz.zone,
+                'total_pages': (total_turns + per_page - 1) // per_page,
+                'current_page': page
+            }), 200
+
+        if archived:
+            # Days moved to cold storage; whatever is still live for the range is merged in
+            merged = merge_with_live(archived, [segment.to_dict() for segment in query.all()])
+            total_segments = len(merged)
+            serialized_segments = merged[(page - 1) * per_page:page * per_page]
+        else:
+            total_segments = query.count()
+            segments = query.offset((page - 1) * per_page).limit(per_page).all()
+            serialized_segments = [segment.to_dict() for segment in segments]
         total_pages = (total_segments + per_page - 1) // per_page
 
-        segments = query.offset((page - 1) * per_page).limit(per_page).all()
-        
-        if not segments:
+        if not serialized_segments:
             return jsonify({
                 'segments': [],
-                'timezone': 'US/Pacific',
+                'timezone': tz.zone,
                 'total_pages': 0,
                 'current_page': 1
             }), 200
     
-        serialized_segments = [segment.to_dict() for segment in segments]
-    
         return jsonify({
             'segments': serialized_segments,
-            'timezone': 'US/Pacific',
+            'timezone': tz.zone,
             'total_pages': total_pages,
             'current_page': page
         }), 200
@@ -377,6 +471,79 @@ def get_transcripts():
         logger.error(f"Error fetching transcripts: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/search', methods=['GET'])
+@login_required
+@replica_reads
+def search():
+    """Full-text search over live transcripts and all summaries. Archived transcripts are not searched."""
+    query_text = (request.args.get('q') or '').strip()
+    search_type = request.args.get('type', 'all')
+    page = max(int(request.args.get('page', 1)), 1)
+    per_page = min(max(int(request.args.get('per_page', 20)), 1), 100)
+
+    if not query_text:
+        return jsonify({'error': 'Missing q parameter'}), 400
+    if search_type not in ('all', 'transcripts', 'summaries'):
+        return jsonify({'error': 'type must be one of all, transcripts, summaries'}), 400
+
+    try:
+        offset = (page - 1) * per_page
+        response = {'query': query_text, 'current_page': page, 'per_page': per_page}
+
+        if search_type in ('all', 'transcripts'):
+            results, has_more = search_segments(current_user.uid, query_text, per_page, offset)
+            response['transcripts'] = {'results': results, 'has_more': has_more}
+            if ARCHIVE_AFTER_DAYS > 0:
+                # Archived segments aren't in the full-text index, so older transcripts may be missing
+                response['transcripts']['archived_before'] = (
+                    datetime.now(pytz.UTC).date() - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+
+        if search_type in ('all', 'summaries'):
+            results, has_more = search_summaries(current_user.id, query_text, per_page, offset)
+            response['summaries'] = {'results': results, 'has_more': has_more}
+
+        return jsonify(response), 200
+    except Exception as e:
+        logger.error(f"Error searching history: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/export', methods=['GET'])
+@login_required
+@replica_reads
+def export():
+    """Stream a date range (inclusive, in the user's timezone) of segments and summaries as NDJSON or CSV."""
+    start_str = request.args.get('start')
+    end_str = request.args.get('end') or start_str
+    export_format = request.args.get('format', 'ndjson')
+    include = request.args.get('include', 'all' if export_format == 'ndjson' else 'segments')
+    compress = request.args.get('gzip', 'false').lower() in ('1', 'true')
+
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': 'format must be one of ndjson, csv'}), 400
+    if include not in EXPORT_INCLUDES or (export_format == 'csv' and include == 'all'):
+        return jsonify({'error': 'include must be segments or summaries for csv, or all for ndjson'}), 400
+    try:
+        start_date = datetime.strptime(start_str or '', '%Y-%m-%d')
+        end_date = datetime.strptime(end_str or '', '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'start and end must be dates in YYYY-MM-DD format'}), 400
+    if end_date < start_date:
+        return jsonify({'error': 'end must not be before start'}), 400
+
+    tz = user_timezone(current_user.timezone)
+    utc_start = tz.localize(start_date).astimezone(pytz.UTC)
+    utc_end = tz.localize(end_date + timedelta(days=1)).astimezone(pytz.UTC)
+
+    filename = f"soundbrain_{include}_{start_date:%Y-%m-%d}_{end_date:%Y-%m-%d}.{export_format}"
+    mimetype = 'application/x-ndjson' if export_format == 'ndjson' else 'text/csv'
+    if compress:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+
+    stream = export_stream(current_user._get_current_object(), utc_start, utc_end, export_format, include, compress)
+    return Response(stream_with_context(stream), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 @app.route('/webhook', methods=['GET'])
 def webhook_get():
     """Respond to GET requests to the webhook endpoint."""
@@ -405,6 +572,12 @@ def webhook_post():
 
         logger.debug(f"Received payload: {payload}")
 
+        segments = payload.get('segments', [])
+        delivery = delivery_key(uid, session_id, segments, request.headers.get('Idempotency-Key'))
+        if seen_recently(delivery):
+            logger.info(f"Ignoring duplicate webhook delivery for UID: {uid}, session: {session_id}")
+            return jsonify({'message': 'Duplicate delivery ignored', 'duplicate': True}), 200
+
         # Forward the webhook data to the specified URL
         #forward_url = f"https://friend-chat-79fbdb3555bc.herokuapp.com/webhook?uid={uid}"
         #try:
@@ -415,13 +588,20 @@ def webhook_post():
         #    logger.error(f"Error forwarding webhook data: {str(e)}")
             # Note: Continuing execution even if forwarding fails
 
+        # The receipt is the first write, so a concurrent retry of the same delivery stops here
+        if claim_delivery(delivery, uid, session_id) is None:
+            db.session.rollback()
+            record_delivery(delivery)
+            logger.info(f"Ignoring duplicate webhook delivery for UID: {uid}, session: {session_id}")
+            return jsonify({'message': 'Duplicate delivery ignored', 'duplicate': True}), 200
+
         # Create main entry in the database
         main_entry = Main(
             uid=uid,
             session_id=session_id,
             timestamp=datetime.utcnow(),
             host=request.remote_addr,
-            raw_data=payload
+            **encode_payload(payload)
         )
         db.session.add(main_entry)
         logger.debug("Added main entry to session")
@@ -435,8 +615,13 @@ def webhook_post():
             raise
 
         # Create segment entries and accumulate segments
-        segments = payload.get('segments', [])
+        user = User.query.filter_by(uid=uid).first()
+        if not user:
+            logger.error(f'User not found for UID: {uid}')
+        tz = user_timezone(user.timezone if user else None)
         for segment in segments:
+            received_at = datetime.utcnow()
+            local_date, local_hour = local_day_and_hour(received_at, tz)
             segment_entry = Segment(
                 main_id=main_entry.id,
                 text=segment.get('text'),
@@ -445,7 +630,9 @@ def webhook_post():
                 is_user=segment.get('is_user'),
                 start_time=segment.get('start_time'),
                 end_time=segment.get('end_time'),
-                timestamp=datetime.utcnow(),
+                timestamp=received_at,
+                local_date=local_date,
+                local_hour=local_hour,
                 summary_id=None  # Initialize summary_id as None
             )
             db.session.add(segment_entry)
@@ -456,11 +643,16 @@ def webhook_post():
             socketio.emit('new_segment', segment_entry.to_dict())
 
             # Accumulate segment for summarization
-            accumulate_segment(uid, session_id, segment, segment_entry.id)
+            if user:
+                accumulate_segment(user, segment, segment_entry.id)
 
-        # Commit the transaction
+        # Commit the transaction; read the id first so invalidation doesn't reload the expired user
+        user_id = user.id if user else None
         try:
             db.session.commit()
+            record_delivery(delivery)
+            if user_id and segments:
+                invalidate_user_day(user_id, local_date)
             #logger.info(f"Webhook data processed successfully for UID: {uid}")
             return jsonify({'message': 'Data processed successfully'}), 200
         except Exception as commit_error:
@@ -504,9 +696,12 @@ def handle_connect():
     """
     if not current_user.is_authenticated:
         return False  # Reject the connection
+    join_room(user_room(current_user.id))
 
 @app.route('/get_heatmap_data')
 @login_required
+@replica_reads
+@cached_day_view
 def get_heatmap_data():
     date_str = request.args.get('date')
     
@@ -514,33 +709,26 @@ def get_heatmap_data():
         return jsonify({'error': 'Missing date parameter'}), 400
     
     try:
-        pacific_tz = pytz.timezone('US/Pacific')
-        selected_date = datetime.strptime(date_str, '%Y-%m-%d')
-        selected_date = pacific_tz.localize(selected_date)
-        
-        utc_start = selected_date.astimezone(pytz.UTC)
-        utc_end = (selected_date + timedelta(days=1)).astimezone(pytz.UTC)
-
-        hourly_counts = db.session.query(
-            func.extract('hour', Segment.timestamp).label('hour'),
-            func.count(Segment.id).label('count')
-        ).join(Main).filter(
-            Main.uid == current_user.uid,
-            Segment.timestamp >= utc_start,
-            Segment.timestamp < utc_end
-        ).group_by(
-            func.extract('hour', Segment.timestamp)
-        ).order_by(
-            func.extract('hour', Segment.timestamp)
-        ).all()
+        local_date, tz, utc_start, utc_end = user_day(date_str)
+
+        archived_rows = archived_day_rows(current_user, local_date, tz, utc_start, utc_end)
+        if archived_rows is not None:
+            hourly_counts = list(Counter(hour for hour, _ in archived_rows).items())
+        else:
+            hourly_counts = db.session.query(
+                Segment.local_hour,
+                func.count(Segment.id).label('count')
+            ).join(Main).filter(
+                Main.uid == current_user.uid,
+                Segment.local_date == local_date
+            ).group_by(
+                Segment.local_hour
+            ).all()
 
         heatmap_data = [0] * 24
 
         for hour, count in hourly_counts:
-            utc_time = utc_start.replace(hour=int(hour), minute=0, second=0, microsecond=0)
-            pacific_time = utc_time.astimezone(pacific_tz)
-            pacific_hour = pacific_time.hour
-            heatmap_data[pacific_hour] = count
+            heatmap_data[hour] = count
 
         return jsonify(heatmap_data), 200
 
@@ -550,56 +738,29 @@ def get_heatmap_data():
 
 @app.route('/get_word_cloud_data')
 @login_required
+@replica_reads
+@cached_day_view
 def get_word_cloud_data():
     date_str = request.args.get('date')
     if not date_str:
         return jsonify({'error': 'Missing date parameter'}), 400
     
     try:
-        pacific_tz = pytz.timezone('US/Pacific')
-        selected_date = datetime.strptime(date_str, '%Y-%m-%d')
-        selected_date = pacific_tz.localize(selected_date)
-        
-        utc_start = selected_date.astimezone(pytz.UTC)
-        utc_end = (selected_date + timedelta(days=1)).astimezone(pytz.UTC)
-
-        segments = Segment.query.join(Main).filter(
-            Main.uid == current_user.uid,
-            Segment.timestamp >= utc_start,
-            Segment.timestamp < utc_end
-        ).all()
-
-        all_text = ' '.join([segment.text for segment in segments])
-        
-        # Use a try-except block for word tokenization
-        try:
-            from nltk.tokenize import word_tokenize
-            from nltk.corpus import stopwords
-            words = word_tokenize(all_text.lower())
-            stop_words = set(stopwords.words('english'))
-        except LookupError:
-            # If NLTK data is not available, fall back to simple splitting
-            words = all_text.lower().split()
-            stop_words = set(['i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're", "you've", "you'll", "you'd", 'your', 'yours', 'yourself', 'yourselves', 'he', 'him', 'his', 'himself', 'she', "she's", 'her', 'hers', 'herself', 'it', "it's", 'its', 'itself', 'they', 'them', 'their', 'theirs', 'themselves', 'what', 'which', 'who', 'whom', 'this', 'that', "that'll", 'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'having', 'do', 'does', 'did', 'doing', 'a', 'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'until', 'while', 'of', 'at', 'by', 'for', 'with', 'about', 'against', 'between', 'into', 'through', 'during', 'before', 'after', 'above', 'below', 'to', 'from', 'up', 'down', 'in', 'out', 'on', 'off', 'over', 'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when', 'where', 'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more', 'most', 'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 's', 't', 'can', 'will', 'just', 'don', "don't", 'should', "should've", 'now', 'd', 'll', 'm', 'o', 're', 've', 'y', 'ain', 'aren', "aren't", 'couldn', "couldn't", 'didn', "didn't", 'doesn', "doesn't", 'hadn', "hadn't", 'hasn', "hasn't", 'haven', "haven't", 'isn', "isn't", 'ma', 'mightn', "mightn't", 'mustn', "mustn't", 'needn', "needn't", 'shan', "shan't", 'shouldn', "shouldn't", 'wasn', "wasn't", 'weren', "weren't", 'won', "won't", 'wouldn', "wouldn't"])
-        
-        # Add custom words to filter out
-        custom_stop_words = {'um', 'uh', 'like', 'yeah', 'okay', 'oh', 'just', 'know', 'think', 'going', 'really', 'get', 'well', 'thing', 'things', 'way', 'kind', 'lot'}
-        stop_words.update(custom_stop_words)
-        
-        filtered_words = [word for word in words if word.isalnum() and word not in stop_words and len(word) > 2]
-        
-        from collections import Counter
-        word_freq = Counter(filtered_words)
-        
-        # Filter out words that appear too frequently (e.g., more than 50% of the time)
-        total_words = sum(word_freq.values())
-        word_cloud_data = [
-            {"text": word, "value": count} 
-            for word, count in word_freq.most_common(50) 
-            if count < total_words * 0.5
-        ]
-
-        return jsonify(word_cloud_data), 200
+        local_date, tz, utc_start, utc_end = user_day(date_str)
+
+        archived_rows = archived_day_rows(current_user, local_date, tz, utc_start, utc_end)
+        if archived_rows is not None:
+            texts = (segment_text for _, segment_text in archived_rows)
+        else:
+            # Stream only the text column and count segment by segment, so memory doesn't grow with the day
+            texts = db.session.execute(
+                db.select(Segment.text).join(Main).where(
+                    Main.uid == current_user.uid,
+                    Segment.local_date == local_date
+                ).execution_options(yield_per=1000)
+            ).scalars()
+
+        return jsonify(word_cloud_data(word_frequencies(cooperative(texts)))), 200
 
     except Exception as e:
         logger.error(f"Error fetching word cloud data: {str(e)}")
@@ -607,44 +768,32 @@ def get_word_cloud_data():
 
 @app.route('/get_dashboard_stats')
 @login_required
+@replica_reads
+@cached_day_view
 def get_dashboard_stats():
     date_str = request.args.get('date')
     if not date_str:
         return jsonify({'error': 'Missing date parameter'}), 400
     
     try:
-        pacific_tz = pytz.timezone('US/Pacific')
-        selected_date = datetime.strptime(date_str, '%Y-%m-%d')
-        selected_date = pacific_tz.localize(selected_date)
-        
-        utc_start = selected_date.astimezone(pytz.UTC)
-        utc_end = (selected_date + timedelta(days=1)).astimezone(pytz.UTC)
-
-        total_segments = Segment.query.join(Main).filter(
-            Main.uid == current_user.uid,
-            Segment.timestamp >= utc_start,
-            Segment.timestamp < utc_end
-        ).count()
-
-        hourly_counts = db.session.query(
-            func.extract('hour', Segment.timestamp).label('hour'),
-            func.count(Segment.id).label('count')
-        ).join(Main).filter(
-            Main.uid == current_user.uid,
-            Segment.timestamp >= utc_start,
-            Segment.timestamp < utc_end
-        ).group_by(
-            func.extract('hour', Segment.timestamp)
-        ).order_by(
-            func.count(Segment.id).desc()
-        ).first()
-
-        most_active_hour = None
-        if hourly_counts:
-            utc_hour = int(hourly_counts[0])
-            utc_time = utc_start.replace(hour=utc_hour, minute=0, second=0, microsecond=0)
-            pacific_time = utc_time.astimezone(pacific_tz)
-            most_active_hour = pacific_time.hour
+        local_date, tz, utc_start, utc_end = user_day(date_str)
+
+        archived_rows = archived_day_rows(current_user, local_date, tz, utc_start, utc_end)
+        if archived_rows is not None:
+            hourly_counts = list(Counter(hour for hour, _ in archived_rows).items())
+        else:
+            hourly_counts = db.session.query(
+                Segment.local_hour,
+                func.count(Segment.id).label('count')
+            ).join(Main).filter(
+                Main.uid == current_user.uid,
+                Segment.local_date == local_date
+            ).group_by(
+                Segment.local_hour
+            ).all()
+
+        total_segments = sum(count for _, count in hourly_counts)
+        most_active_hour = max(hourly_counts, key=lambda row: row[1])[0] if hourly_counts else None
 
         return jsonify({
             'total_segments': total_segments,
@@ -655,12 +804,52 @@ def get_dashboard_stats():
         logger.error(f"Error fetching dashboard stats: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
-def accumulate_segment(uid, session_id, segment_data, segment_id):
-    user = User.query.filter_by(uid=uid).first()
-    if not user:
-        logger.error(f'User not found for UID: {uid}')
-        return
+@app.route('/get_dashboard')
+@login_required
+@replica_reads
+@cached_day_view
+def get_dashboard():
+    """Heatmap, stats and word cloud for a day from a single pass over its segments."""
+    date_str = request.args.get('date')
+    if not date_str:
+        return jsonify({'error': 'Missing date parameter'}), 400
+
+    try:
+        local_date, tz, utc_start, utc_end = user_day(date_str)
+
+        rows = archived_day_rows(current_user, local_date, tz, utc_start, utc_end)
+        if rows is None:
+            rows = db.session.execute(
+                db.select(Segment.local_hour, Segment.text).join(Main).where(
+                    Main.uid == current_user.uid,
+                    Segment.local_date == local_date
+                ).execution_options(yield_per=1000)
+            )
 
+        heatmap_data = [0] * 24
+        word_freq = Counter()
+        for hour, segment_text in cooperative(rows):
+            heatmap_data[hour] += 1
+            count_words(word_freq, segment_text)
+
+        total_segments = sum(heatmap_data)
+        most_active_hour = max(range(24), key=heatmap_data.__getitem__) if total_segments else None
+
+        return jsonify({
+            'heatmap': heatmap_data,
+            'word_cloud': word_cloud_data(word_freq),
+            'stats': {
+                'total_segments': total_segments,
+                'most_active_hour': most_active_hour
+            }
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error fetching dashboard data: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def accumulate_segment(user, segment_data, segment_id):
+    # Added to the webhook's transaction; committed together with the delivery receipt
     new_segment = temp_segments(
         user_id=user.id,
         segment_id=segment_id,
@@ -670,10 +859,11 @@ def accumulate_segment(uid, session_id, segment_data, segment_id):
         processed_at=None  # Ensure new segments are marked as unprocessed
     )
     db.session.add(new_segment)
-    db.session.commit()
 
 @app.route('/get_summaries', methods=['GET'])
 @login_required
+@replica_reads
+@cached_day_view
 def get_summaries():
     date_str = request.args.get('date')
     page = int(request.args.get('page', 1))
@@ -681,30 +871,18 @@ def get_summaries():
     hour = request.args.get('hour')
 
     if not date_str:
-        date_str = datetime.now(pytz.timezone('US/Pacific')).strftime('%Y-%m-%d')
+        date_str = datetime.now(user_timezone(current_user.timezone)).strftime('%Y-%m-%d')
 
     try:
-        pacific_tz = pytz.timezone('US/Pacific')
-        selected_date = datetime.strptime(date_str, '%Y-%m-%d')
-        selected_date = pacific_tz.localize(selected_date)
-        
-        utc_start = selected_date.astimezone(pytz.UTC)
-        utc_end = (selected_date + timedelta(days=1)).astimezone(pytz.UTC)
+        local_date = user_day(date_str)[0]
 
         query = summaries.query.filter(
             summaries.user_id == current_user.id,
-            summaries.timestamp >= utc_start,
-            summaries.timestamp < utc_end
+            summaries.local_date == local_date
         )
 
         if hour is not None:
-            hour = int(hour)
-            hour_start = utc_start + timedelta(hours=hour)
-            hour_end = hour_start + timedelta(hours=1)
-            query = query.filter(
-                summaries.timestamp >= hour_start,
-                summaries.timestamp < hour_end
-            )
+            query = query.filter(summaries.local_hour == int(hour))
 
         query = query.order_by(summaries.timestamp.desc())
 
@@ -733,18 +911,120 @@ def get_summaries():
 
 @app.route('/get_summary_segments/<int:summary_id>', methods=['GET'])
 @login_required
+@replica_reads
 def get_summary_segments(summary_id):
+    try:
+        result = summary_segments(current_user, [summary_id])
+        if summary_id not in result:
+            return jsonify({'error': 'Summary not found or access denied'}), 404
+
+        return jsonify(result[summary_id][0]), 200
+    except Exception as e:
+        logger.error(f"Error fetching summary segments: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/get_summary_segments', methods=['GET'])
+@login_required
+@replica_reads
+def get_summaries_segments():
+    """
+    Segments of many summaries in one request: ?ids=1,2,3&limit=50.
+
+    Each summary returns at most `limit` segments, with has_more and next_after; pass
+    ?ids=<id>&after=<next_after> to load the rest of one summary.
+    """
+    try:
+        summary_ids = [int(value) for value in request.args.get('ids', '').split(',') if value.strip()]
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+        after = request.args.get('after', type=int)
+    except ValueError:
+        return jsonify({'error': 'ids must be a comma-separated list of summary ids'}), 400
+    if not summary_ids:
+        return jsonify({'error': 'Missing ids parameter'}), 400
+    if len(summary_ids) > 200:
+        return jsonify({'error': 'At most 200 summary ids per request'}), 400
+
+    try:
+        result = summary_segments(current_user, summary_ids, limit=limit, after=after)
+        return jsonify({'summaries': {
+            str(summary_id): {
+                'segments': segments,
+                'has_more': has_more,
+                'next_after': segments[-1]['id'] if has_more else None
+            } for summary_id, (segments, has_more) in result.items()
+        }}), 200
+    except Exception as e:
+        logger.error(f"Error fetching segments for summaries: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/get_related_summaries/<int:summary_id>', methods=['GET'])
+@login_required
+def get_related_summaries(summary_id):
+    limit = min(max(int(request.args.get('limit', 5)), 1), 50)
     try:
         summary = summaries.query.get(summary_id)
         if not summary or summary.user_id != current_user.id:
             return jsonify({'error': 'Summary not found or access denied'}), 404
-        
-        segments = Segment.query.filter_by(summary_id=summary_id).all()
-        result = [segment.to_dict() for segment in segments]
-        
-        return jsonify(result), 200
+
+        neighbours = related_summaries(current_user.id, summary_id, limit)
+        scores = dict(neighbours)
+        rows = summaries.query.filter(
+            summaries.user_id == current_user.id,
+            summaries.id.in_(scores.keys())
+        ).all() if scores else []
+        # Summaries deleted since they were indexed simply drop out here
+        rows.sort(key=lambda row: scores[row.id], reverse=True)
+
+        return jsonify([{
+            'id': row.id,
+            'headline': row.headline,
+            'bullet_points': row.bullet_points,
+            'tag': row.tag,
+            'timestamp': row.timestamp.isoformat(),
+            'score': round(scores[row.id], 4)
+        } for row in rows]), 200
     except Exception as e:
-        logger.error(f"Error fetching summary segments: {str(e)}")
+        logger.error(f"Error fetching related summaries: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/get_digest', methods=['GET'])
+@login_required
+def get_digest_view():
+    period = request.args.get('period', 'day')
+    date_str = request.args.get('date')
+    if period not in ('day', 'week'):
+        return jsonify({'error': 'period must be day or week'}), 400
+
+    try:
+        if date_str:
+            date = datetime.strptime(date_str, '%Y-%m-%d')
+        else:
+            date = datetime.now(pytz.timezone(current_user.timezone or 'US/Pacific'))
+
+        start, digest, sections = get_digest(current_user, period, date)
+
+        def serialize(row):
+            return {
+                'period': row.period,
+                'period_start': row.period_start.isoformat(),
+                'headline': row.headline,
+                'bullet_points': row.bullet_points,
+                'source_count': row.source_count,
+                'updated_at': row.updated_at.isoformat() if row.updated_at else None
+            }
+
+        return jsonify({
+            'period': period,
+            'period_start': start.isoformat(),
+            'digest': serialize(digest) if digest and digest.headline else None,
+            # Stale digests are still served; a rebuild is queued
+            'stale': bool(digest and digest.stale),
+            'sections': [serialize(section) for section in sections]
+        }), 200
+    except ValueError:
+        return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+    except Exception as e:
+        logger.error(f"Error fetching digest: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/get_user_uid')
@@ -766,17 +1046,29 @@ def handle_exception(e):
 @app.route('/summary_updates')
 @login_required
 def summary_updates():
+    """Server-sent events for new summaries from any process, pushed over LISTEN/NOTIFY rather than polled."""
+    user_id = current_user.id
+    listener = queue.Queue(maxsize=100)
+    # Nothing below touches the database; hand the connection back for the life of the stream
+    db.session.close()
+
     def event_stream():
-        last_check = time.time()
-        while True:
-            # Check for new summaries every 5 seconds
-            time.sleep(5)
-            new_summaries = check_for_new_summaries(current_user.id, last_check)
-            for summary in new_summaries:
+        with summary_listeners_lock:
+            summary_listeners.setdefault(user_id, set()).add(listener)
+        try:
+            while True:
+                try:
+                    summary = listener.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
                 yield f"data: {json.dumps(summary)}\n\n"
-            last_check = time.time()
+        finally:
+            with summary_listeners_lock:
+                summary_listeners.get(user_id, set()).discard(listener)
 
-    return Response(stream_with_context(event_stream()), content_type='text/event-stream')
+    return Response(event_stream(), content_type='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/admin/check_backlog', methods=['GET'])
 @login_required
@@ -807,27 +1099,21 @@ def check_backlog():
         'timestamp': sum.timestamp.isoformat()
     } for sum in latest_summaries]
     
+    # How far behind each user's summaries are, as the fair scheduler sees it
+    now = datetime.now(pytz.UTC)
+    user_lag = [{
+        'user_id': user_id,
+        'pending_segments': count,
+        'lag_seconds': round((now - oldest).total_seconds(), 1)
+    } for user_id, (oldest, count) in sorted(pending_backlogs(db.session).items(), key=lambda item: item[1][0])]
+
     return jsonify({
         'backlog_segments': backlog_data,
-        'latest_summaries': summaries_data
+        'latest_summaries': summaries_data,
+        'user_lag': user_lag
     }), 200
 
 
-def check_for_new_summaries(user_id, last_check):
-    new_summaries = summaries.query.filter(
-        summaries.user_id == user_id,
-        summaries.timestamp > datetime.fromtimestamp(last_check, pytz.UTC)
-    ).order_by(summaries.timestamp.asc()).all()
-
-    return [{
-        'id': summary.id,
-        'headline': summary.headline,
-        'bullet_points': summary.bullet_points,
-        'tag': summary.tag,
-        'fact_checker': summary.fact_checker,
-        'timestamp': summary.timestamp.isoformat()
-    } for summary in new_summaries]
-
 if __name__ != '__main__':
     # On Replit, this block may not be executed, so we ensure the scheduler starts
     # and application context is properly set up.
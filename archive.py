@@ -0,0 +1,397 @@
+"""
+Cold storage for old transcript segments.
+
+Reads almost always hit the last few days, but segments and main grew without
+bound. archive_old_segments() moves each user's segments older than
+ARCHIVE_AFTER_DAYS out of those tables into segment_archive, one row per user
+and UTC day. A day with segments still waiting in temp_segments is left live
+until the summarizer has dealt with them.
+
+A row holds the day in columnar form: a dict of column -> list for the segments,
+and another for the main rows they belonged to, each zlib-compressed on its own
+so day reads never decompress the raw payloads. Main rows keep raw_data,
+raw_format and raw_blob exactly as stored, so Main.payload can be rebuilt after
+restore_day() moves a day back.
+
+The block is written and the live rows are deleted in the same transaction, so a
+day is either live or archived, and a failed run leaves the rows where they were.
+The archive is in Postgres rather than on local disk, which Heroku wipes on every
+restart or deploy and which other dynos can't read. Readers still drop archived
+rows whose ids are also live, in case a read spans the commit.
+
+Archived days are read by /get_transcripts, /get_summary_segments, /export and the
+day views (/get_dashboard, /get_heatmap_data, /get_word_cloud_data and
+/get_dashboard_stats). Full-text search covers live segments only.
+
+Archives written to ARCHIVE_DIR by earlier versions are loaded with
+`python archive.py --import-dir archive`.
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import zlib
+from datetime import date, datetime, timedelta
+
+import pytz
+from sqlalchemy import func, or_, text
+from sqlalchemy.orm import undefer
+
+from cooperative import offload
+from models import db, Main, Segment, SegmentArchive, User, temp_segments, local_day_and_hour, user_timezone
+from response_cache import cache, invalidate_user_days, warn_if_cache_local
+
+logger = logging.getLogger(__name__)
+
+# Only read by --import-dir, for archives written by the file-based version
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+# 0 disables archival
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 0))
+ARCHIVE_MAX_DAYS_PER_RUN = int(os.environ.get('ARCHIVE_MAX_DAYS_PER_RUN', 30))
+
+# First key of the advisory lock that serialises archivers on a user, across dynos
+ARCHIVE_LOCK_CLASS = 38
+
+SEGMENT_COLUMNS = ('id', 'main_id', 'text', 'speaker', 'speaker_id', 'is_user', 'start_time', 'end_time',
+                   'timestamp', 'summary_id', 'processed')
+MAIN_COLUMNS = ('id', 'uid', 'session_id', 'timestamp', 'host', 'raw_data', 'raw_format', 'raw_blob')
+
+def _to_columns(rows, columns):
+    return {column: [row[column] for row in rows] for column in columns}
+
+def _to_rows(block_columns, columns):
+    count = len(block_columns['id'])
+    # Columns added after a block was written read as None
+    values = [block_columns.get(column) or [None] * count for column in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+def encode_block(rows, columns):
+    return zlib.compress(json.dumps(_to_columns(rows, columns), separators=(',', ':')).encode('utf-8'), 9)
+
+def decode_block(block, columns):
+    return _to_rows(json.loads(zlib.decompress(block).decode('utf-8')), columns)
+
+def _isoformat(timestamp):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=pytz.UTC)
+    return timestamp.astimezone(pytz.UTC).isoformat()
+
+def _utc_days(start, end):
+    day = start.astimezone(pytz.UTC).date()
+    last = (end.astimezone(pytz.UTC) - timedelta(microseconds=1)).date()
+    while day <= last:
+        yield day
+        day += timedelta(days=1)
+
+def read_archived_segments(user_id, start, end):
+    """
+    Archived segments of a user with start <= timestamp < end, as Segment.to_dict() dicts
+    in timestamp order. One primary-key range query when the user has nothing archived.
+    """
+    days = list(_utc_days(start, end))
+    if not days:
+        return []
+    blocks = db.session.query(SegmentArchive.segment_block).filter(
+        SegmentArchive.user_id == user_id,
+        SegmentArchive.day >= days[0],
+        SegmentArchive.day <= days[-1]
+    ).all()
+
+    start_iso, end_iso = _isoformat(start), _isoformat(end)
+    result = []
+    for (block,) in blocks:
+        for row in offload(decode_block, block, SEGMENT_COLUMNS):
+            # UTC isoformat strings sort chronologically, so they compare as text
+            if start_iso <= row['timestamp'] < end_iso:
+                result.append(row)
+    result.sort(key=lambda row: (row['timestamp'], row['id']))
+    return result
+
+def read_archived_summary_segments(user_id, windows):
+    """
+    Archived segments of several summaries. windows maps summary_id -> (start, end) and the
+    result maps summary_id -> segment dicts in timestamp order. Each archived day is fetched
+    and decompressed once, however many of the windows cover it.
+    """
+    days = sorted({day for start, end in windows.values() for day in _utc_days(start, end)})
+    result = {summary_id: [] for summary_id in windows}
+    if not days:
+        return result
+    blocks = db.session.query(SegmentArchive.segment_block).filter(
+        SegmentArchive.user_id == user_id,
+        SegmentArchive.day.in_(days)
+    ).all()
+
+    bounds = {summary_id: (_isoformat(start), _isoformat(end)) for summary_id, (start, end) in windows.items()}
+    for (block,) in blocks:
+        for row in offload(decode_block, block, SEGMENT_COLUMNS):
+            window = bounds.get(row['summary_id'])
+            if window and window[0] <= row['timestamp'] < window[1]:
+                result[row['summary_id']].append(row)
+    for rows in result.values():
+        rows.sort(key=lambda row: (row['timestamp'], row['id']))
+    return result
+
+def merge_with_live(archived, live):
+    """Combine archived and live segment dicts; a row still in Postgres wins over its archived copy."""
+    if not archived:
+        return live
+    live_ids = {row['id'] for row in live}
+    merged = [row for row in archived if row['id'] not in live_ids] + live
+    merged.sort(key=lambda row: (row['timestamp'], row['id']))
+    return merged
+
+def archived_day_rows(user, local_date, tz, utc_start, utc_end):
+    """
+    (local_hour, text) of every segment of a local day, live and archived, for the day views.
+    None when nothing of the day is archived, so the views keep their SQL-only path.
+    """
+    archived = read_archived_segments(user.id, utc_start, utc_end)
+    if not archived:
+        return None
+    live = db.session.query(Segment.id, Segment.local_hour, Segment.text).join(Main).filter(
+        Main.uid == user.uid,
+        Segment.local_date == local_date
+    ).all()
+    live_ids = {segment_id for segment_id, _, _ in live}
+    rows = [(local_day_and_hour(datetime.fromisoformat(row['timestamp']), tz)[1], row['text'])
+            for row in archived if row['id'] not in live_ids]
+    return rows + [(hour, segment_text) for _, hour, segment_text in live]
+
+def _lock_user(user_id):
+    """Take the user's archive lock for the rest of the transaction; False if another archiver has it."""
+    return db.session.execute(text("SELECT pg_try_advisory_xact_lock(:lock_class, :user_id)"),
+                              {'lock_class': ARCHIVE_LOCK_CLASS, 'user_id': user_id}).scalar()
+
+def _merge_rows(previous, rows):
+    merged = {row['id']: row for row in previous}
+    merged.update({row['id']: row for row in rows})
+    return sorted(merged.values(), key=lambda row: row['id'])
+
+def _store_day(user_id, day, segment_rows, main_rows):
+    """Add rows to the user's archive block for day, merging with what is already archived."""
+    existing = db.session.query(SegmentArchive).options(undefer(SegmentArchive.main_block)).filter_by(
+        user_id=user_id, day=day
+    ).first()
+    if existing:
+        # Late rows for a day that was already archived: rewrite the day as one block
+        segment_rows = _merge_rows(decode_block(existing.segment_block, SEGMENT_COLUMNS), segment_rows)
+        main_rows = _merge_rows(decode_block(existing.main_block, MAIN_COLUMNS), main_rows)
+    else:
+        existing = SegmentArchive(user_id=user_id, day=day)
+        db.session.add(existing)
+    existing.segment_block = encode_block(segment_rows, SEGMENT_COLUMNS)
+    existing.main_block = encode_block(main_rows, MAIN_COLUMNS)
+    existing.segment_count = len(segment_rows)
+    existing.main_count = len(main_rows)
+
+def _day_bounds(day):
+    day_start = datetime.combine(day, datetime.min.time(), tzinfo=pytz.UTC)
+    return day_start, day_start + timedelta(days=1)
+
+def _invalidate_day(user, day):
+    day_start, day_end = _day_bounds(day)
+    tz = user_timezone(user.timezone)
+    invalidate_user_days(user.id, [local_day_and_hour(timestamp, tz)[0]
+                                   for timestamp in (day_start, day_end - timedelta(microseconds=1))])
+
+def archive_day(user, day):
+    """
+    Move one UTC day of a user's segments into the archive in a single transaction.
+    Returns the number of segments moved, or None if another archiver holds the user.
+    """
+    day_start, day_end = _day_bounds(day)
+    try:
+        if not _lock_user(user.id):
+            db.session.rollback()
+            return None
+
+        segments = db.session.query(Segment).join(Main).filter(
+            Main.uid == user.uid,
+            Segment.timestamp >= day_start,
+            Segment.timestamp < day_end
+        ).order_by(Segment.id.asc()).all()
+        if not segments:
+            db.session.rollback()
+            return 0
+
+        segment_ids = [segment.id for segment in segments]
+        # Unsummarized backlog stays live so the summarizer or a batch job can still reach it
+        if db.session.query(temp_segments.query.filter(
+            temp_segments.user_id == user.id,
+            temp_segments.segment_id.in_(segment_ids)
+        ).exists()).scalar():
+            db.session.rollback()
+            logger.info(f"User {user.id} still has unsummarized segments on {day}, not archiving it")
+            return 0
+        main_ids = {segment.main_id for segment in segments}
+        # Main rows go with their last segments; a session that also has segments on other days stays live
+        finished_mains = Main.query.options(undefer(Main.raw_blob)).filter(
+            Main.id.in_(main_ids),
+            ~Main.segments.any(or_(Segment.timestamp < day_start, Segment.timestamp >= day_end))
+        ).order_by(Main.id.asc()).all()
+
+        segment_rows = [segment.to_dict() for segment in segments]
+        for row, segment in zip(segment_rows, segments):
+            row['timestamp'] = _isoformat(segment.timestamp)
+        main_rows = [{
+            'id': main.id,
+            'uid': main.uid,
+            'session_id': main.session_id,
+            'timestamp': _isoformat(main.timestamp),
+            'host': main.host,
+            'raw_data': main.raw_data,
+            'raw_format': main.raw_format,
+            'raw_blob': base64.b64encode(main.raw_blob).decode('ascii') if main.raw_blob is not None else None,
+        } for main in finished_mains]
+
+        _store_day(user.id, day, segment_rows, main_rows)
+        Segment.query.filter(Segment.id.in_(segment_ids)).delete(synchronize_session=False)
+        if finished_mains:
+            Main.query.filter(Main.id.in_([main.id for main in finished_mains])).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    _invalidate_day(user, day)
+    logger.info(f"Archived {len(segment_ids)} segments and {len(finished_mains)} sessions of User {user.id} for {day}")
+    db.session.expunge_all()
+    return len(segment_ids)
+
+def restore_day(user, day):
+    """Move an archived UTC day back into main and segments. Returns the number of segments restored."""
+    try:
+        if not _lock_user(user.id):
+            raise RuntimeError(f"Archive for User {user.id} is busy")
+        archived = db.session.query(SegmentArchive).options(undefer(SegmentArchive.main_block)).filter_by(
+            user_id=user.id, day=day
+        ).first()
+        if archived is None:
+            db.session.rollback()
+            return 0
+
+        segment_rows = decode_block(archived.segment_block, SEGMENT_COLUMNS)
+        main_rows = decode_block(archived.main_block, MAIN_COLUMNS)
+        live_main_ids = {main_id for (main_id,) in db.session.query(Main.id).filter(
+            Main.id.in_([row['main_id'] for row in segment_rows]))}
+        live_segment_ids = {segment_id for (segment_id,) in db.session.query(Segment.id).filter(
+            Segment.id.in_([row['id'] for row in segment_rows]))}
+
+        for row in main_rows:
+            if row['id'] in live_main_ids:
+                continue
+            db.session.execute(db.insert(Main).values(
+                **{column: row[column] for column in ('id', 'uid', 'session_id', 'host', 'raw_data', 'raw_format')},
+                timestamp=datetime.fromisoformat(row['timestamp']),
+                raw_blob=base64.b64decode(row['raw_blob']) if row['raw_blob'] is not None else None,
+            ))
+
+        tz = user_timezone(user.timezone)
+        restored = [row for row in segment_rows if row['id'] not in live_segment_ids]
+        for row in restored:
+            timestamp = datetime.fromisoformat(row['timestamp'])
+            local_date, local_hour = local_day_and_hour(timestamp, tz)
+            db.session.execute(db.insert(Segment).values(
+                **{column: row[column] for column in SEGMENT_COLUMNS if column != 'timestamp'},
+                timestamp=timestamp, local_date=local_date, local_hour=local_hour,
+            ))
+        db.session.delete(archived)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    _invalidate_day(user, day)
+    logger.info(f"Restored {len(restored)} segments of User {user.id} for {day}")
+    return len(restored)
+
+def archive_old_segments(after_days=ARCHIVE_AFTER_DAYS, max_days=ARCHIVE_MAX_DAYS_PER_RUN):
+    """Archive up to max_days user-days older than after_days, oldest first. Returns segments moved."""
+    if after_days <= 0:
+        return 0
+
+    cutoff = datetime.now(pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=after_days)
+    utc_day = func.date(func.timezone('UTC', Segment.timestamp))
+    # Days with segments still waiting in temp_segments are left until they are summarized
+    pending = db.session.query(User.id, utc_day).select_from(Segment).join(Main).join(
+        User, User.uid == Main.uid
+    ).outerjoin(temp_segments, temp_segments.segment_id == Segment.id).filter(
+        Segment.timestamp < cutoff
+    ).group_by(User.id, utc_day).having(func.count(temp_segments.id) == 0).order_by(
+        utc_day.asc(), User.id.asc()
+    ).limit(max_days).all()
+    db.session.commit()
+
+    moved = 0
+    for user_id, day in pending:
+        user = db.session.get(User, user_id)
+        try:
+            count = archive_day(user, day)
+        except Exception as e:
+            logger.error(f"Error archiving {day} for User {user_id}: {str(e)}")
+            continue
+        if count is None:
+            logger.info(f"Archive for User {user_id} is busy, skipping {day}")
+        else:
+            moved += count
+    return moved
+
+def import_file_archive(archive_dir=ARCHIVE_DIR):
+    """
+    Load archives written to archive_dir by the file-based version, one day per transaction.
+    Their main rows only kept the payload envelope, so they are imported as raw_format 'envelope'.
+    Returns the number of segments imported; the files can be removed afterwards.
+    """
+    imported = 0
+    for user_dir in sorted(os.listdir(archive_dir)):
+        if not user_dir.startswith('user_'):
+            continue
+        user_id = int(user_dir[len('user_'):])
+        path = os.path.join(archive_dir, user_dir)
+        for index_name in sorted(name for name in os.listdir(path) if name.endswith('.json')):
+            with open(os.path.join(path, index_name)) as f:
+                index = json.load(f)
+            with open(os.path.join(path, index_name[:-len('.json')] + '.seg'), 'rb') as f:
+                data = f.read()
+            for day, entry in sorted(index.items()):
+                block = json.loads(zlib.decompress(data[entry['offset']:entry['offset'] + entry['length']]))
+                main_rows = _to_rows(block['main'], MAIN_COLUMNS)
+                for row in main_rows:
+                    row['raw_format'] = 'envelope'
+                _store_day(user_id, date.fromisoformat(day), _to_rows(block['segments'], SEGMENT_COLUMNS), main_rows)
+                db.session.commit()
+                imported += entry['segments']
+                logger.info(f"Imported {entry['segments']} archived segments of User {user_id} for {day}")
+    return imported
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--after-days', type=int, default=ARCHIVE_AFTER_DAYS or 90)
+    parser.add_argument('--max-days', type=int, default=ARCHIVE_MAX_DAYS_PER_RUN)
+    parser.add_argument('--import-dir', help="Load a file-based archive directory into segment_archive")
+    parser.add_argument('--restore', nargs=2, metavar=('USER_ID', 'UTC_DAY'),
+                        help="Move an archived day (YYYY-MM-DD) back into the live tables")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    from flask import Flask
+    from config import Config
+    from database import init_database
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    init_database(app, role='worker')
+    cache.init_app(app)
+    warn_if_cache_local("archival run from the command line")
+    with app.app_context():
+        if args.import_dir:
+            print(f"Imported {import_file_archive(args.import_dir)} segments")
+        elif args.restore:
+            user = db.session.get(User, int(args.restore[0]))
+            print(f"Restored {restore_day(user, date.fromisoformat(args.restore[1]))} segments")
+        else:
+            print(f"Archived {archive_old_segments(args.after_days, args.max_days)} segments")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
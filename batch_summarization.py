@@ -0,0 +1,550 @@
+"""
+Bulk (re)summarization through provider batch APIs.
+
+The scheduler summarizes chunks one synchronous call at a time, which is fine
+for live traffic but slow and expensive for thousands of chunks after a prompt
+change or an outage. This module instead packs every chunk's summary and
+fact-check requests into JSONL batch jobs, polls them until they finish, and
+writes the results back in bulk.
+
+Two modes:
+  backlog      summarize unprocessed temp_segments, like the scheduler would
+  resummarize  regenerate existing summaries in place from their linked segments
+
+Two backends:
+  openai  the OpenAI Batch API (JSONL in, JSONL out, 24h completion window)
+  local   a file-based stand-in that runs the requests through get_llm() when
+          polled, producing output in the same format. Use it with
+          BATCH_LOCAL_MODEL=fake for testing.
+
+A job's chunk definitions are kept in a manifest under BATCH_DIR, so a job
+submitted in one run can be collected in another:
+
+    python batch_summarization.py run --mode backlog --backend local
+    python batch_summarization.py submit --mode resummarize --since 2024-10-01
+    python batch_summarization.py resume <job_id>
+
+Backlog segments are claimed (processed_at is set) at submit time so the
+scheduler does not summarize them as well; chunks that fail are released again.
+`release <job_id>` hands back the claims of a job that will not be applied, and
+the scheduler's cleanup job releases claims older than BATCH_CLAIM_TTL_HOURS.
+
+Results are committed every commit_every chunks and the progress is saved to
+the manifest. A backlog chunk whose segments already have a summary is skipped,
+so resuming a job that stopped part way through does not write it twice.
+Summaries written here are not sent to Reflect. Open /summary_updates streams
+receive them as summary_written events when each batch commits.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta
+
+import pytz
+from flask import Flask
+from langchain.output_parsers import PydanticOutputParser
+from sqlalchemy import update
+
+from config import Config
+from database import init_database
+from models import db, Segment, summaries, temp_segments
+from notifications import notify_summary_event, summary_event_data
+from related import rebuild_user_index, sync_user_index
+from response_cache import cache, invalidate_user_days, warn_if_cache_local
+from summarization import (SUMMARY_PROMPT, FACT_CHECK_PROMPT, FORMATTED_CATEGORIES, FactCheck, PartialSummary,
+                           combine_results, get_llm)
+from summarization_handler import COMPACT_TRANSCRIPTS, TRANSCRIPT_TOKEN_BUDGET
+from text_processing import compact_transcript
+
+logger = logging.getLogger(__name__)
+
+BATCH_DIR = os.environ.get('BATCH_DIR', 'batch_jobs')
+BATCH_OPENAI_MODEL = os.environ.get('BATCH_OPENAI_MODEL', 'gpt-4o')
+BATCH_LOCAL_MODEL = os.environ.get('BATCH_LOCAL_MODEL', 'fake')
+# OpenAI accepts up to 50,000 requests per batch; each chunk needs two
+MAX_REQUESTS_PER_BATCH = int(os.environ.get('BATCH_MAX_REQUESTS', 40000))
+TERMINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+CHUNK_SIZE_MINUTES = 10
+MIN_CHUNK_CHARS = 50
+
+class OpenAIBatchBackend:
+    name = 'openai'
+
+    def __init__(self):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+
+    def request_line(self, custom_id, prompt):
+        return {
+            'custom_id': custom_id,
+            'method': 'POST',
+            'url': '/v1/chat/completions',
+            'body': {
+                'model': BATCH_OPENAI_MODEL,
+                'messages': [{'role': 'user', 'content': prompt}],
+                'max_tokens': 2000,
+                'temperature': 0.5,
+            },
+        }
+
+    def submit(self, input_path):
+        with open(input_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions',
+                                           completion_window='24h')
+        return batch.id
+
+    def status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def download(self, batch_id, output_path):
+        batch = self.client.batches.retrieve(batch_id)
+        with open(output_path, 'w') as f:
+            # Failed requests are reported in a separate error file in the same line format
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    f.write(self.client.files.content(file_id).text)
+
+class LocalBatchBackend:
+    """Stand-in for a provider batch API that runs the requests through get_llm() on first poll."""
+    name = 'local'
+
+    def __init__(self, model=BATCH_LOCAL_MODEL):
+        self.model = model
+        self.directory = os.path.join(BATCH_DIR, 'local')
+
+    def request_line(self, custom_id, prompt):
+        return {'custom_id': custom_id, 'body': {'messages': [{'role': 'user', 'content': prompt}]}}
+
+    def _path(self, batch_id, kind):
+        return os.path.join(self.directory, f"{batch_id}.{kind}.jsonl")
+
+    def submit(self, input_path):
+        os.makedirs(self.directory, exist_ok=True)
+        batch_id = f"local_{uuid.uuid4().hex[:12]}"
+        os.replace(input_path, self._path(batch_id, 'input'))
+        return batch_id
+
+    def status(self, batch_id):
+        if not os.path.exists(self._path(batch_id, 'output')):
+            self._process(batch_id)
+        return 'completed'
+
+    def _process(self, batch_id):
+        llm = get_llm(self.model)
+        tmp_path = self._path(batch_id, 'output') + '.tmp'
+        with open(self._path(batch_id, 'input')) as requests_file, open(tmp_path, 'w') as output:
+            for line in requests_file:
+                request = json.loads(line)
+                try:
+                    message = llm.invoke(request['body']['messages'][0]['content'])
+                    result = {'custom_id': request['custom_id'], 'error': None, 'response': {
+                        'status_code': 200,
+                        'body': {'choices': [{'message': {'role': 'assistant', 'content': message.content}}],
+                                 'usage': getattr(message, 'usage_metadata', None)},
+                    }}
+                except Exception as e:
+                    result = {'custom_id': request['custom_id'], 'response': None,
+                              'error': {'code': type(e).__name__, 'message': str(e)}}
+                output.write(json.dumps(result) + "\n")
+        os.replace(tmp_path, self._path(batch_id, 'output'))
+
+    def download(self, batch_id, output_path):
+        with open(self._path(batch_id, 'output')) as source, open(output_path, 'w') as target:
+            target.write(source.read())
+
+def get_backend(name):
+    if name == 'openai':
+        return OpenAIBatchBackend()
+    if name == 'local':
+        return LocalBatchBackend()
+    raise ValueError(f"Unsupported batch backend: {name}")
+
+def manifest_path(job_id):
+    return os.path.join(BATCH_DIR, f"{job_id}.json")
+
+def save_job(job):
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    tmp_path = manifest_path(job['id']) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f, indent=2)
+    os.replace(tmp_path, manifest_path(job['id']))
+
+def load_job(job_id):
+    with open(manifest_path(job_id)) as f:
+        return json.load(f)
+
+def chunk_text(fragments):
+    if COMPACT_TRANSCRIPTS:
+        return compact_transcript(fragments, token_budget=TRANSCRIPT_TOKEN_BUDGET).text
+    return " ".join(text for _, text in fragments)
+
+def collect_backlog_chunks(user_id=None, chunk_size_minutes=CHUNK_SIZE_MINUTES):
+    """Group unprocessed temp_segments into the same 10-minute windows the scheduler uses, and claim them."""
+    query = temp_segments.query.filter(temp_segments.processed_at.is_(None))
+    if user_id:
+        query = query.filter(temp_segments.user_id == user_id)
+    rows = query.order_by(temp_segments.user_id.asc(), temp_segments.timestamp.asc()).all()
+
+    window = timedelta(minutes=chunk_size_minutes)
+    groups = {}
+    first_by_user = {}
+    for row in rows:
+        first = first_by_user.setdefault(row.user_id, row.timestamp)
+        index = int((row.timestamp - first) / window)
+        groups.setdefault((row.user_id, index), []).append(row)
+
+    chunks = []
+    claimed_at = datetime.now(pytz.UTC)
+    for (chunk_user_id, _), group in groups.items():
+        text = chunk_text([(row.speaker, row.text) for row in group])
+        if len(text.strip()) < MIN_CHUNK_CHARS:
+            continue
+        for row in group:
+            row.processed_at = claimed_at
+        chunks.append({
+            'user_id': chunk_user_id,
+            'segment_ids': [row.segment_id for row in group],
+            'timestamp': group[0].timestamp.isoformat(),
+            'text': text,
+        })
+    db.session.commit()
+    return chunks
+
+def collect_resummarize_chunks(user_id=None, since=None, until=None):
+    query = summaries.query
+    if user_id:
+        query = query.filter(summaries.user_id == user_id)
+    if since:
+        query = query.filter(summaries.timestamp >= since)
+    if until:
+        query = query.filter(summaries.timestamp < until)
+    summary_rows = query.order_by(summaries.id.asc()).all()
+    if not summary_rows:
+        return []
+
+    segments_by_summary = {}
+    for segment in Segment.query.filter(
+        Segment.summary_id.in_([row.id for row in summary_rows])
+    ).order_by(Segment.timestamp.asc()).all():
+        segments_by_summary.setdefault(segment.summary_id, []).append(segment)
+
+    chunks = []
+    for row in summary_rows:
+        linked = segments_by_summary.get(row.id)
+        if not linked:
+            continue
+        text = chunk_text([(segment.speaker, segment.text) for segment in linked])
+        if len(text.strip()) < MIN_CHUNK_CHARS:
+            continue
+        chunks.append({
+            'user_id': row.user_id,
+            'summary_id': row.id,
+            'segment_ids': [segment.id for segment in linked],
+            'timestamp': row.timestamp.isoformat(),
+            'text': text,
+        })
+    return chunks
+
+def build_requests(backend, chunks):
+    """Yield one summary and one fact-check request line per chunk."""
+    pacific_tz = pytz.timezone('US/Pacific')
+    for index, chunk in enumerate(chunks):
+        # Date the prompt at the time the conversation happened, not when the batch runs
+        current_datetime = datetime.fromisoformat(chunk['timestamp']).astimezone(pacific_tz).strftime("%Y-%m-%d %H:%M:%S %Z")
+        yield backend.request_line(f"{index}:summary", SUMMARY_PROMPT.format(
+            categories=FORMATTED_CATEGORIES, text=chunk['text'], current_datetime=current_datetime))
+        yield backend.request_line(f"{index}:fact_check", FACT_CHECK_PROMPT.format(
+            text=chunk['text'], current_datetime=current_datetime))
+
+def submit_job(mode, backend, user_id=None, since=None, until=None):
+    job_id = f"{mode}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:6]}"
+    if mode == 'backlog':
+        chunks = collect_backlog_chunks(user_id)
+    else:
+        chunks = collect_resummarize_chunks(user_id, since, until)
+
+    job = {'id': job_id, 'mode': mode, 'backend': backend.name, 'created_at': datetime.utcnow().isoformat(),
+           'chunks': chunks, 'batches': [], 'applied': False}
+    if not chunks:
+        logger.info(f"No chunks to summarize for {mode} job")
+        job['applied'] = True
+        save_job(job)
+        return job
+
+    # Save before submitting so claimed segments can always be traced back to this job
+    save_job(job)
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    request_lines = list(build_requests(backend, chunks))
+    for start in range(0, len(request_lines), MAX_REQUESTS_PER_BATCH):
+        input_path = os.path.join(BATCH_DIR, f"{job_id}.{len(job['batches'])}.input.jsonl")
+        with open(input_path, 'w') as f:
+            for line in request_lines[start:start + MAX_REQUESTS_PER_BATCH]:
+                f.write(json.dumps(line) + "\n")
+        batch_id = backend.submit(input_path)
+        job['batches'].append({'id': batch_id, 'status': 'submitted'})
+        save_job(job)
+        logger.info(f"Submitted batch {batch_id} for job {job_id}")
+
+    logger.info(f"Submitted {len(chunks)} chunks in {len(job['batches'])} batches as job {job_id}")
+    return job
+
+def wait_for_job(job, backend, poll_interval=60, timeout=None):
+    """Poll until every batch in the job has finished. Returns True when all completed."""
+    started = time.monotonic()
+    while True:
+        for batch in job['batches']:
+            if batch['status'] not in TERMINAL_STATUSES:
+                batch['status'] = backend.status(batch['id'])
+        save_job(job)
+
+        pending = [batch['id'] for batch in job['batches'] if batch['status'] not in TERMINAL_STATUSES]
+        if not pending:
+            return all(batch['status'] == 'completed' for batch in job['batches'])
+        if timeout and time.monotonic() - started > timeout:
+            logger.info(f"Job {job['id']} still waiting on {len(pending)} batches")
+            return False
+        logger.info(f"Job {job['id']}: {len(pending)} batches pending")
+        time.sleep(poll_interval)
+
+def read_results(job, backend):
+    """Return {custom_id: response text} for every successful request in the job."""
+    results = {}
+    for batch in job['batches']:
+        if batch['status'] != 'completed':
+            continue
+        output_path = os.path.join(BATCH_DIR, f"{job['id']}.{batch['id']}.output.jsonl")
+        backend.download(batch['id'], output_path)
+        with open(output_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get('response') or {}
+                if item.get('error') or response.get('status_code') != 200:
+                    logger.warning(f"Request {item.get('custom_id')} failed: {item.get('error') or response.get('status_code')}")
+                    continue
+                results[item['custom_id']] = response['body']['choices'][0]['message']['content']
+    return results
+
+def parse_chunk(results, index):
+    summary_parser = PydanticOutputParser(pydantic_object=PartialSummary)
+    fact_check_parser = PydanticOutputParser(pydantic_object=FactCheck)
+
+    summary_text = results.get(f"{index}:summary")
+    if summary_text is None:
+        return None
+    summary_part = summary_parser.parse(summary_text)
+    if summary_part.headline == "INSUFFICIENT_CONTEXT":
+        return None
+
+    fact_check_text = results.get(f"{index}:fact_check")
+    fact_check_part = fact_check_parser.parse(fact_check_text) if fact_check_text else FactCheck()
+    return combine_results(summary_part, fact_check_part)
+
+def apply_job(job, backend, commit_every=500):
+    """Write the job's results back in bulk. Returns counts of written, skipped and failed chunks."""
+    if job.get('applied'):
+        logger.info(f"Job {job['id']} was already applied")
+        return {}
+
+    results = read_results(job, backend)
+    counts = {'written': 0, 'skipped': 0, 'failed': 0}
+    users = set()
+    failed_segment_ids = []
+
+    pending = []
+    for index, chunk in enumerate(job['chunks']):
+        try:
+            summary = parse_chunk(results, index)
+        except Exception as e:
+            logger.warning(f"Could not parse results for chunk {index} of job {job['id']}: {str(e)}")
+            summary = None
+
+        if summary is None:
+            counts['failed'] += 1
+            if job['mode'] == 'backlog':
+                failed_segment_ids.extend(chunk['segment_ids'])
+            continue
+
+        pending.append((chunk, summary))
+        users.add(chunk['user_id'])
+        if len(pending) >= commit_every:
+            record_batch(job, counts, pending)
+            pending = []
+
+    if pending:
+        record_batch(job, counts, pending)
+
+    if failed_segment_ids:
+        # Hand failed chunks back to the scheduler, counting this as one attempt
+        temp_segments.query.filter(temp_segments.segment_id.in_(failed_segment_ids)).update({
+            temp_segments.processed_at: None,
+            temp_segments.processing_attempts: temp_segments.processing_attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+
+    for user_id in users:
+        try:
+            if job['mode'] == 'resummarize':
+                rebuild_user_index(user_id)
+            else:
+                sync_user_index(user_id)
+        except Exception as e:
+            logger.warning(f"Failed to update related index for User {user_id}: {str(e)}")
+
+    job['applied'] = True
+    job['result'] = counts
+    save_job(job)
+    logger.info(f"Applied job {job['id']}: {counts}")
+    return counts
+
+def record_batch(job, counts, pending):
+    written = write_results(job['mode'], pending)
+    counts['written'] += written
+    counts['skipped'] += len(pending) - written
+    job['progress'] = dict(counts)
+    save_job(job)
+
+def already_summarized(pending):
+    """Drop backlog chunks whose segments were linked to a summary by an earlier, interrupted apply."""
+    segment_ids = [segment_id for chunk, _ in pending for segment_id in chunk['segment_ids']]
+    linked = set(db.session.execute(
+        db.select(Segment.id).where(Segment.id.in_(segment_ids), Segment.summary_id.isnot(None))
+    ).scalars())
+    return [(chunk, summary) for chunk, summary in pending
+            if not any(segment_id in linked for segment_id in chunk['segment_ids'])]
+
+def write_results(mode, pending):
+    """Write one batch of results and commit. Returns how many chunks were written."""
+    if mode == 'backlog':
+        pending = already_summarized(pending)
+        if not pending:
+            return 0
+        new_rows = [summaries(
+            user_id=chunk['user_id'],
+            headline=summary.headline,
+            bullet_points=summary.bullet_points,
+            tag=summary.tag,
+            fact_checker=summary.fact_checker,
+            timestamp=datetime.fromisoformat(chunk['timestamp']),
+            created_at=datetime.utcnow()
+        ) for chunk, summary in pending]
+        db.session.add_all(new_rows)
+        db.session.flush()
+
+        links = [{'id': segment_id, 'processed': True, 'summary_id': row.id}
+                 for row, (chunk, _) in zip(new_rows, pending) for segment_id in chunk['segment_ids']]
+        db.session.execute(update(Segment), links)
+        db.session.query(temp_segments).filter(
+            temp_segments.segment_id.in_([link['id'] for link in links])
+        ).delete(synchronize_session=False)
+        written = new_rows
+    else:
+        # Load and modify the rows (rather than a bulk UPDATE) so the search vector
+        # and digest listeners see the change
+        by_id = {row.id: row for row in summaries.query.filter(
+            summaries.id.in_([chunk['summary_id'] for chunk, _ in pending])
+        ).all()}
+        for chunk, summary in pending:
+            row = by_id.get(chunk['summary_id'])
+            if row is None:
+                continue
+            row.headline = summary.headline
+            row.bullet_points = summary.bullet_points
+            row.tag = summary.tag
+            row.fact_checker = summary.fact_checker
+        written = list(by_id.values())
+
+    # Read before the commit expires the rows
+    days = {}
+    for row in written:
+        days.setdefault(row.user_id, []).append(row.local_date)
+        notify_summary_event(row.user_id, 'summary_written', summary_event_data(row), session=db.session)
+    db.session.commit()
+    for user_id, dates in days.items():
+        invalidate_user_days(user_id, dates)
+    return len(written)
+
+def release_job(job):
+    """Hand a backlog job's claimed segments back to the scheduler instead of applying its results."""
+    if job.get('applied'):
+        logger.info(f"Job {job['id']} was already applied")
+        return {}
+    released = 0
+    if job['mode'] == 'backlog':
+        segment_ids = [segment_id for chunk in job['chunks'] for segment_id in chunk['segment_ids']]
+        # Segments whose summaries were already written are no longer in temp_segments
+        released = temp_segments.query.filter(
+            temp_segments.segment_id.in_(segment_ids),
+            temp_segments.processed_at.isnot(None)
+        ).update({temp_segments.processed_at: None}, synchronize_session=False)
+        db.session.commit()
+    counts = {'released': released}
+    job['applied'] = True
+    job['result'] = counts
+    save_job(job)
+    logger.info(f"Released job {job['id']}: {counts}")
+    return counts
+
+def create_batch_app():
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    init_database(app, role='worker')
+    cache.init_app(app)
+    warn_if_cache_local("batch reprocessing")
+    return app
+
+def parse_date(value):
+    return pytz.UTC.localize(datetime.strptime(value, '%Y-%m-%d')) if value else None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in ('run', 'submit'):
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument('--mode', choices=['backlog', 'resummarize'], default='backlog')
+        subparser.add_argument('--backend', choices=['openai', 'local'], default='openai')
+        subparser.add_argument('--user-id', type=int)
+        subparser.add_argument('--since', help="resummarize: first day to include (YYYY-MM-DD, UTC)")
+        subparser.add_argument('--until', help="resummarize: day to stop before (YYYY-MM-DD, UTC)")
+        subparser.add_argument('--poll-interval', type=float, default=60)
+    resume = subparsers.add_parser('resume')
+    resume.add_argument('job_id')
+    resume.add_argument('--poll-interval', type=float, default=60)
+    release = subparsers.add_parser('release', help="Abandon a job and hand its claimed segments back to the scheduler")
+    release.add_argument('job_id')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    app = create_batch_app()
+    with app.app_context():
+        try:
+            if args.command == 'release':
+                print(json.dumps(release_job(load_job(args.job_id))))
+                return 0
+            if args.command == 'resume':
+                job = load_job(args.job_id)
+                backend = get_backend(job['backend'])
+            else:
+                backend = get_backend(args.backend)
+                job = submit_job(args.mode, backend, args.user_id, parse_date(args.since), parse_date(args.until))
+                if args.command == 'submit':
+                    print(job['id'])
+                    return 0
+
+            wait_for_job(job, backend, poll_interval=args.poll_interval)
+            print(json.dumps(apply_job(job, backend)))
+            return 0
+        except Exception as e:
+            logger.error(f"Batch summarization failed: {str(e)}")
+            logger.error(traceback.format_exc())
+            return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""
+End-to-end benchmark for the summarization pipeline using the offline fake model.
+
+Seeds temp_segments with a synthetic multi-user backlog, runs summarization_task
+(fair_scheduler -> process_user_chunk -> generate_summary) at each concurrency setting,
+and reports chunks/sec, database queries per chunk and end-to-end lag.
+
+    BENCH_DATABASE_URL=postgresql://localhost/soundbrain_bench \\
+        python benchmarks/bench_summarization.py --users 8 --hours 6 --concurrency 1,4
+
+Pass --check-baseline to fail when throughput or query counts regress against
+benchmarks/baselines/summarization.json, and --save-baseline to update it.
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bench_utils import (QueryCounter, compare_to_baseline, create_bench_app, get_bench_database_url,
+                         load_baseline, percentile, print_table, reset_database, save_baseline)
+
+# Summaries must come from the fake model and must not be pushed to Reflect
+os.environ['SUMMARY_MODEL'] = 'fake'
+os.environ['FACT_CHECK_MODEL'] = 'fake'
+os.environ['STREAM_SUMMARIES'] = 'false'
+os.environ.pop('REFLECT_ACCESS_TOKEN', None)
+# Keep the router from failing over to a real provider when the fake model injects errors
+os.environ.pop('OPENAI_API_KEY', None)
+os.environ.pop('ANTHROPIC_API_KEY', None)
+
+import summarization_handler
+from fake_llm import configure_fake_llm
+from models import db, Main, Segment, User, temp_segments
+
+WORDS = (
+    "the team reviewed quarterly pipeline numbers and agreed to follow up with the customer "
+    "about pricing next week while Armaan finished his homework and Gizmo waited by the door "
+    "we should book the flight to Seattle before Friday because the conference starts Monday "
+    "remember to pick up groceries and call the vet about the appointment on Thursday afternoon"
+).split()
+
+def synthetic_sentence(rng):
+    words = rng.choices(WORDS, k=rng.randint(6, 18))
+    return " ".join(words).capitalize() + "."
+
+def seed_backlog(users, hours, segments_per_minute, seed):
+    """Insert a synthetic backlog of unsummarized segments for several users."""
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    total_segments = 0
+
+    for index in range(users):
+        user = User(f"bench_user_{index}", uid=f"bench-uid-{index}")
+        db.session.add(user)
+        db.session.flush()
+
+        # Users have very different backlog sizes, from a few minutes to the full window
+        user_hours = hours if index == 0 else rng.uniform(0.1, hours)
+        start = now - timedelta(hours=user_hours)
+        minutes = int(user_hours * 60)
+        main_entry = None
+
+        for minute in range(minutes):
+            if minute % 20 == 0:
+                main_entry = Main(uid=user.uid, session_id=f"bench-{index}-{minute}", timestamp=start,
+                                  host='127.0.0.1', raw_data={})
+                db.session.add(main_entry)
+                db.session.flush()
+
+            for _ in range(rng.randint(0, segments_per_minute * 2)):
+                timestamp = start + timedelta(minutes=minute, seconds=rng.uniform(0, 60))
+                sentence = synthetic_sentence(rng)
+                speaker = f"SPEAKER_{rng.randint(0, 2)}"
+                segment = Segment(main_id=main_entry.id, text=sentence, speaker=speaker, speaker_id=0,
+                                  is_user=False, timestamp=timestamp)
+                db.session.add(segment)
+                db.session.flush()
+                db.session.add(temp_segments(user_id=user.id, segment_id=segment.id, speaker=speaker,
+                                             text=sentence, timestamp=timestamp, processed_at=None))
+                total_segments += 1
+
+    db.session.commit()
+    return total_segments
+
+def run_once(app, counter, args, concurrency):
+    with app.app_context():
+        reset_database()
+        total_segments = seed_backlog(args.users, args.hours, args.segments_per_minute, args.seed)
+        oldest = db.session.query(db.func.min(temp_segments.timestamp)).scalar()
+
+    configure_fake_llm(latency_ms=args.latency_ms, latency_jitter_ms=args.latency_jitter_ms,
+                       slow_rate=args.slow_rate, slow_latency_ms=args.slow_latency_ms,
+                       error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                       rate_limit_retry_after=args.rate_limit_retry_after, seed=args.seed)
+
+    chunk_lags = []
+    chunk_statuses = []
+    original = summarization_handler.process_segments_for_summary
+
+    def timed_chunk(user_id, start_time, end_time):
+        status, summary_id = original(user_id, start_time, end_time)
+        chunk_statuses.append(status)
+        if status == "success":
+            chunk_lags.append(time.monotonic() - run_start)
+        return status, summary_id
+
+    summarization_handler.process_segments_for_summary = timed_chunk
+    counter.reset()
+    run_start = time.monotonic()
+    try:
+        with app.app_context():
+            summarization_handler.summarization_task(max_workers=concurrency)
+    finally:
+        summarization_handler.process_segments_for_summary = original
+    elapsed = time.monotonic() - run_start
+
+    with app.app_context():
+        remaining = temp_segments.query.count()
+
+    chunks = len(chunk_statuses)
+    return {
+        'concurrency': concurrency,
+        'segments': total_segments,
+        'chunks': chunks,
+        'summaries': chunk_statuses.count("success"),
+        'errors': chunk_statuses.count("error"),
+        'rate_limited': chunk_statuses.count("rate_limited"),
+        'remaining': remaining,
+        'seconds': elapsed,
+        'chunks_per_sec': chunks / elapsed if elapsed else None,
+        'queries_per_chunk': counter.count / chunks if chunks else None,
+        'db_time_per_chunk': counter.total_time / chunks if chunks else None,
+        'lag_p50': percentile(chunk_lags, 50),
+        'lag_p95': percentile(chunk_lags, 95),
+        'lag_max': max(chunk_lags) if chunk_lags else None,
+        'backlog_age_hours': round((datetime.utcnow() - oldest.replace(tzinfo=None)).total_seconds() / 3600, 2) if oldest else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--users', type=int, default=6)
+    parser.add_argument('--hours', type=float, default=3.0, help="Backlog length of the largest user")
+    parser.add_argument('--segments-per-minute', type=int, default=4)
+    parser.add_argument('--concurrency', default="1,4", help="Comma-separated summarization worker counts")
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--latency-jitter-ms', type=float, default=20.0)
+    parser.add_argument('--slow-rate', type=float, default=0.02)
+    parser.add_argument('--slow-latency-ms', type=float, default=1000.0)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Fraction of LLM calls answered with a 429")
+    parser.add_argument('--rate-limit-retry-after', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative regression in chunks/sec")
+    parser.add_argument('--verbose', action='store_true', help="Keep the pipeline's own logging")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.ERROR)
+
+    concurrencies = [int(c) for c in args.concurrency.split(',')]
+    # Size the worker pool for the largest run, as SUMMARIZATION_CONCURRENCY does in production
+    os.environ.setdefault('DB_WORKER_MAX_OVERFLOW', str(2 * max(concurrencies) + 1))
+    app = create_bench_app(get_bench_database_url(args.database_url))
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+
+    results = [run_once(app, counter, args, concurrency) for concurrency in concurrencies]
+    print_table(results, ['concurrency', 'segments', 'chunks', 'summaries', 'errors', 'rate_limited', 'remaining', 'seconds',
+                          'chunks_per_sec', 'queries_per_chunk', 'db_time_per_chunk', 'lag_p50', 'lag_p95', 'lag_max'])
+
+    if args.save_baseline:
+        save_baseline('summarization', results)
+
+    if args.check_baseline:
+        baseline = load_baseline('summarization')
+        if baseline is None:
+            print("No baseline stored; run with --save-baseline first")
+            return 1
+        regressions = compare_to_baseline(results, baseline, 'concurrency', {
+            'chunks_per_sec': ('higher', args.tolerance),
+            'queries_per_chunk': ('lower', 0.1),
+        })
+        if regressions:
+            print("Regressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""Shared helpers for the benchmark scripts in this directory."""
+import json
+import os
+import sys
+import threading
+import time
+
+from flask import Flask
+from sqlalchemy import event, text
+
+# Make the application modules importable when a script is run directly
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from config import Config
+from database import init_database
+from models import db
+from schema import upgrade_schema
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+def get_bench_database_url(cli_value=None):
+    """
+    Resolve the benchmark database URL.
+
+    Benchmarks truncate every table, so they refuse to run against DATABASE_URL.
+    """
+    url = cli_value or os.environ.get('BENCH_DATABASE_URL')
+    if not url:
+        raise SystemExit("Set BENCH_DATABASE_URL (or pass --database-url) to a dedicated, disposable database")
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    if url == Config.SQLALCHEMY_DATABASE_URI:
+        raise SystemExit("Refusing to benchmark against DATABASE_URL; benchmarks truncate every table")
+    return url
+
+def create_bench_app(database_url):
+    """Minimal Flask app bound to the benchmark database, without the web app's OAuth and scheduler setup."""
+    app = Flask('benchmark')
+    app.config.from_object(Config)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    init_database(app, role='worker')
+    return app
+
+def reset_database():
+    """Bring the schema up to date and empty every table. Call inside an app context."""
+    upgrade_schema()
+    table_names = ", ".join(f'"{table.name}"' for table in db.metadata.sorted_tables)
+    db.session.execute(text(f"TRUNCATE {table_names} RESTART IDENTITY CASCADE"))
+    db.session.commit()
+
+class QueryCounter:
+    """Count statements and time spent in the database for an engine."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.total_time = 0.0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        self.local.start = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - getattr(self.local, 'start', time.perf_counter())
+        with self.lock:
+            self.count += 1
+            self.total_time += elapsed
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.total_time = 0.0
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self._before)
+        event.remove(self.engine, 'after_cursor_execute', self._after)
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+def print_table(rows, columns):
+    widths = {column: max(len(column), *(len(format_value(row.get(column))) for row in rows)) for column in columns}
+    print("  ".join(column.rjust(widths[column]) for column in columns))
+    for row in rows:
+        print("  ".join(format_value(row.get(column)).rjust(widths[column]) for column in columns))
+
+def format_value(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
+
+def load_baseline(name):
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_baseline(name, results):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"Saved baseline to {path}")
+
+def compare_to_baseline(results, baseline, key, checks):
+    """
+    Compare results to a stored baseline and return a list of regression messages.
+
+    results and baseline are lists of dicts matched on key. checks maps a metric name
+    to (direction, tolerance): direction is 'higher' when bigger is better and 'lower'
+    when smaller is better; tolerance is the allowed relative change.
+    """
+    regressions = []
+    baseline_by_key = {row[key]: row for row in baseline}
+    for row in results:
+        expected = baseline_by_key.get(row[key])
+        if not expected:
+            continue
+        for metric, (direction, tolerance) in checks.items():
+            current, previous = row.get(metric), expected.get(metric)
+            if current is None or not previous:
+                continue
+            change = (current - previous) / previous
+            if (direction == 'higher' and change < -tolerance) or (direction == 'lower' and change > tolerance):
+                regressions.append(f"{key}={row[key]} {metric}: {previous:.3f} -> {current:.3f} ({change:+.1%})")
+    return regressions
@@ -0,0 +1,175 @@
+"""
+Memory benchmark for the word cloud's word-frequency pass.
+
+Seeds one user with days of increasing size. Each day's frequencies are computed
+the way /get_word_cloud_data does, streaming segments.text through a server-side
+cursor and counting segment by segment. For comparison, the old approach is run
+too: load every Segment, join the texts into one string and tokenize it at once.
+For each day size and tokenizer it reports time and the Python heap peak
+measured with tracemalloc. Streaming should stay flat as days grow.
+
+    BENCH_DATABASE_URL=postgresql://localhost/soundbrain_bench \\
+        python benchmarks/bench_word_cloud.py --day-sizes 1000,10000,50000 --tokenizers nltk,regex
+
+tracemalloc only sees Python allocations, not libpq's result buffers, so the
+materialized numbers understate its real footprint.
+
+Pass --check-baseline to fail when peak memory or throughput regress against
+benchmarks/baselines/word_cloud.json, and --save-baseline to update it.
+"""
+import argparse
+import logging
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+from bench_utils import (compare_to_baseline, create_bench_app, get_bench_database_url, load_baseline, print_table,
+                         reset_database, save_baseline)
+
+from models import db, Main, Segment, User
+from text_processing import count_words, word_cloud_setup, word_frequencies
+
+WORDS = (
+    "the team reviewed quarterly pipeline numbers and agreed to follow up with the customer "
+    "about pricing next week while Armaan finished his homework and Gizmo waited by the door "
+    "we should book the flight to Seattle before Friday because the conference starts Monday "
+    "remember to pick up groceries and call the vet about the appointment on Thursday afternoon "
+    "um yeah I don't think it's a well-known issue but we'll see"
+).split()
+
+UID = 'bench-word-cloud'
+
+def seed_days(day_sizes, seed):
+    """One day per size, each with that many segments. Returns {size: local_date}."""
+    rng = random.Random(seed)
+    user = User("bench_word_cloud", uid=UID)
+    db.session.add(user)
+    days = {}
+    first_day = date(2024, 1, 1)
+
+    for index, size in enumerate(day_sizes):
+        local_date = first_day + timedelta(days=index)
+        start = datetime.combine(local_date, datetime.min.time())
+        main_entry = Main(uid=UID, session_id=f"bench-word-cloud-{index}", timestamp=start,
+                          host='127.0.0.1', raw_data={})
+        db.session.add(main_entry)
+        db.session.flush()
+
+        for offset in range(0, size, 5000):
+            db.session.execute(db.insert(Segment), [{
+                'main_id': main_entry.id,
+                'text': " ".join(rng.choices(WORDS, k=rng.randint(6, 30))).capitalize() + ".",
+                'speaker': f"SPEAKER_{rng.randint(0, 2)}",
+                'speaker_id': 0,
+                'is_user': False,
+                'timestamp': start + timedelta(seconds=rng.uniform(0, 86399)),
+                'local_date': local_date,
+                'local_hour': rng.randint(0, 23),
+            } for _ in range(min(5000, size - offset))])
+        days[size] = local_date
+
+    db.session.commit()
+    return days
+
+def day_filter(local_date):
+    return (Main.uid == UID, Segment.local_date == local_date)
+
+def streaming(local_date, tokenizer):
+    texts = db.session.execute(
+        db.select(Segment.text).join(Main).where(*day_filter(local_date)).execution_options(yield_per=1000)
+    ).scalars()
+    return word_frequencies(texts, tokenizer)
+
+def materialized(local_date, tokenizer):
+    """The pre-streaming implementation, kept here as the reference."""
+    segments = Segment.query.join(Main).filter(*day_filter(local_date)).all()
+    all_text = ' '.join([segment.text for segment in segments])
+    word_freq = Counter()
+    count_words(word_freq, all_text, tokenizer)
+    return word_freq
+
+MODES = {'streaming': streaming, 'materialized': materialized}
+
+def measure(mode, local_date, size, tokenizer):
+    db.session.expunge_all()
+    tracemalloc.start()
+    start = time.perf_counter()
+    word_freq = MODES[mode](local_date, tokenizer)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.session.rollback()
+    # What the tokenizer resolved to; 'nltk' falls back to str.split without the punkt data,
+    # so it is part of the run key and a baseline is only compared with the same tokenizer
+    tokenize = word_cloud_setup(tokenizer)[0].__name__
+    return {
+        'run': f"{mode}/{tokenizer}:{tokenize}/{size}",
+        'mode': mode,
+        'tokenizer': tokenizer,
+        'tokenize': tokenize,
+        'segments': size,
+        'distinct_words': len(word_freq),
+        'seconds': elapsed,
+        'segments_per_sec': size / elapsed if elapsed else None,
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--day-sizes', default="1000,10000,50000", help="Comma-separated segments per day")
+    parser.add_argument('--tokenizers', default="nltk,regex")
+    parser.add_argument('--modes', default="streaming,materialized")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.5, help="Allowed relative regression in throughput, which is noisy")
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)
+    day_sizes = [int(size) for size in args.day_sizes.split(',')]
+    tokenizers = args.tokenizers.split(',')
+    modes = args.modes.split(',')
+
+    app = create_bench_app(get_bench_database_url(args.database_url))
+    results = []
+    with app.app_context():
+        reset_database()
+        days = seed_days(day_sizes, args.seed)
+        for tokenizer in tokenizers:
+            # Load the tokenizer and stop words before measuring
+            word_cloud_setup(tokenizer)[0]("warm up")
+            for mode in modes:
+                for size in day_sizes:
+                    results.append(measure(mode, days[size], size, tokenizer))
+
+    print_table(results, ['mode', 'tokenizer', 'tokenize', 'segments', 'distinct_words', 'seconds', 'segments_per_sec', 'peak_kb'])
+
+    if args.save_baseline:
+        save_baseline('word_cloud', results)
+
+    if args.check_baseline:
+        baseline = load_baseline('word_cloud')
+        if baseline is None:
+            print("No baseline stored; run with --save-baseline first")
+            return 1
+        recorded = {row['run'] for row in baseline}
+        for run in sorted({row['run'] for row in results} - recorded):
+            print(f"No baseline for {run}; run with --save-baseline to record it")
+        regressions = compare_to_baseline(results, baseline, 'run', {
+            'segments_per_sec': ('higher', args.tolerance),
+            'peak_kb': ('lower', 0.2),
+        })
+        if regressions:
+            print("Regressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+"""
+Load generator for the /webhook ingest path.
+
+Replays synthetic device sessions against the Flask app in-process. It uses many
+uids, a variable number of segments per POST, and bursty arrival: short gaps
+inside a burst and long pauses between bursts. It reports throughput, latency
+percentiles, database round trips per request and connection-pool saturation.
+
+    BENCH_DATABASE_URL=postgresql://localhost/soundbrain_bench \\
+        python benchmarks/load_webhook.py --devices 50 --requests-per-device 40 --concurrency 8,32
+
+Pass --check-baseline to fail when results regress against
+benchmarks/baselines/webhook.json, and --save-baseline to update it.
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_utils import (QueryCounter, compare_to_baseline, get_bench_database_url, load_baseline, percentile,
+                         print_table, reset_database, save_baseline)
+from config import Config
+
+SENTENCES = [
+    "Can you send me the deck before the call tomorrow.",
+    "I think we should move the launch to next quarter.",
+    "Gizmo needs to go out again.",
+    "The customer asked about pricing for the enterprise tier.",
+    "Let's grab lunch after the standup.",
+    "Did Armaan finish his reading assignment.",
+    "The flight to Seattle leaves at seven in the morning.",
+    "We closed three deals this week and pipeline is up twelve percent.",
+]
+
+def import_app(database_url):
+    """Import the web app bound to the benchmark database."""
+    Config.SQLALCHEMY_DATABASE_URI = database_url
+    os.environ.setdefault('GOOGLE_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('GOOGLE_CLIENT_SECRET', 'benchmark')
+    # app.py writes client_secrets.json to the working directory on import
+    os.chdir(tempfile.mkdtemp(prefix='soundbrain-bench-'))
+    import app as app_module
+    # Keep the summarizer out of the measurement
+    app_module.scheduler.remove_all_jobs()
+    return app_module
+
+def build_sessions(devices, requests_per_device, max_segments, seed, duplicate_rate=0.0):
+    """Build each device's list of (delay_before_send, payload) pairs, with some posts retried."""
+    rng = random.Random(seed)
+    sessions = []
+    for device in range(devices):
+        uid = f"load-uid-{device}"
+        session_id = f"load-session-{device}"
+        requests = []
+        for index in range(requests_per_device):
+            # Bursts of back-to-back posts separated by longer pauses
+            in_burst = index % rng.randint(3, 8) != 0
+            delay = rng.uniform(0.0, 0.01) if in_burst else rng.uniform(0.05, 0.2)
+            segments = [{
+                'text': rng.choice(SENTENCES),
+                'speaker': f"SPEAKER_{rng.randint(0, 2)}",
+                'speaker_id': rng.randint(0, 2),
+                'is_user': rng.random() < 0.3,
+                'start_time': index * 5.0,
+                'end_time': index * 5.0 + rng.uniform(1, 5),
+            } for _ in range(rng.randint(1, max_segments))]
+            payload = {'session_id': session_id, 'segments': segments}
+            requests.append((delay, payload))
+            if duplicate_rate and rng.random() < duplicate_rate:
+                # A device retrying after a timeout sends the same payload again
+                requests.append((rng.uniform(0.0, 0.05), payload))
+        sessions.append((uid, requests))
+    return sessions
+
+class PoolSampler:
+    """Sample connection-pool checkouts in the background to measure saturation."""
+
+    def __init__(self, engine, interval=0.005):
+        self.pool = engine.pool
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def capacity(self):
+        size = self.pool.size() if hasattr(self.pool, 'size') else None
+        overflow = getattr(self.pool, '_max_overflow', 0)
+        return size + max(overflow, 0) if size is not None else None
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            if hasattr(self.pool, 'checkedout'):
+                self.samples.append(self.pool.checkedout())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+
+    def stats(self):
+        capacity = self.capacity()
+        if not self.samples:
+            return {'pool_capacity': capacity, 'pool_max_checked_out': None, 'pool_saturated_pct': None}
+        saturated = sum(1 for sample in self.samples if capacity and sample >= capacity)
+        return {
+            'pool_capacity': capacity,
+            'pool_max_checked_out': max(self.samples),
+            'pool_saturated_pct': 100.0 * saturated / len(self.samples),
+        }
+
+def run_once(app_module, counter, sessions, concurrency):
+    app = app_module.app
+    db = app_module.db
+
+    with app.app_context():
+        reset_database()
+        for uid, _ in sessions:
+            db.session.add(app_module.User(username=uid, uid=uid))
+        db.session.commit()
+        engine = db.engine
+
+    latencies = []
+    statuses = []
+    duplicates = []
+    lock = threading.Lock()
+
+    def replay(session):
+        uid, requests = session
+        client = app.test_client()
+        for delay, payload in requests:
+            time.sleep(delay)
+            start = time.perf_counter()
+            response = client.post(f"/webhook?uid={uid}", json=payload)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses.append(response.status_code)
+                if (response.get_json(silent=True) or {}).get('duplicate'):
+                    duplicates.append(elapsed)
+
+    counter.reset()
+    with PoolSampler(engine) as sampler:
+        run_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(replay, sessions))
+        elapsed = time.perf_counter() - run_start
+
+    total = len(latencies)
+    segments = sum(len(payload['segments']) for _, requests in sessions for _, payload in requests)
+    with app.app_context():
+        stored_segments = db.session.query(db.func.count(app_module.Segment.id)).scalar()
+    result = {
+        'concurrency': concurrency,
+        'requests': total,
+        'segments': segments,
+        'errors': sum(1 for status in statuses if status >= 400),
+        'duplicates': len(duplicates),
+        'stored_segments': stored_segments,
+        'seconds': elapsed,
+        'requests_per_sec': total / elapsed if elapsed else None,
+        'latency_p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'latency_p95_ms': percentile(latencies, 95) * 1000 if latencies else None,
+        'latency_p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+        'queries_per_request': counter.count / total if total else None,
+        'db_ms_per_request': counter.total_time * 1000 / total if total else None,
+    }
+    result.update(sampler.stats())
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url')
+    parser.add_argument('--devices', type=int, default=40, help="Number of distinct uids sending sessions")
+    parser.add_argument('--requests-per-device', type=int, default=25)
+    parser.add_argument('--max-segments', type=int, default=6, help="Upper bound of segments per POST")
+    parser.add_argument('--concurrency', default="8,32", help="Comma-separated numbers of concurrent devices")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help="Fraction of posts the device retries")
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed relative regression in throughput and p95")
+    parser.add_argument('--verbose', action='store_true', help="Keep the app's own logging")
+    args = parser.parse_args()
+
+    database_url = get_bench_database_url(args.database_url)
+    if not args.verbose:
+        logging.disable(logging.ERROR)
+    app_module = import_app(database_url)
+
+    with app_module.app.app_context():
+        counter = QueryCounter(app_module.db.engine)
+
+    sessions = build_sessions(args.devices, args.requests_per_device, args.max_segments, args.seed, args.duplicate_rate)
+    results = [run_once(app_module, counter, sessions, int(c)) for c in args.concurrency.split(',')]
+    print_table(results, ['concurrency', 'requests', 'segments', 'stored_segments', 'errors', 'duplicates',
+                          'requests_per_sec', 'latency_p50_ms',
+                          'latency_p95_ms', 'latency_p99_ms', 'queries_per_request', 'db_ms_per_request',
+                          'pool_capacity', 'pool_max_checked_out', 'pool_saturated_pct'])
+
+    if args.save_baseline:
+        save_baseline('webhook', results)
+
+    if args.check_baseline:
+        baseline = load_baseline('webhook')
+        if baseline is None:
+            print("No baseline stored; run with --save-baseline first")
+            return 1
+        regressions = compare_to_baseline(results, baseline, 'concurrency', {
+            'requests_per_sec': ('higher', args.tolerance),
+            'latency_p95_ms': ('lower', args.tolerance),
+            'queries_per_request': ('lower', 0.05),
+        })
+        if regressions:
+            print("Regressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against baseline")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,46 @@
+"""
+Keep CPU-bound request work from stalling the web process's eventlet hub.
+
+Under ASYNC_MODE=eventlet every request is a greenlet on one OS thread, and a
+greenlet only gives way when it waits on I/O. Tokenizing a large day or
+vectorizing a user's history would otherwise freeze webhook ingest, Socket.IO
+and every SSE stream until it finished.
+
+    offload(func, ...)   runs a pure computation on eventlet's native thread
+                         pool. It must not touch the database or a socket,
+                         whose green connections belong to the hub.
+    cooperative(items)   yields to the hub every COOPERATIVE_YIELD_EVERY items
+                         of a loop that has to stay on the hub, such as one
+                         reading a streamed query.
+
+Outside eventlet (threading mode, the worker and the CLIs) both are plain
+pass-throughs.
+"""
+import os
+from functools import lru_cache
+
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'threading')
+COOPERATIVE_YIELD_EVERY = 200
+
+@lru_cache(maxsize=None)
+def _green():
+    if ASYNC_MODE != 'eventlet':
+        return False
+    from eventlet import patcher
+    return patcher.is_monkey_patched('thread')
+
+def offload(func, *args, **kwargs):
+    if not _green():
+        return func(*args, **kwargs)
+    from eventlet import tpool
+    return tpool.execute(func, *args, **kwargs)
+
+def cooperative(items, every=COOPERATIVE_YIELD_EVERY):
+    if not _green():
+        yield from items
+        return
+    import eventlet
+    for index, item in enumerate(items, 1):
+        yield item
+        if index % every == 0:
+            eventlet.sleep(0)
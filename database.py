@@ -0,0 +1,157 @@
+"""
+Engine and session setup shared by the web app, the scheduler jobs and the CLIs.
+
+Each process calls init_database(app, role) in place of db.init_app(app). The role
+picks the pool settings:
+
+    web     request handlers; many short transactions, so a small pool with a
+            statement timeout that stops one slow query holding a connection
+    worker  summarizer, digests, archival, batch and schema CLIs; few long
+            transactions and no statement timeout by default
+
+The scheduler normally runs in worker.py under the worker role, but the web
+process runs it too when RUN_SCHEDULER is set (see jobs.py). So the web role
+gets a second engine with the worker settings, and, when REPLICA_DATABASE_URL is
+set, a read-only engine with the web settings for replica.py. worker_session()
+opens a session on the worker engine and worker_binding() points db.session at it for
+the rest of an app context; the scheduled jobs use both, which keeps a slow
+chunk or archival run off the request pool and its statement timeout. Under the
+worker role both simply use the default engine.
+
+Settings are read from DB_<SETTING> for the web role and DB_WORKER_<SETTING> for
+the worker role: POOL_SIZE, MAX_OVERFLOW, POOL_TIMEOUT, POOL_RECYCLE, POOL_PRE_PING
+and STATEMENT_TIMEOUT_MS (0 disables it).
+
+With DB_PGBOUNCER=true the app connects through PgBouncer in transaction pooling
+mode. PgBouncer does the pooling, so SQLAlchemy opens a connection per checkout
+(NullPool), and the statement timeout is set with SET LOCAL at the start of each
+transaction rather than as a startup option. psycopg2 does not use server-side
+prepared statements, so nothing else has to change.
+"""
+import logging
+import os
+from contextlib import contextmanager
+
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+ROLES = ('web', 'worker')
+
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'false').lower() == 'true'
+
+# Each summarizer thread can hold two connections at once: its chunk session and db.session
+SUMMARIZATION_CONCURRENCY = int(os.environ.get('SUMMARIZATION_CONCURRENCY', 1))
+
+POOL_DEFAULTS = {
+    'web': {
+        'POOL_SIZE': 5,
+        'MAX_OVERFLOW': 10,
+        'POOL_TIMEOUT': 10,
+        'POOL_RECYCLE': 1800,
+        'POOL_PRE_PING': True,
+        'STATEMENT_TIMEOUT_MS': 30000,
+    },
+    'worker': {
+        'POOL_SIZE': 2,
+        'MAX_OVERFLOW': 2 * SUMMARIZATION_CONCURRENCY + 1,
+        'POOL_TIMEOUT': 30,
+        'POOL_RECYCLE': 1800,
+        'POOL_PRE_PING': True,
+        'STATEMENT_TIMEOUT_MS': 0,
+    },
+}
+
+WORKER_BIND = 'worker'
+REPLICA_BIND = 'replica'
+
+def pool_setting(role, name):
+    default = POOL_DEFAULTS[role][name]
+    prefix = 'DB_' if role == 'web' else f"DB_{role.upper()}_"
+    value = os.environ.get(f"{prefix}{name}")
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() == 'true'
+    return int(value)
+
+def engine_options(role='web', pgbouncer=DB_PGBOUNCER, read_only=False):
+    """create_engine() keyword arguments for a role."""
+    if pgbouncer:
+        return {'poolclass': NullPool}
+
+    options = {
+        'pool_size': pool_setting(role, 'POOL_SIZE'),
+        'max_overflow': pool_setting(role, 'MAX_OVERFLOW'),
+        'pool_timeout': pool_setting(role, 'POOL_TIMEOUT'),
+        'pool_recycle': pool_setting(role, 'POOL_RECYCLE'),
+        'pool_pre_ping': pool_setting(role, 'POOL_PRE_PING'),
+    }
+    startup = []
+    statement_timeout = pool_setting(role, 'STATEMENT_TIMEOUT_MS')
+    if statement_timeout:
+        startup.append(f"-c statement_timeout={statement_timeout}")
+    if read_only:
+        # A replica refuses writes anyway; this makes a stand-in on the primary refuse them too
+        startup.append("-c default_transaction_read_only=on")
+    if startup:
+        options['connect_args'] = {'options': " ".join(startup)}
+    return options
+
+def _set_local_statement_timeout(engine, statement_timeout):
+    @event.listens_for(engine, 'begin')
+    def set_statement_timeout(conn):
+        # SET LOCAL ends with the transaction, so it never leaks to the next PgBouncer client
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(statement_timeout)}")
+
+def init_database(app, role='web'):
+    """Configure Flask-SQLAlchemy for a role and bind it to app."""
+    if role not in ROLES:
+        raise ValueError(f"Unknown database role: {role}")
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(role)
+    if role == 'web':
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds[WORKER_BIND] = {'url': app.config['SQLALCHEMY_DATABASE_URI'], **engine_options('worker')}
+        if app.config.get('REPLICA_DATABASE_URL'):
+            binds[REPLICA_BIND] = {'url': app.config['REPLICA_DATABASE_URL'], **engine_options('web', read_only=True)}
+        app.config['SQLALCHEMY_BINDS'] = binds
+    db.init_app(app)
+
+    if DB_PGBOUNCER:
+        with app.app_context():
+            timeouts = {None: pool_setting(role, 'STATEMENT_TIMEOUT_MS')}
+            if WORKER_BIND in db.engines:
+                timeouts[WORKER_BIND] = pool_setting('worker', 'STATEMENT_TIMEOUT_MS')
+            if REPLICA_BIND in db.engines:
+                timeouts[REPLICA_BIND] = pool_setting('web', 'STATEMENT_TIMEOUT_MS')
+            for bind_key, statement_timeout in timeouts.items():
+                if statement_timeout:
+                    _set_local_statement_timeout(db.engines[bind_key], statement_timeout)
+    logger.debug(f"Database initialised for the {role} role{' through PgBouncer' if DB_PGBOUNCER else ''}")
+
+def worker_engine():
+    """The engine for background work; the default engine outside the web process."""
+    return db.engines.get(WORKER_BIND, db.engine)
+
+_worker_sessions = sessionmaker()
+
+def worker_session():
+    """A new session on the worker engine. Use it as a context manager so it is always closed."""
+    return _worker_sessions(bind=worker_engine())
+
+@contextmanager
+def worker_binding():
+    """Send every db.session statement in the current app context to the worker engine."""
+    previous = g.get('session_bind')
+    if WORKER_BIND in db.engines:
+        g.session_bind = WORKER_BIND
+    try:
+        yield
+    finally:
+        g.session_bind = previous
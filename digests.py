@@ -0,0 +1,202 @@
+"""
+Hierarchical daily and weekly digests built from existing summaries.
+
+Summaries are the map outputs. Each reduce step reads only the level below it:
+the summaries of an hour make an hour digest, the hour digests of a day make a
+day digest, and the day digests of a week make a week digest. Every LLM call
+therefore sees at most a day's worth of hours or a week's worth of days, however
+much was recorded.
+
+Writing a summary marks its hour, day and week digests stale in the same
+transaction (see the summaries listener in models.py). build_stale_digests()
+then rebuilds only those rows, draining each level before starting the next.
+A child whose rebuild changes it marks its parent stale again, and a parent
+with stale children waits rather than being built from partial input. A
+rebuild whose inputs hash to the stored fingerprint skips the LLM, and a
+period with a single input is copied as-is.
+"""
+import hashlib
+import json
+import logging
+import os
+import traceback
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, digests, summaries, User, period_start, user_timezone
+from summarization import generate_digest
+
+logger = logging.getLogger(__name__)
+
+DIGEST_PERIODS = ('hour', 'day', 'week')
+# Level each period is reduced from, and how its inputs are labelled in the prompt
+CHILD_UNITS = {'hour': 'time', 'day': 'hour', 'week': 'day'}
+CHILD_PERIODS = {'day': 'hour', 'week': 'day'}
+PARENT_PERIODS = {'hour': 'day', 'day': 'week'}
+MAX_BULLETS_PER_SOURCE = 6
+DIGEST_MAX_INPUT_CHARS = int(os.environ.get('DIGEST_MAX_INPUT_CHARS', 12000))
+
+def period_end(period, start, tz):
+    if period == 'hour':
+        return start + timedelta(hours=1)
+    days = 7 if period == 'week' else 1
+    local = start.astimezone(tz)
+    return tz.localize(datetime(local.year, local.month, local.day) + timedelta(days=days))
+
+def source_fingerprint(sources):
+    payload = json.dumps([[source.id, source.headline, source.bullet_points] for source in sources], default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def load_sources(digest, tz):
+    end = period_end(digest.period, digest.period_start, tz)
+    if digest.period == 'hour':
+        return summaries.query.filter(
+            summaries.user_id == digest.user_id,
+            summaries.timestamp >= digest.period_start,
+            summaries.timestamp < end
+        ).order_by(summaries.timestamp.asc()).all()
+
+    return digests.query.filter(
+        digests.user_id == digest.user_id,
+        digests.period == CHILD_PERIODS[digest.period],
+        digests.period_start >= digest.period_start,
+        digests.period_start < end,
+        digests.headline.isnot(None)
+    ).order_by(digests.period_start.asc()).all()
+
+def source_label(digest, source, tz):
+    if digest.period == 'hour':
+        return source.timestamp.astimezone(tz).strftime('%H:%M')
+    if digest.period == 'day':
+        return source.period_start.astimezone(tz).strftime('%H:00')
+    return source.period_start.astimezone(tz).strftime('%A %Y-%m-%d')
+
+def format_sources(digest, sources, tz):
+    """Render the inputs as labelled headlines and bullets, capped at DIGEST_MAX_INPUT_CHARS."""
+    blocks = []
+    for source in sources:
+        bullets = "\n".join(f"  - {point}" for point in (source.bullet_points or [])[:MAX_BULLETS_PER_SOURCE])
+        blocks.append(f"[{source_label(digest, source, tz)}] {source.headline}\n{bullets}".rstrip())
+    text = "\n".join(blocks)
+    if len(text) > DIGEST_MAX_INPUT_CHARS:
+        logger.warning(f"Digest input for User {digest.user_id} {digest.period} {digest.period_start} "
+                       f"truncated from {len(text)} characters")
+        text = text[:DIGEST_MAX_INPUT_CHARS]
+    return text
+
+def has_stale_children(digest, tz):
+    if digest.period == 'hour':
+        return False
+    return db.session.query(digests.query.filter(
+        digests.user_id == digest.user_id,
+        digests.period == CHILD_PERIODS[digest.period],
+        digests.period_start >= digest.period_start,
+        digests.period_start < period_end(digest.period, digest.period_start, tz),
+        digests.stale.is_(True)
+    ).exists()).scalar()
+
+def mark_parent_stale(digest, tz):
+    """Queue the day or week containing digest; its inputs just changed."""
+    parent = PARENT_PERIODS.get(digest.period)
+    if parent is None:
+        return
+    db.session.execute(
+        insert(digests).values(user_id=digest.user_id, period=parent, stale=True, source_count=0,
+                               period_start=period_start(parent, digest.period_start, tz))
+        .on_conflict_do_update(constraint='uq_digests_user_period', set_={'stale': True})
+    )
+
+def rebuild_digest(digest, tz, user_name):
+    # A parent built while some of its children are stale would miss their input
+    if has_stale_children(digest, tz):
+        return "waiting"
+
+    # Clear the flag before the slow part so a summary written meanwhile marks it stale again
+    digest.stale = False
+    db.session.commit()
+
+    try:
+        sources = load_sources(digest, tz)
+        if not sources:
+            mark_parent_stale(digest, tz)
+            db.session.delete(digest)
+            db.session.commit()
+            return "deleted"
+
+        fingerprint = source_fingerprint(sources)
+        if fingerprint == digest.source_fingerprint and digest.headline:
+            return "unchanged"
+
+        if len(sources) == 1:
+            headline, bullet_points = sources[0].headline, list(sources[0].bullet_points or [])
+        else:
+            result = generate_digest(format_sources(digest, sources, tz), digest.period,
+                                     CHILD_UNITS[digest.period], user_name)
+            headline, bullet_points = result.headline, result.bullet_points
+
+        digest.headline = headline
+        digest.bullet_points = bullet_points
+        digest.source_count = len(sources)
+        digest.source_fingerprint = fingerprint
+        digest.updated_at = datetime.now(pytz.UTC)
+        mark_parent_stale(digest, tz)
+        db.session.commit()
+        return "rebuilt"
+    except Exception:
+        db.session.rollback()
+        digest.stale = True
+        db.session.commit()
+        raise
+
+def build_stale_digests(batch_size=200):
+    """Rebuild stale hour, then day, then week digests, draining each level before the next reads it."""
+    logger.info("Starting digest build")
+    users = {}
+    results = {}
+
+    for period in DIGEST_PERIODS:
+        # Walk the level by id so rows that fail and stay stale are not retried until the next run
+        last_id = 0
+        while True:
+            stale_digests = digests.query.filter(
+                digests.stale.is_(True),
+                digests.period == period,
+                digests.id > last_id
+            ).order_by(digests.id.asc()).limit(batch_size).all()
+            if not stale_digests:
+                break
+
+            for digest in stale_digests:
+                last_id = digest.id
+                if digest.user_id not in users:
+                    user = db.session.get(User, digest.user_id)
+                    users[digest.user_id] = (user_timezone(user.timezone if user else None),
+                                             (user.first_name or user.username) if user else "the user")
+                tz, user_name = users[digest.user_id]
+                try:
+                    status = rebuild_digest(digest, tz, user_name)
+                except Exception as e:
+                    logger.error(f"Error building {period} digest {digest.id} for User {digest.user_id}: {str(e)}")
+                    logger.error(traceback.format_exc())
+                    status = "error"
+                results[status] = results.get(status, 0) + 1
+
+    logger.info(f"Finished digest build: {results}")
+    return results
+
+def get_digest(user, period, date):
+    """Return (period_start, digest, sections) for the day or week containing date; sections are the level below."""
+    tz = user_timezone(user.timezone)
+    start = period_start(period, tz.localize(datetime(date.year, date.month, date.day)), tz)
+    digest = digests.query.filter_by(user_id=user.id, period=period, period_start=start).first()
+
+    sections = digests.query.filter(
+        digests.user_id == user.id,
+        digests.period == CHILD_PERIODS[period],
+        digests.period_start >= start,
+        digests.period_start < period_end(period, start, tz),
+        digests.headline.isnot(None)
+    ).order_by(digests.period_start.asc()).all()
+    return start, digest, sections
@@ -0,0 +1,149 @@
+"""
+Bulk export of a user's segments and summaries as NDJSON or CSV.
+
+Rows are read through a server-side cursor (yield_per) and encoded into
+chunks of about EXPORT_CHUNK_BYTES. Those chunks are sent as a chunked HTTP
+response and, if requested, gzip-compressed as they are produced. Memory stays
+flat however long the range is. Archived days (see archive.py) are read one day
+at a time, ahead of the live rows.
+"""
+import csv
+import io
+import json
+import logging
+import zlib
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import select
+
+from archive import read_archived_segments
+from cooperative import offload
+from models import db, Main, Segment, summaries
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_INCLUDES = ('all', 'segments', 'summaries')
+
+SEGMENT_EXPORT_FIELDS = ('id', 'main_id', 'timestamp', 'speaker', 'speaker_id', 'is_user', 'start_time', 'end_time',
+                         'text', 'summary_id')
+SUMMARY_EXPORT_FIELDS = ('id', 'timestamp', 'tag', 'headline', 'bullet_points', 'fact_checker')
+
+def _utc_isoformat(timestamp):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=pytz.UTC)
+    return timestamp.astimezone(pytz.UTC).isoformat()
+
+def segment_records(user, start, end):
+    """
+    Segments with start <= timestamp < end: archived days first, then live rows in timestamp order.
+    An archived segment that is also live is left to the live rows, as in merge_with_live.
+    """
+    day = start
+    while day < end:
+        day_end = min(day + timedelta(days=1), end)
+        archived = read_archived_segments(user.id, day, day_end)
+        if archived:
+            live_ids = set(db.session.execute(select(Segment.id).join(Main).where(
+                Main.uid == user.uid,
+                Segment.id.in_([row['id'] for row in archived])
+            )).scalars())
+            for row in archived:
+                if row['id'] not in live_ids:
+                    yield {field: row[field] for field in SEGMENT_EXPORT_FIELDS}
+        day = day_end
+
+    stmt = select(*(getattr(Segment, field) for field in SEGMENT_EXPORT_FIELDS)).join(Main).where(
+        Main.uid == user.uid,
+        Segment.timestamp >= start,
+        Segment.timestamp < end
+    ).order_by(Segment.timestamp.asc(), Segment.id.asc()).execution_options(yield_per=EXPORT_BATCH_SIZE)
+    for row in db.session.execute(stmt):
+        record = dict(row._mapping)
+        record['timestamp'] = _utc_isoformat(record['timestamp'])
+        yield record
+
+def summary_records(user, start, end):
+    stmt = select(*(getattr(summaries, field) for field in SUMMARY_EXPORT_FIELDS)).where(
+        summaries.user_id == user.id,
+        summaries.timestamp >= start,
+        summaries.timestamp < end
+    ).order_by(summaries.timestamp.asc(), summaries.id.asc()).execution_options(yield_per=EXPORT_BATCH_SIZE)
+    for row in db.session.execute(stmt):
+        record = dict(row._mapping)
+        record['timestamp'] = _utc_isoformat(record['timestamp'])
+        yield record
+
+def ndjson_chunks(sources):
+    """sources: [(record_type, records)]; each line carries its type so one file can hold both."""
+    buffer = []
+    size = 0
+    for record_type, records in sources:
+        for record in records:
+            line = json.dumps({'type': record_type, **record}, ensure_ascii=False, default=str) + "\n"
+            buffer.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_BYTES:
+                yield "".join(buffer).encode('utf-8')
+                buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode('utf-8')
+
+def csv_chunks(records, fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for record in records:
+        writer.writerow([
+            "\n".join(value) if isinstance(value, list) else value
+            for value in (record[field] for field in fields)
+        ])
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for chunk in chunks:
+        compressed = offload(compressor.compress, chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def export_stream(user, start, end, export_format='ndjson', include='all', compress=False):
+    """Byte chunks of the export of user's data with start <= timestamp < end."""
+    if export_format == 'csv':
+        if include == 'segments':
+            chunks = csv_chunks(segment_records(user, start, end), SEGMENT_EXPORT_FIELDS)
+        else:
+            chunks = csv_chunks(summary_records(user, start, end), SUMMARY_EXPORT_FIELDS)
+    else:
+        sources = []
+        if include in ('all', 'segments'):
+            sources.append(('segment', segment_records(user, start, end)))
+        if include in ('all', 'summaries'):
+            sources.append(('summary', summary_records(user, start, end)))
+        chunks = ndjson_chunks(sources)
+
+    if compress:
+        chunks = gzip_chunks(chunks)
+
+    started = datetime.now()
+    sent = 0
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    except Exception as e:
+        # Headers are already sent, so the client sees a truncated body rather than an error status
+        logger.error(f"Error exporting data for User {user.id}: {str(e)}")
+        raise
+    logger.info(f"Exported {sent} bytes of {include} as {export_format} for User {user.id} "
+                f"in {(datetime.now() - started).total_seconds():.1f}s")
@@ -0,0 +1,189 @@
+"""
+Fair scheduling of summarization chunks across users.
+
+summarization_task used to take users in id order and drain each backlog before
+moving on. A user who uploaded a day of audio held up everyone else's
+near-real-time summaries until the whole upload was done. FairScheduler hands
+out one chunk at a time instead:
+
+    - Users whose next chunk is less than SUMMARIZATION_FRESH_MINUTES old are
+      in the 'fresh' lane and are always served before users in the
+      'backfill' lane.
+    - Within a lane, users are served by deficit round-robin. Each pass a user
+      earns its weight in credit and spends one credit per chunk. Weights come
+      from SUMMARIZATION_USER_WEIGHTS ("user_id:weight,..."), default 1, and
+      may be fractional.
+    - A user gets at most SUMMARIZATION_USER_CHUNK_QUOTA chunks per run
+      (0 means no limit). The rest waits for the next run.
+    - A user has at most one chunk in flight, so each backlog is still
+      summarized oldest first.
+
+Segments that arrive during a run are picked up by a rescan every
+SUMMARIZATION_RESCAN_SECONDS, so a long backfill doesn't hold fresh data until
+the next run. Per-user lag is the age of the oldest unsummarized segment. It is
+exported as summarization_user_lag_seconds and logged at the end of each run.
+"""
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import func
+
+from instrumentation import user_chunks, user_lag_seconds
+from models import temp_segments
+
+logger = logging.getLogger(__name__)
+
+SUMMARIZATION_FRESH_MINUTES = int(os.environ.get('SUMMARIZATION_FRESH_MINUTES', 30))
+SUMMARIZATION_USER_CHUNK_QUOTA = int(os.environ.get('SUMMARIZATION_USER_CHUNK_QUOTA', 0))
+SUMMARIZATION_RESCAN_SECONDS = int(os.environ.get('SUMMARIZATION_RESCAN_SECONDS', 60))
+
+LANES = ('fresh', 'backfill')
+
+def parse_weights(value):
+    """"12:2,7:0.5" -> {12: 2.0, 7: 0.5}; malformed or non-positive entries are ignored."""
+    weights = {}
+    for item in (value or '').split(','):
+        user_id, _, weight = item.strip().partition(':')
+        try:
+            user_id, weight = int(user_id), float(weight)
+        except ValueError:
+            continue
+        if weight > 0:
+            weights[user_id] = weight
+    return weights
+
+SUMMARIZATION_USER_WEIGHTS = parse_weights(os.environ.get('SUMMARIZATION_USER_WEIGHTS'))
+
+def _aware(timestamp):
+    return pytz.UTC.localize(timestamp) if timestamp.tzinfo is None else timestamp
+
+def pending_backlogs(session, since=None):
+    """{user_id: (oldest unsummarized timestamp, pending segments)}, optionally only for segments created since."""
+    query = session.query(temp_segments.user_id, func.min(temp_segments.timestamp), func.count()).filter(
+        temp_segments.processed_at.is_(None)
+    )
+    if since is not None:
+        query = query.filter(temp_segments.created_at >= since)
+    return {user_id: (_aware(oldest), count) for user_id, oldest, count in query.group_by(temp_segments.user_id)}
+
+class UserBacklog:
+    def __init__(self, user_id, next_start, weight):
+        self.user_id = user_id
+        self.next_start = next_start
+        self.weight = weight
+        self.deficit = 0.0
+        self.chunks = 0
+        self.busy = False
+        # Where the user's last chunk ended; new segments from before it wait for the next run
+        self.resume_after = None
+
+class FairScheduler:
+    def __init__(self, fresh_minutes=SUMMARIZATION_FRESH_MINUTES, quota=SUMMARIZATION_USER_CHUNK_QUOTA,
+                 weights=None, rescan_seconds=SUMMARIZATION_RESCAN_SECONDS):
+        self.fresh_window = timedelta(minutes=fresh_minutes)
+        self.quota = quota
+        self.weights = SUMMARIZATION_USER_WEIGHTS if weights is None else weights
+        self.rescan_seconds = rescan_seconds
+        self.backlogs = {}
+        self.ring = []
+        # Deficit round-robin state per lane: ring position, and whether the user there got this visit's credit
+        self.position = {lane: 0 for lane in LANES}
+        self.credited = {lane: False for lane in LANES}
+        self.last_scan = None
+        self.last_scan_clock = None
+        self.initial_pending = {}
+
+    def scan(self, session):
+        """Add users with pending segments; after the first scan only segments created since the last one."""
+        now = datetime.now(pytz.UTC)
+        # Rows become visible at commit but carry their transaction's start time, so look back a little
+        since = self.last_scan - timedelta(seconds=self.rescan_seconds) if self.last_scan else None
+        pending = pending_backlogs(session, since)
+        if since is None:
+            self.initial_pending = pending
+            report_lag(pending, now)
+        self.last_scan = now
+        self.last_scan_clock = time.monotonic()
+
+        for user_id, (oldest, _) in pending.items():
+            backlog = self.backlogs.get(user_id)
+            if backlog is None:
+                self.backlogs[user_id] = UserBacklog(user_id, oldest, self.weights.get(user_id, 1.0))
+                self.ring.append(user_id)
+            elif (backlog.next_start is None and not backlog.busy
+                  and (backlog.resume_after is None or oldest >= backlog.resume_after)):
+                # New segments for a user who had caught up; earlier leftovers wait for the next run
+                backlog.next_start = oldest
+        return len(pending)
+
+    def rescan_due(self):
+        return self.last_scan_clock is not None and time.monotonic() - self.last_scan_clock >= self.rescan_seconds
+
+    def lane(self, backlog, now):
+        return 'fresh' if backlog.next_start >= now - self.fresh_window else 'backfill'
+
+    def _ready(self, backlog, lane, now):
+        return (backlog.next_start is not None and not backlog.busy
+                and (not self.quota or backlog.chunks < self.quota)
+                and self.lane(backlog, now) == lane)
+
+    def next_chunk(self):
+        """(user_id, chunk start, lane) of the next chunk to summarize, or None when nothing is ready."""
+        now = datetime.now(pytz.UTC)
+        for lane in LANES:
+            if not any(self._ready(backlog, lane, now) for backlog in self.backlogs.values()):
+                continue
+            # Each full pass credits every ready user its weight, so this ends within 1 / min(weight) passes
+            while True:
+                backlog = self.backlogs[self.ring[self.position[lane] % len(self.ring)]]
+                if self._ready(backlog, lane, now):
+                    if not self.credited[lane]:
+                        backlog.deficit += backlog.weight
+                        self.credited[lane] = True
+                    if backlog.deficit >= 1:
+                        backlog.deficit -= 1
+                        backlog.busy = True
+                        backlog.chunks += 1
+                        user_chunks.inc(user_id=backlog.user_id, lane=lane)
+                        return backlog.user_id, backlog.next_start, lane
+                self.position[lane] += 1
+                self.credited[lane] = False
+        return None
+
+    def complete(self, user_id, next_start, chunk_end=None):
+        """Record a finished chunk; next_start is None once the user has nothing more to summarize this run."""
+        backlog = self.backlogs[user_id]
+        backlog.busy = False
+        backlog.next_start = next_start
+        if chunk_end is not None:
+            backlog.resume_after = _aware(chunk_end)
+        if next_start is None:
+            backlog.deficit = 0.0
+
+    def log_run(self, session):
+        """Report each user's lag after the run, from a fresh look at what is still pending."""
+        now = datetime.now(pytz.UTC)
+        pending = pending_backlogs(session)
+        report_lag(pending, now)
+        for user_id in self.ring:
+            backlog = self.backlogs[user_id]
+            before = self.initial_pending.get(user_id)
+            after = pending.get(user_id)
+            logger.info(f"Summarized {backlog.chunks} chunks for User {user_id} (weight {backlog.weight:g}); lag "
+                        f"{(now - before[0]).total_seconds() if before else 0:.0f}s -> "
+                        f"{(now - after[0]).total_seconds() if after else 0:.0f}s")
+
+# Users with a nonzero lag on the last report, so the gauge drops to zero once they catch up
+_lagging_users = set()
+
+def report_lag(pending, now=None):
+    now = now or datetime.now(pytz.UTC)
+    for user_id in _lagging_users - set(pending):
+        user_lag_seconds.set(0, user_id=user_id)
+    for user_id, (oldest, _) in pending.items():
+        user_lag_seconds.set(round((now - oldest).total_seconds(), 1), user_id=user_id)
+    _lagging_users.clear()
+    _lagging_users.update(pending)
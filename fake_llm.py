@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Iterator, List, Optional
+
+from langchain.chat_models.base import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+class FakeLLMError(Exception):
+    """Raised by FakeChatModel to simulate a provider failure."""
+
+class FakeRateLimitError(FakeLLMError):
+    """Raised by FakeChatModel to simulate a 429, shaped like the provider SDKs' RateLimitError."""
+
+    status_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__("Simulated rate limit")
+        self.headers = {'retry-after': str(retry_after)}
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic offline stand-in for the summary and fact-check models.
+
+    Responses are built from the conversation fragments in the prompt, so the same
+    input always produces the same summary. Latency and failures are drawn from a
+    generator seeded with the fragments and how many times they have been sent, so
+    benchmark runs are repeatable and a retried chunk can succeed after a failure.
+    """
+
+    latency_ms: float = 0.0
+    latency_jitter_ms: float = 0.0
+    slow_rate: float = 0.0
+    slow_latency_ms: float = 0.0
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    rate_limit_retry_after: float = 1.0
+    stream_chunk_size: int = 16
+    seed: int = 0
+
+    _attempts: Counter = PrivateAttr(default_factory=Counter)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _prompt_text(self, messages: List[BaseMessage]) -> str:
+        return "\n".join(str(message.content) for message in messages)
+
+    def _fragments(self, prompt: str) -> str:
+        match = re.search(r"<(conversation_fragments|summaries)>\s*(.*?)\s*</\1>", prompt, re.S)
+        return match.group(2) if match else prompt
+
+    def _is_fact_check(self, prompt: str) -> bool:
+        return '"fact_checks"' in prompt
+
+    def _rng(self, prompt: str) -> random.Random:
+        # Key on the fragments rather than the whole prompt, which embeds the current time
+        kind = 'fact_check' if self._is_fact_check(prompt) else 'summary'
+        key = f"{kind}:{self._fragments(prompt)}"
+        with self._lock:
+            attempt = self._attempts[key]
+            self._attempts[key] += 1
+        digest = hashlib.sha256(f"{self.seed}:{attempt}:{key}".encode('utf-8')).hexdigest()
+        return random.Random(int(digest[:16], 16))
+
+    def _simulate_call(self, prompt: str) -> None:
+        rng = self._rng(prompt)
+        latency = self.latency_ms + rng.uniform(-self.latency_jitter_ms, self.latency_jitter_ms)
+        if self.slow_rate and rng.random() < self.slow_rate:
+            latency = self.slow_latency_ms
+        if latency > 0:
+            time.sleep(latency / 1000.0)
+        if self.error_rate and rng.random() < self.error_rate:
+            raise FakeLLMError("Simulated provider error")
+        if self.rate_limit_rate and rng.random() < self.rate_limit_rate:
+            raise FakeRateLimitError(self.rate_limit_retry_after)
+
+    def _respond(self, prompt: str) -> str:
+        fragments = self._fragments(prompt)
+
+        if self._is_fact_check(prompt):
+            return "```json\n" + json.dumps({"fact_checks": []}) + "\n```"
+
+        words = fragments.split()
+        if len(words) < 8:
+            return "```json\n" + json.dumps({"headline": "INSUFFICIENT_CONTEXT", "bullet_points": [], "tag": None}) + "\n```"
+
+        sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+", fragments) if s.strip()]
+        headline = " ".join(word.capitalize() for word in words[:6])
+        return "```json\n" + json.dumps({
+            "headline": f"📝 {headline}",
+            "bullet_points": sentences[:5],
+            "tag": "other",
+        }, ensure_ascii=False) + "\n```"
+
+    def _usage(self, prompt: str, response: str) -> dict:
+        # Roughly four characters per token, the usual rule of thumb for English text
+        input_tokens = max(1, len(prompt) // 4)
+        output_tokens = max(1, len(response) // 4)
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        prompt = self._prompt_text(messages)
+        self._simulate_call(prompt)
+        response = self._respond(prompt)
+        message = AIMessage(content=response, usage_metadata=self._usage(prompt, response))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        prompt = self._prompt_text(messages)
+        self._simulate_call(prompt)
+        response = self._respond(prompt)
+        for start in range(0, len(response), self.stream_chunk_size):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=response[start:start + self.stream_chunk_size]))
+
+_fake_llm = None
+
+def get_fake_llm() -> FakeChatModel:
+    """
+    Return the shared fake model, configured from FAKE_LLM_* environment variables.
+
+    A single instance is reused so retry counts, and therefore injected failures,
+    stay deterministic across calls.
+    """
+    global _fake_llm
+    if _fake_llm is None:
+        _fake_llm = FakeChatModel(
+            latency_ms=float(os.environ.get('FAKE_LLM_LATENCY_MS', 0)),
+            latency_jitter_ms=float(os.environ.get('FAKE_LLM_LATENCY_JITTER_MS', 0)),
+            slow_rate=float(os.environ.get('FAKE_LLM_SLOW_RATE', 0)),
+            slow_latency_ms=float(os.environ.get('FAKE_LLM_SLOW_LATENCY_MS', 0)),
+            error_rate=float(os.environ.get('FAKE_LLM_ERROR_RATE', 0)),
+            rate_limit_rate=float(os.environ.get('FAKE_LLM_RATE_LIMIT_RATE', 0)),
+            rate_limit_retry_after=float(os.environ.get('FAKE_LLM_RATE_LIMIT_RETRY_AFTER', 1)),
+            seed=int(os.environ.get('FAKE_LLM_SEED', 0)),
+        )
+    return _fake_llm
+
+def configure_fake_llm(**settings) -> FakeChatModel:
+    """Replace the shared fake model, e.g. to switch latency profiles between benchmark runs."""
+    global _fake_llm
+    _fake_llm = FakeChatModel(**settings)
+    return _fake_llm
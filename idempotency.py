@@ -0,0 +1,121 @@
+"""
+Idempotent /webhook ingest.
+
+Device apps retry POSTs that time out, and each retry used to be stored again as
+a new Main row, new segments and new temp_segments. Every delivery now gets an
+idempotency key. The key is the client's Idempotency-Key header if one is sent,
+otherwise a hash of the uid, session and segment content.
+
+The webhook_receipts table has a unique index on the key, and the receipt is
+inserted with ON CONFLICT DO NOTHING as the first write of the ingest
+transaction. That insert is the authoritative check, and it holds across
+workers and restarts. In front of it, a rotating in-memory bloom filter of
+recently seen keys lets the common retry be recognised before any write. A
+bloom hit is confirmed with a single index lookup, because bloom filters can
+give false positives. A miss means the key is certainly new to this process.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, webhook_receipts
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_BLOOM_CAPACITY = int(os.environ.get('WEBHOOK_BLOOM_CAPACITY', 100000))
+WEBHOOK_RECEIPT_TTL_DAYS = int(os.environ.get('WEBHOOK_RECEIPT_TTL_DAYS', 7))
+
+class RecentKeyFilter:
+    """
+    Bloom filter over recently seen hex digests, in two generations.
+
+    When the current generation has taken `capacity` keys it becomes the previous
+    one and a fresh generation starts. Lookups check both, so at least the last
+    `capacity` keys are always covered, and memory stays fixed.
+    """
+
+    def __init__(self, capacity=WEBHOOK_BLOOM_CAPACITY, false_positive_rate=0.01):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.current = bytearray((self.size + 7) // 8)
+        self.previous = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def _positions(self, key):
+        # Keys are already sha256 hex digests; double hashing derives the k positions
+        digest = int(key[:32], 16)
+        first, second = digest >> 64, (digest & ((1 << 64) - 1)) | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    @staticmethod
+    def _contains(bits, positions):
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+    def might_contain(self, key):
+        positions = self._positions(key)
+        with self.lock:
+            return self._contains(self.current, positions) or self._contains(self.previous, positions)
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self.lock:
+            if self.count >= self.capacity:
+                self.previous = self.current
+                self.current = bytearray((self.size + 7) // 8)
+                self.count = 0
+            for position in positions:
+                self.current[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+recent_keys = RecentKeyFilter()
+
+def delivery_key(uid, session_id, segments, client_key=None):
+    """Idempotency key for one webhook delivery."""
+    if client_key:
+        material = f"client\x00{uid}\x00{client_key}"
+    else:
+        content = [[segment.get('speaker'), segment.get('text'), segment.get('start_time'), segment.get('end_time')]
+                   for segment in segments]
+        material = f"content\x00{uid}\x00{session_id}\x00{json.dumps(content, sort_keys=True, default=str)}"
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def seen_recently(key):
+    """True if this key was already ingested. Runs no query unless the bloom filter has a hit."""
+    if not recent_keys.might_contain(key):
+        return False
+    return db.session.query(webhook_receipts.id).filter_by(idempotency_key=key).first() is not None
+
+def claim_delivery(key, uid, session_id):
+    """
+    Insert the receipt for this delivery in the current transaction.
+
+    Returns the receipt id, or None if another request already claimed the key. Once the
+    transaction commits, the key is added to the bloom filter with record_delivery().
+    """
+    return db.session.execute(
+        insert(webhook_receipts).values(
+            idempotency_key=key, uid=uid, session_id=session_id, created_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=['idempotency_key']).returning(webhook_receipts.id)
+    ).scalar()
+
+def record_delivery(key):
+    recent_keys.add(key)
+
+def prune_webhook_receipts(ttl_days=WEBHOOK_RECEIPT_TTL_DAYS):
+    """Delete receipts older than the retry window; devices don't retry for days."""
+    cutoff = datetime.utcnow() - timedelta(days=ttl_days)
+    try:
+        deleted = webhook_receipts.query.filter(webhook_receipts.created_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        logger.info(f"Pruned {deleted} webhook receipts older than {ttl_days} days")
+    except Exception as e:
+        logger.error(f"Error pruning webhook receipts: {str(e)}")
+        db.session.rollback()
@@ -0,0 +1,297 @@
+"""
+In-process metrics for requests, database queries, background jobs and LLM calls.
+
+Metrics are kept per process and exposed in Prometheus text format on /metrics and as
+JSON on /admin/metrics. SQLAlchemy cursor events count every statement. Flask request
+hooks and span() blocks additionally attribute queries to the request or job step
+running on the current thread.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from langchain_core.callbacks import BaseCallbackHandler
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(zip(self.labelnames, key)), 'value': value} for key, value in sorted(self.values.items())]
+
+class Gauge:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labelnames)
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(zip(self.labelnames, key)), 'value': value} for key, value in sorted(self.values.items())]
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labelnames)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames + ('le',), key + (str(bound),))} {cumulative}")
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames + ('le',), key + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return [{
+                'labels': dict(zip(self.labelnames, key)),
+                'count': count,
+                'sum': round(total, 6),
+                'avg': round(total / count, 6) if count else None,
+            } for key, (counts, total, count) in sorted(self.values.items())]
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+REGISTRY = []
+
+def counter(name, help_text, labelnames=()):
+    metric = Counter(name, help_text, labelnames)
+    REGISTRY.append(metric)
+    return metric
+
+def gauge(name, help_text, labelnames=()):
+    metric = Gauge(name, help_text, labelnames)
+    REGISTRY.append(metric)
+    return metric
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, help_text, labelnames, buckets)
+    REGISTRY.append(metric)
+    return metric
+
+http_requests = counter('http_requests_total', "HTTP requests handled", ('endpoint', 'method', 'status'))
+http_request_seconds = histogram('http_request_duration_seconds', "HTTP request latency", ('endpoint', 'method'))
+http_request_queries = histogram('http_request_db_queries', "Database queries per HTTP request", ('endpoint',), COUNT_BUCKETS)
+db_queries = counter('db_queries_total', "Database statements executed")
+db_query_seconds = histogram('db_query_duration_seconds', "Database statement latency")
+span_seconds = histogram('span_duration_seconds', "Duration of instrumented job steps", ('span', 'outcome'))
+span_queries = histogram('span_db_queries', "Database queries per instrumented job step", ('span',), COUNT_BUCKETS)
+job_runs = counter('scheduler_job_runs_total', "Background job runs", ('job', 'outcome'))
+job_seconds = histogram('scheduler_job_duration_seconds', "Background job duration", ('job',))
+chunk_segments = histogram('summarization_chunk_segments', "Segments per summarization chunk", (), COUNT_BUCKETS)
+chunk_chars = histogram('summarization_chunk_chars', "Characters of transcript per summarization chunk", (), SIZE_BUCKETS)
+chunk_tokens = histogram('summarization_chunk_tokens', "Estimated transcript tokens per chunk before and after compaction", ('stage',), SIZE_BUCKETS)
+chunk_reduction = histogram('summarization_chunk_reduction_ratio', "Fraction of transcript tokens removed by compaction", (), RATIO_BUCKETS)
+chunks_processed = counter('summarization_chunks_total', "Summarization chunks processed", ('status',))
+user_chunks = counter('summarization_user_chunks_total', "Summarization chunks scheduled per user", ('user_id', 'lane'))
+user_lag_seconds = gauge('summarization_user_lag_seconds', "Age of each user's oldest unsummarized segment at the last scheduler scan", ('user_id',))
+llm_request_seconds = histogram('llm_request_duration_seconds', "LLM request latency", ('provider', 'outcome'))
+llm_tokens = counter('llm_tokens_total', "LLM tokens used", ('provider', 'purpose', 'kind'))
+llm_rate_limited = counter('llm_rate_limited_total', "LLM calls refused for rate limits, by the provider (429) or the client-side limiter", ('limiter', 'source'))
+llm_concurrency_limit = gauge('llm_concurrency_limit', "Current AIMD limit on concurrent LLM calls", ('limiter',))
+read_routes = counter('db_read_routes_total', "Replica-eligible requests by the database they read from", ('target', 'reason'))
+
+# Statement timing and per-scope query counting for whatever runs on the current thread
+_local = threading.local()
+
+def _scopes():
+    if not hasattr(_local, 'scopes'):
+        _local.scopes = []
+    return _local.scopes
+
+def _remove_scope(scope):
+    scopes = _scopes()
+    for index, existing in enumerate(scopes):
+        if existing is scope:
+            del scopes[index]
+            return
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _local.query_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - getattr(_local, 'query_start', time.perf_counter())
+    db_queries.inc()
+    db_query_seconds.observe(elapsed)
+    for scope in _scopes():
+        scope['queries'] += 1
+        scope['query_seconds'] += elapsed
+
+@contextmanager
+def query_scope():
+    """Count the queries issued on this thread while the block runs."""
+    scope = {'queries': 0, 'query_seconds': 0.0}
+    _scopes().append(scope)
+    try:
+        yield scope
+    finally:
+        _remove_scope(scope)
+
+@contextmanager
+def span(name):
+    """Time a job step and count its queries, e.g. `with span('summarize.llm'):`."""
+    start = time.perf_counter()
+    outcome = 'ok'
+    with query_scope() as scope:
+        try:
+            yield scope
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            span_seconds.observe(time.perf_counter() - start, span=name, outcome=outcome)
+            span_queries.observe(scope['queries'], span=name)
+
+# Last run of each scheduler job, for /scheduler_status
+job_last_runs = {}
+
+@contextmanager
+def job_run(job_id):
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        with query_scope() as scope:
+            yield scope
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        job_runs.inc(job=job_id, outcome=outcome)
+        job_seconds.observe(duration, job=job_id)
+        job_last_runs[job_id] = {
+            'finished_at': time.time(),
+            'duration': round(duration, 3),
+            'outcome': outcome,
+            'queries': scope['queries'],
+        }
+
+class LLMUsageCallback(BaseCallbackHandler):
+    """Record token usage, including provider-side prompt cache hits, for one LLM call."""
+
+    def __init__(self, provider, purpose):
+        self.provider = provider
+        self.purpose = purpose
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+                if not usage:
+                    continue
+                llm_tokens.inc(usage.get('input_tokens', 0), provider=self.provider, purpose=self.purpose, kind='input')
+                llm_tokens.inc(usage.get('output_tokens', 0), provider=self.provider, purpose=self.purpose, kind='output')
+                cache_read = (usage.get('input_token_details') or {}).get('cache_read', 0)
+                if cache_read:
+                    llm_tokens.inc(cache_read, provider=self.provider, purpose=self.purpose, kind='cache_read')
+
+def init_instrumentation(app):
+    """Register the Flask request hooks that time each request and count its queries."""
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+        g.metrics_scope = {'queries': 0, 'query_seconds': 0.0}
+        _scopes().append(g.metrics_scope)
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.pop('metrics_start', None)
+        scope = g.pop('metrics_scope', None)
+        if scope is not None:
+            _remove_scope(scope)
+        if start is None or scope is None:
+            return response
+
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        http_request_seconds.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+        http_request_queries.observe(scope['queries'], endpoint=endpoint)
+        return response
+
+    @app.teardown_request
+    def clear_request_scope(exc):
+        # after_request is skipped when a view raises; don't leak the scope to the next request
+        scope = g.pop('metrics_scope', None)
+        if scope is not None:
+            _remove_scope(scope)
+
+def render_prometheus():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def metrics_snapshot():
+    return {metric.name: metric.snapshot() for metric in REGISTRY}
@@ -0,0 +1,73 @@
+"""
+Scheduled background jobs: summarization, cleanup, digests and archival.
+
+They are CPU-heavy (transcript compaction, tokenizing, compression) and hold
+long transactions, so in production they run in their own process, worker.py
+(the Procfile's worker: entry). Under eventlet they would otherwise share the
+web process's hub with webhook ingest, Socket.IO and the SSE streams, and one
+large chunk would stall all of them. The web process only adds them when
+RUN_SCHEDULER is true, which is the default outside eventlet so that
+`python app.py` still summarizes on its own. Either way each job runs with
+db.session bound to the worker engine (database.worker_binding).
+"""
+import os
+
+from apscheduler.triggers.interval import IntervalTrigger
+
+from archive import ARCHIVE_AFTER_DAYS, archive_old_segments
+from database import worker_binding
+from digests import build_stale_digests
+from idempotency import prune_webhook_receipts
+from instrumentation import job_run
+from summarization_handler import cleanup_locked_segments, summarization_task
+
+RUN_SCHEDULER = os.environ.get(
+    'RUN_SCHEDULER', 'false' if os.environ.get('ASYNC_MODE', 'threading') == 'eventlet' else 'true'
+).lower() == 'true'
+
+def add_jobs(scheduler, app):
+    def summarization_task_wrapper():
+        with app.app_context(), worker_binding(), job_run('summarization_job'):
+            summarization_task()
+
+    def cleanup_locked_segments_wrapper():
+        with app.app_context(), worker_binding(), job_run('cleanup_locked_segments_job'):
+            cleanup_locked_segments()
+            prune_webhook_receipts()
+
+    def digest_task_wrapper():
+        with app.app_context(), worker_binding(), job_run('digest_job'):
+            build_stale_digests()
+
+    def archive_task_wrapper():
+        with app.app_context(), worker_binding(), job_run('archive_job'):
+            archive_old_segments()
+
+    scheduler.add_job(
+        func=summarization_task_wrapper,
+        trigger=IntervalTrigger(minutes=5),
+        id='summarization_job',
+        name='Generate summaries every 5 minutes',
+        replace_existing=True)
+
+    scheduler.add_job(
+        func=cleanup_locked_segments_wrapper,
+        trigger=IntervalTrigger(minutes=15),
+        id='cleanup_locked_segments_job',
+        name='Cleanup locked segments every 15 minutes',
+        replace_existing=True)
+
+    scheduler.add_job(
+        func=digest_task_wrapper,
+        trigger=IntervalTrigger(minutes=15),
+        id='digest_job',
+        name='Rebuild stale daily and weekly digests every 15 minutes',
+        replace_existing=True)
+
+    if ARCHIVE_AFTER_DAYS > 0:
+        scheduler.add_job(
+            func=archive_task_wrapper,
+            trigger=IntervalTrigger(hours=6),
+            id='archive_job',
+            name='Move segments older than ARCHIVE_AFTER_DAYS to cold storage every 6 hours',
+            replace_existing=True)
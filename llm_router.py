@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from instrumentation import llm_request_seconds
+from rate_limiter import RateLimited, is_rate_limit_error, parse_rate_limit_headers, error_headers
+
+logger = logging.getLogger(__name__)
+
+class ProviderStats:
+    """Rolling latency and error window for a single LLM provider."""
+
+    def __init__(self, window_size=200, cooldown_seconds=60, failure_threshold=3):
+        self.latencies = deque(maxlen=window_size)
+        self.outcomes = deque(maxlen=window_size)
+        self.cooldown_seconds = cooldown_seconds
+        self.failure_threshold = failure_threshold
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.lock = threading.Lock()
+
+    def record_success(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.outcomes.append(True)
+            self.consecutive_failures = 0
+            self.unhealthy_until = 0.0
+
+    def record_failure(self, latency):
+        with self.lock:
+            self.outcomes.append(False)
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                self.unhealthy_until = time.monotonic() + self.cooldown_seconds
+
+    def p95_latency(self, min_samples=20):
+        with self.lock:
+            if len(self.latencies) < min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def error_rate(self):
+        with self.lock:
+            if not self.outcomes:
+                return 0.0
+            return self.outcomes.count(False) / len(self.outcomes)
+
+    def is_healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    def snapshot(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            requests = len(self.outcomes)
+            consecutive_failures = self.consecutive_failures
+        return {
+            'healthy': self.is_healthy(),
+            'requests': requests,
+            'error_rate': round(self.error_rate(), 3),
+            'consecutive_failures': consecutive_failures,
+            'avg_latency': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'p95_latency': self.p95_latency(),
+        }
+
+class LLMRouter:
+    """
+    Route LLM calls across providers with automatic failover and optional hedging.
+
+    Providers are tried in preference order, skipping any that recently failed
+    repeatedly. With hedging enabled, a second request goes to the next provider
+    once the first has been running longer than its p95 latency, and whichever
+    finishes first wins.
+
+    With a limiter (provider -> rate_limiter.ProviderLimiter), each call first
+    waits for its provider's rate limits. A 429 or a limiter timeout is raised as
+    RateLimited and doesn't count against the provider's health. If any provider
+    was rate limited and none succeeded, RateLimited is what the caller sees, so
+    it can retry later instead of treating the call as failed.
+    """
+
+    def __init__(self, providers, hedge=False, hedge_delay=None, max_workers=8, limiter=None):
+        self.providers = list(providers)
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.limiter = limiter
+        self.stats = {provider: ProviderStats() for provider in self.providers}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm-router')
+
+    def candidates(self, preferred):
+        """Return providers in the order they should be tried for this call."""
+        self.stats.setdefault(preferred, ProviderStats())
+        ordered = [preferred] + [p for p in self.providers if p != preferred]
+        healthy = [p for p in ordered if self.stats[p].is_healthy()]
+        unhealthy = [p for p in ordered if not self.stats[p].is_healthy()]
+        return healthy + unhealthy
+
+    def _timed_call(self, provider, call, tokens=0):
+        limiter = self.limiter(provider) if self.limiter else None
+        if limiter:
+            limiter.acquire(tokens)
+        start = time.monotonic()
+        try:
+            result = call(provider)
+        except Exception as e:
+            if limiter:
+                limiter.release(e)
+            if is_rate_limit_error(e):
+                llm_request_seconds.observe(time.monotonic() - start, provider=provider, outcome='rate_limited')
+                retry_after = parse_rate_limit_headers(error_headers(e)).get('retry_after')
+                raise RateLimited(f"{provider} returned 429: {str(e)}", retry_after=retry_after) from e
+            self.stats[provider].record_failure(time.monotonic() - start)
+            llm_request_seconds.observe(time.monotonic() - start, provider=provider, outcome='error')
+            raise
+        if limiter:
+            limiter.release()
+        self.stats[provider].record_success(time.monotonic() - start)
+        llm_request_seconds.observe(time.monotonic() - start, provider=provider, outcome='ok')
+        return result
+
+    def invoke(self, preferred, call, hedge=None, tokens=0):
+        """
+        Run call(provider) against the preferred provider, failing over on errors.
+
+        tokens is the estimated size of the call (prompt plus completion) for the
+        limiter's tokens-per-minute bucket. Raises RateLimited if any provider was
+        rate limited and every provider fails, otherwise the last error.
+        """
+        candidates = self.candidates(preferred)
+        hedge = self.hedge if hedge is None else hedge
+        if hedge and len(candidates) > 1:
+            return self._invoke_hedged(candidates, call, tokens)
+
+        last_error = None
+        rate_limited = None
+        for provider in candidates:
+            try:
+                return self._timed_call(provider, call, tokens)
+            except RateLimited as e:
+                logger.warning(f"LLM provider {provider} is rate limited, trying next provider: {str(e)}")
+                rate_limited = e
+            except Exception as e:
+                logger.warning(f"LLM provider {provider} failed, trying next provider: {str(e)}")
+                last_error = e
+        raise rate_limited or last_error
+
+    def _invoke_hedged(self, candidates, call, tokens=0):
+        pending = {}
+        remaining = list(candidates)
+        last_error = None
+        rate_limited = None
+
+        def launch():
+            provider = remaining.pop(0)
+            future = self.executor.submit(self._timed_call, provider, call, tokens)
+            pending[future] = provider
+            return provider
+
+        primary = launch()
+        hedge_delay = self.hedge_delay or self.stats[primary].p95_latency()
+
+        while pending:
+            timeout = hedge_delay if remaining and hedge_delay is not None else None
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                hedged = launch()
+                logger.info(f"LLM provider {primary} exceeded {hedge_delay:.2f}s, hedging with {hedged}")
+                continue
+
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    return future.result()
+                except RateLimited as e:
+                    logger.warning(f"LLM provider {provider} is rate limited: {str(e)}")
+                    rate_limited = e
+                except Exception as e:
+                    logger.warning(f"LLM provider {provider} failed: {str(e)}")
+                    last_error = e
+
+            # Every in-flight request failed so far; fall over to the next provider immediately
+            if not pending and remaining:
+                launch()
+
+        raise rate_limited or last_error
+
+    def snapshot(self):
+        return {provider: stats.snapshot() for provider, stats in self.stats.items()}
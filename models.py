@@ -1,12 +1,16 @@
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.orm import DeclarativeBase, relationship
+from flask_sqlalchemy.session import Session
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
+from sqlalchemy.orm import DeclarativeBase, relationship, deferred
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
-from sqlalchemy import func, Index
+from sqlalchemy import DDL, func, Index, UniqueConstraint, event, inspect, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.dml import UpdateBase
 
 # Set up logging for this module
 logger = logging.getLogger(__name__)
@@ -15,8 +19,22 @@ logger = logging.getLogger(__name__)
 class Base(DeclarativeBase):
     pass
 
+class RoutingSession(Session):
+    """
+    db.session that sends a request's reads to the bind named in g.read_bind (set by
+    replica.replica_reads). Flushes and INSERT/UPDATE/DELETE statements always go to the primary.
+    g.session_bind (set by database.worker_binding) sends every statement to that bind.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context() and g.get('session_bind'):
+            return self._db.engines[g.session_bind]
+        if (bind is None and not self._flushing and not isinstance(clause, UpdateBase)
+                and has_app_context() and g.get('read_bind')):
+            return self._db.engines[g.read_bind]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
 # Initialize SQLAlchemy with the custom base class
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
 
 # User model for authentication and user management
 class User(db.Model, UserMixin):
@@ -64,10 +82,23 @@ class Main(db.Model):
     timestamp = db.Column(db.DateTime, nullable=False)
     host = db.Column(db.String, nullable=False)
     raw_data = db.Column(JSONB, nullable=False)  # Stores JSON data
+    # How raw_data is stored (see raw_payloads.py); NULL rows hold the whole payload
+    raw_format = db.Column(db.String(16), nullable=True)
+    raw_blob = deferred(db.Column(db.LargeBinary, nullable=True))
 
     # Establish a one-to-many relationship with Segment model
     segments = db.relationship('Segment', back_populates='main', cascade='all, delete-orphan')
 
+    __table_args__ = (
+        Index('idx_main_uid', uid),
+    )
+
+    @property
+    def payload(self):
+        """The full webhook payload, whichever storage mode the row was written in."""
+        from raw_payloads import decode_payload
+        return decode_payload(self)
+
 # Segment model to store individual parts of a session
 class Segment(db.Model):
     __tablename__ = 'segments'
@@ -83,10 +114,24 @@ class Segment(db.Model):
     timestamp = db.Column(db.DateTime(timezone=True), default=db.func.now())
     summary_id = db.Column(db.Integer, db.ForeignKey('summaries.id'), nullable=True)
     processed = db.Column(db.Boolean, default=False)
+    # Day and hour of timestamp in the user's timezone, stamped at ingest
+    local_date = db.Column(db.Date)
+    local_hour = db.Column(db.SmallInteger)
+    # Full-text search document, set by the segments_search_vector trigger on insert and on text changes
+    search_vector = deferred(db.Column(TSVECTOR))
 
     # Establish the many-to-one relationship with Main model
     main = relationship('Main', back_populates='segments')
 
+    __table_args__ = (
+        Index('idx_segments_main_id', main_id),
+        Index('idx_segments_local_date', local_date),
+        Index('idx_segments_summary_id', summary_id),
+        Index('idx_segments_search_vector', search_vector, postgresql_using='gin'),
+    )
+    # Don't fetch SQL-side defaults back with RETURNING on every ingest insert
+    __mapper_args__ = {'eager_defaults': False}
+
     # Add relationship to summaries
     summary = relationship('summaries', back_populates='segments')
 
@@ -111,6 +156,45 @@ class Segment(db.Model):
             'processed': self.processed
         }
 
+# One row per accepted /webhook delivery; the unique key makes device retries no-ops
+
+# A plain column filled by a trigger rather than a generated column: adding a generated
+# column rewrites the whole table under an exclusive lock, while this one can be added
+# instantly and backfilled in batches (see schema.py).
+SEGMENT_SEARCH_VECTOR_FUNCTION = """
+    CREATE OR REPLACE FUNCTION segments_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := to_tsvector('english', coalesce(NEW.text, ''));
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+"""
+SEGMENT_SEARCH_VECTOR_TRIGGER = """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'segments_search_vector'
+                       AND tgrelid = 'segments'::regclass) THEN
+            CREATE TRIGGER segments_search_vector BEFORE INSERT OR UPDATE OF text ON segments
+                FOR EACH ROW EXECUTE FUNCTION segments_search_vector_update();
+        END IF;
+    END
+    $$
+"""
+event.listen(Segment.__table__, 'after_create', DDL(SEGMENT_SEARCH_VECTOR_FUNCTION))
+event.listen(Segment.__table__, 'after_create', DDL(SEGMENT_SEARCH_VECTOR_TRIGGER))
+
+class webhook_receipts(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    idempotency_key = db.Column(db.String(64), nullable=False)
+    uid = db.Column(db.String(255), nullable=False)
+    session_id = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index('uq_webhook_receipts_key', idempotency_key, unique=True),
+        Index('idx_webhook_receipts_created_at', created_at),
+    )
+
 class temp_segments(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -142,9 +226,145 @@ class summaries(db.Model):
     fact_checker = db.Column(db.ARRAY(db.Text))
     timestamp = db.Column(db.DateTime(timezone=True), default=func.now())
     created_at = db.Column(db.DateTime(timezone=True), default=func.now())
+    # Day and hour of timestamp in the user's timezone, stamped when the summary is written
+    local_date = db.Column(db.Date)
+    local_hour = db.Column(db.SmallInteger)
+    # Full-text search document over the headline (weight A) and bullets (weight B)
+    search_vector = deferred(db.Column(TSVECTOR))
 
     # Update relationship to User
     user = relationship('User', back_populates='summaries')
 
     # Add relationship to Segment
-    segments = relationship('Segment', back_populates='summary')
\ No newline at end of file
+    segments = relationship('Segment', back_populates='summary')
+
+    __table_args__ = (
+        Index('idx_summaries_search_vector', search_vector, postgresql_using='gin'),
+        Index('idx_summaries_user_local_date', user_id, local_date),
+    )
+
+def summary_search_vector(headline, bullet_points):
+    """SQL expression for a summary's search document."""
+    if isinstance(bullet_points, list):
+        bullet_text = " ".join(bullet_points)
+    else:
+        bullet_text = bullet_points or ""
+    return func.setweight(func.to_tsvector('english', headline or ''), 'A').op('||')(
+        func.setweight(func.to_tsvector('english', bullet_text), 'B')
+    )
+
+# array_to_string is not immutable, so Postgres can't generate this column itself;
+# compute it whenever a summary is written instead.
+@event.listens_for(summaries, 'before_insert')
+@event.listens_for(summaries, 'before_update')
+def set_summary_search_vector(mapper, connection, target):
+    target.search_vector = summary_search_vector(target.headline, target.bullet_points)
+
+# Rolled-up digests of a user's summaries. Hour digests reduce the summaries written in
+# that hour, day digests reduce hour digests and week digests reduce day digests.
+# period_start is the start of the period in the user's timezone, stored as an instant.
+class digests(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    period = db.Column(db.String(10), nullable=False)  # 'hour', 'day' or 'week'
+    period_start = db.Column(db.DateTime(timezone=True), nullable=False)
+    headline = db.Column(db.Text)
+    bullet_points = db.Column(db.ARRAY(db.Text))
+    source_count = db.Column(db.Integer, default=0)
+    # Hash of the contributing rows; a rebuild whose inputs hash the same skips the LLM
+    source_fingerprint = db.Column(db.String(64))
+    stale = db.Column(db.Boolean, nullable=False, default=True)
+    updated_at = db.Column(db.DateTime(timezone=True), default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'period', 'period_start', name='uq_digests_user_period'),
+        Index('idx_digests_stale', stale, postgresql_where=stale),
+    )
+
+# One UTC day of a user's archived segments and the sessions they belonged to (see archive.py).
+# Each block is a zlib-compressed JSON dict of column -> list of values.
+class SegmentArchive(db.Model):
+    __tablename__ = 'segment_archive'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    segment_block = db.Column(db.LargeBinary, nullable=False)
+    # Only read by restore_day(), so day reads don't fetch the raw payloads
+    main_block = deferred(db.Column(db.LargeBinary, nullable=False))
+    segment_count = db.Column(db.Integer, nullable=False)
+    main_count = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+# A user's related-summaries index (see related.py): the indexed summary ids and their
+# hashed term vectors, stored together as one uncompressed .npz.
+class RelatedIndex(db.Model):
+    __tablename__ = 'related_index'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    # Bumped on every write; processes compare it with their cached copy before loading the blob
+    version = db.Column(db.Integer, nullable=False, default=1)
+    index_blob = deferred(db.Column(db.LargeBinary, nullable=False))
+    updated_at = db.Column(db.DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+DEFAULT_TIMEZONE = 'US/Pacific'
+
+def user_timezone(name):
+    try:
+        return pytz.timezone(name or DEFAULT_TIMEZONE)
+    except pytz.UnknownTimeZoneError:
+        return pytz.timezone(DEFAULT_TIMEZONE)
+
+def period_start(period, timestamp, tz):
+    """Start of the hour, day or week (from Monday) containing timestamp, in the user's timezone."""
+    if timestamp.tzinfo is None:
+        timestamp = pytz.UTC.localize(timestamp)
+    local = timestamp.astimezone(tz)
+    if period == 'hour':
+        return local.replace(minute=0, second=0, microsecond=0)
+    day = datetime(local.year, local.month, local.day)
+    if period == 'week':
+        day -= timedelta(days=local.weekday())
+    return tz.localize(day)
+
+def local_day_and_hour(timestamp, tz):
+    """(date, hour) of timestamp in tz; naive timestamps are UTC."""
+    if timestamp.tzinfo is None:
+        timestamp = pytz.UTC.localize(timestamp)
+    local = timestamp.astimezone(tz)
+    return local.date(), local.hour
+
+@event.listens_for(summaries, 'before_insert')
+@event.listens_for(summaries, 'before_update')
+def set_summary_local_date(mapper, connection, target):
+    if not isinstance(target.timestamp, datetime):
+        return
+    if target.local_date is not None and not inspect(target).attrs.timestamp.history.has_changes():
+        return
+    timezone_name = connection.execute(select(User.timezone).where(User.id == target.user_id)).scalar()
+    target.local_date, target.local_hour = local_day_and_hour(target.timestamp, user_timezone(timezone_name))
+
+# Runs inside the summary's flush, so a digest can never miss a summary that was committed
+def mark_digests_stale(connection, user_id, timestamps):
+    timezone_name = connection.execute(select(User.timezone).where(User.id == user_id)).scalar()
+    tz = user_timezone(timezone_name)
+    rows = {
+        (period, period_start(period, timestamp, tz))
+        for timestamp in timestamps if timestamp is not None
+        for period in ('hour', 'day', 'week')
+    }
+    if not rows:
+        return
+    connection.execute(
+        insert(digests).values([
+            {'user_id': user_id, 'period': period, 'period_start': start, 'stale': True, 'source_count': 0}
+            for period, start in rows
+        ]).on_conflict_do_update(constraint='uq_digests_user_period', set_={'stale': True})
+    )
+
+@event.listens_for(summaries, 'after_insert')
+@event.listens_for(summaries, 'after_update')
+@event.listens_for(summaries, 'after_delete')
+def summary_changed(mapper, connection, target):
+    # A summary moved to another hour leaves its old periods stale too
+    previous = inspect(target).attrs.timestamp.history.deleted or []
+    mark_digests_stale(connection, target.user_id, [target.timestamp, *previous])
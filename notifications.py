@@ -0,0 +1,119 @@
+"""
+Summary events shared between processes through Postgres LISTEN/NOTIFY.
+
+The summarizer, batch reprocessing and any other dyno publish summary events with
+notify_summary_event(). Each web process runs listen_summary_events() in a
+background task and hands every event to its Socket.IO rooms and open
+/summary_updates streams, so a browser hears about a summary whichever process
+wrote it. Events carry {user_id, event, data}:
+
+    summary_progress   partial output of a summary being written (live view only)
+    summary_complete   a summary the scheduler just wrote, with its stream_id
+    summary_discarded  a streamed summary that was not persisted
+    summary_written    a summary written or rewritten by batch reprocessing
+
+Events published with a session are delivered when that session commits, so a
+listener never hears about a summary it cannot read yet. NOTIFY payloads must
+stay under 8000 bytes. A larger progress event is dropped; a larger summary
+event is sent as just its id and the listener loads the row.
+
+LISTEN needs a session-level connection, which PgBouncer's transaction pooling
+does not provide. Set LISTEN_DATABASE_URL to a direct connection in that case;
+it defaults to DATABASE_URL.
+"""
+import json
+import logging
+import os
+import select
+import time
+
+import psycopg2
+from sqlalchemy import func, select as sql_select
+
+from database import worker_engine
+from models import db, summaries
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_EVENTS_CHANNEL = 'summary_events'
+# NOTIFY rejects payloads of 8000 bytes or more
+MAX_NOTIFY_BYTES = 7900
+SUMMARY_EVENTS = ('summary_complete', 'summary_written')
+LISTEN_RECONNECT_SECONDS = 5
+
+def summary_event_data(row):
+    return {
+        'id': row.id,
+        'headline': row.headline,
+        'bullet_points': row.bullet_points,
+        'tag': row.tag,
+        'fact_checker': row.fact_checker,
+        'timestamp': row.timestamp.isoformat() if row.timestamp else None,
+    }
+
+def _payload(user_id, event, data):
+    payload = json.dumps({'user_id': user_id, 'event': event, 'data': data}, default=str)
+    if len(payload.encode('utf-8')) < MAX_NOTIFY_BYTES:
+        return payload
+    if event not in SUMMARY_EVENTS:
+        logger.debug(f"Dropping {event} for User {user_id}: payload too large to notify")
+        return None
+    slim = {'id': data['id'], 'stream_id': data.get('stream_id'), 'load': True}
+    return json.dumps({'user_id': user_id, 'event': event, 'data': slim})
+
+def notify_summary_event(user_id, event, data, session=None):
+    """Publish an event to every web process; with a session it is sent when the session commits."""
+    payload = _payload(user_id, event, data)
+    if payload is None:
+        return
+    statement = sql_select(func.pg_notify(SUMMARY_EVENTS_CHANNEL, payload))
+    if session is not None:
+        session.execute(statement)
+        return
+    with worker_engine().begin() as conn:
+        conn.execute(statement)
+
+def _listen_url(app):
+    url = os.environ.get('LISTEN_DATABASE_URL') or app.config['SQLALCHEMY_DATABASE_URI']
+    # psycopg2 takes libpq URLs, not SQLAlchemy ones with a driver suffix
+    return url.replace('postgresql+psycopg2://', 'postgresql://', 1)
+
+def _resolve(app, message):
+    data = message['data']
+    if data.pop('load', False):
+        with app.app_context():
+            row = db.session.get(summaries, data['id'])
+            if row is None:
+                return None
+            data.update(summary_event_data(row))
+    return message
+
+def listen_summary_events(app, deliver, poll_seconds=LISTEN_RECONNECT_SECONDS):
+    """Call deliver(user_id, event, data) for every summary event; runs forever, reconnecting on errors."""
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(_listen_url(app))
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {SUMMARY_EVENTS_CHANNEL}")
+            logger.info(f"Listening for {SUMMARY_EVENTS_CHANNEL}")
+            while True:
+                # select() is cooperative once eventlet has patched it
+                if select.select([conn], [], [], poll_seconds) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        message = _resolve(app, json.loads(notify.payload))
+                        if message is not None:
+                            deliver(message['user_id'], message['event'], message['data'])
+                    except Exception as e:
+                        logger.warning(f"Failed to deliver summary event: {str(e)}")
+        except Exception as e:
+            logger.error(f"Summary event listener failed, reconnecting: {str(e)}")
+            time.sleep(poll_seconds)
+        finally:
+            if conn is not None:
+                conn.close()
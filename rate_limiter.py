@@ -0,0 +1,263 @@
+"""
+Client-side rate limiting against LLM provider quotas.
+
+Each provider and model pair gets a ProviderLimiter. It enforces three limits:
+
+    - requests per minute and tokens per minute, as token buckets. They start
+      from LLM_RATE_LIMITS ("model=rpm/tpm,...") if set and then follow the
+      provider's rate-limit headers (x-ratelimit-* for OpenAI,
+      anthropic-ratelimit-* for Anthropic).
+    - concurrent requests, adjusted by AIMD. The limit grows by one after a
+      full window of successes, is halved by a 429, and stays between 1 and
+      LLM_MAX_CONCURRENCY.
+
+A call waits for its buckets, so a burst is spread out rather than sent and
+rejected. After a 429 the limiter pauses for the provider's retry-after. If a
+call cannot start within LLM_RATE_LIMIT_MAX_WAIT seconds, or the provider
+still answers 429, RateLimited is raised. The router then fails over. The
+summarizer retries the chunk without counting it as a failed attempt, and
+stops the run after SUMMARIZATION_RATE_LIMIT_STREAK rate-limited chunks in a row.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from instrumentation import llm_concurrency_limit, llm_rate_limited
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 8))
+LLM_RATE_LIMIT_MAX_WAIT = float(os.environ.get('LLM_RATE_LIMIT_MAX_WAIT', 60))
+# Used when a 429 carries no retry-after
+DEFAULT_RETRY_AFTER = 5.0
+
+class RateLimited(Exception):
+    """A provider refused a call for its rate limit, or the limiter could not admit it in time."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_limits(value):
+    """"gpt-4o=500/30000,claude-3-5-sonnet-20240620=50/40000" -> {model: (rpm, tpm)}."""
+    limits = {}
+    for item in (value or '').split(','):
+        model, _, rates = item.strip().partition('=')
+        rpm, _, tpm = rates.partition('/')
+        try:
+            limits[model] = (int(rpm) if rpm else None, int(tpm) if tpm else None)
+        except ValueError:
+            continue
+    return limits
+
+LLM_RATE_LIMITS = parse_limits(os.environ.get('LLM_RATE_LIMITS'))
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def parse_reset(value, now=None):
+    """Seconds until a reset given as "1m30s" / "120ms" (OpenAI), an RFC 3339 time (Anthropic) or plain seconds."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+    try:
+        reset_at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return max(0.0, reset_at.timestamp() - (now or time.time()))
+
+def _int_header(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def parse_rate_limit_headers(headers):
+    """Normalise OpenAI and Anthropic rate-limit headers to {requests: ..., tokens: ..., retry_after: ...}."""
+    headers = {str(key).lower(): value for key, value in (headers or {}).items()}
+    parsed = {}
+    for kind in ('requests', 'tokens'):
+        for limit, remaining, reset in (
+            (f"x-ratelimit-limit-{kind}", f"x-ratelimit-remaining-{kind}", f"x-ratelimit-reset-{kind}"),
+            (f"anthropic-ratelimit-{kind}-limit", f"anthropic-ratelimit-{kind}-remaining", f"anthropic-ratelimit-{kind}-reset"),
+        ):
+            if limit in headers or remaining in headers:
+                parsed[kind] = {
+                    'limit': _int_header(headers, limit),
+                    'remaining': _int_header(headers, remaining),
+                    'reset': parse_reset(headers.get(reset)),
+                }
+                break
+    if 'retry-after-ms' in headers:
+        parsed['retry_after'] = parse_reset(headers['retry-after-ms']) / 1000.0
+    elif 'retry-after' in headers:
+        parsed['retry_after'] = parse_reset(headers['retry-after'])
+    return parsed
+
+def is_rate_limit_error(error):
+    """429s from the OpenAI and Anthropic SDKs (and the fake model); other failures are not rate limits."""
+    return isinstance(error, RateLimited) or getattr(error, 'status_code', None) == 429
+
+def error_headers(error):
+    return getattr(getattr(error, 'response', None), 'headers', None) or getattr(error, 'headers', None)
+
+class TokenBucket:
+    """Refills per_minute units evenly over a minute, holding at most a minute's worth."""
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.available = min(self.per_minute, self.available + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until amount is available; 0 if it is now."""
+        self._refill(now)
+        # A call larger than the whole bucket waits for a full bucket rather than forever
+        amount = min(amount, self.per_minute)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) * 60.0 / self.per_minute
+
+    def take(self, amount):
+        self.available -= min(amount, self.per_minute)
+
+    def sync(self, limit=None, remaining=None):
+        """Adopt the provider's view of the limit and what is left of it."""
+        self._refill(time.monotonic())
+        if limit:
+            self.per_minute = limit
+        if remaining is not None:
+            self.available = min(self.available, float(remaining))
+
+class ProviderLimiter:
+    def __init__(self, name, requests_per_minute=None, tokens_per_minute=None, max_concurrency=LLM_MAX_CONCURRENCY):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+        llm_concurrency_limit.set(int(self.concurrency), limiter=name)
+
+    def _wait_time(self, tokens, now):
+        """Seconds until the pause ends and both buckets can cover the call."""
+        waits = [self.paused_until - now]
+        if self.requests:
+            waits.append(self.requests.wait_time(1, now))
+        if self.tokens and tokens:
+            waits.append(self.tokens.wait_time(tokens, now))
+        return max(waits)
+
+    def acquire(self, tokens=0, max_wait=LLM_RATE_LIMIT_MAX_WAIT):
+        """Block until the call fits every limit, or raise RateLimited if that takes over max_wait seconds."""
+        deadline = time.monotonic() + max_wait
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                wait = self._wait_time(tokens, now)
+                full = self.in_flight >= int(self.concurrency)
+                if wait <= 0 and not full:
+                    break
+                if now + wait > deadline or (full and now >= deadline):
+                    llm_rate_limited.inc(limiter=self.name, source='client')
+                    raise RateLimited(f"{self.name} is rate limited; no capacity within {max_wait:.0f}s",
+                                      retry_after=max(wait, 0.0))
+                # release() wakes waiters for a free slot; recheck at least every second for refills
+                self.condition.wait(min(max(wait, 0.0) or 1.0, deadline - now, 1.0))
+            self.in_flight += 1
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens and tokens:
+                self.tokens.take(tokens)
+
+    def release(self, error=None):
+        """Finish a call started with acquire(), adjusting concurrency by its outcome."""
+        with self.condition:
+            self.in_flight -= 1
+            if error is not None and is_rate_limit_error(error):
+                self._rate_limited(parse_rate_limit_headers(error_headers(error)).get('retry_after'))
+            elif error is None:
+                # Additive increase: one more slot per window of successes at the current limit
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+            llm_concurrency_limit.set(int(self.concurrency), limiter=self.name)
+            self.condition.notify_all()
+
+    def _rate_limited(self, retry_after):
+        self.concurrency = max(1.0, self.concurrency / 2)
+        pause = retry_after if retry_after is not None else DEFAULT_RETRY_AFTER
+        self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        llm_rate_limited.inc(limiter=self.name, source='provider')
+        logger.warning(f"{self.name} returned 429; pausing {pause:.1f}s, concurrency now {int(self.concurrency)}")
+
+    def observe_headers(self, headers):
+        """Follow the limits and remaining quota the provider reports."""
+        parsed = parse_rate_limit_headers(headers)
+        with self.condition:
+            for kind in ('requests', 'tokens'):
+                info = parsed.get(kind)
+                if not info or not info['limit']:
+                    continue
+                bucket = getattr(self, kind)
+                if bucket is None:
+                    bucket = TokenBucket(info['limit'])
+                    setattr(self, kind, bucket)
+                # Reset times are until the quota is full again, so the bucket's own refill paces the next call
+                bucket.sync(info['limit'], info['remaining'])
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                'concurrency_limit': int(self.concurrency),
+                'in_flight': self.in_flight,
+                'paused_for': round(max(0.0, self.paused_until - time.monotonic()), 1),
+                'requests_per_minute': self.requests.per_minute if self.requests else None,
+                'tokens_per_minute': self.tokens.per_minute if self.tokens else None,
+            }
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter_for(provider, model):
+    name = f"{provider}:{model}"
+    with _limiters_lock:
+        if name not in _limiters:
+            requests_per_minute, tokens_per_minute = LLM_RATE_LIMITS.get(model, (None, None))
+            _limiters[name] = ProviderLimiter(name, requests_per_minute, tokens_per_minute)
+        return _limiters[name]
+
+def limiters_snapshot():
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {name: limiter.snapshot() for name, limiter in limiters.items()}
+
+class RateLimitCallback(BaseCallbackHandler):
+    """Feed the rate-limit headers of successful responses to a limiter."""
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                headers = (generation.generation_info or {}).get('headers') or \
+                    getattr(getattr(generation, 'message', None), 'response_metadata', {}).get('headers')
+                if headers:
+                    self.limiter.observe_headers(headers)
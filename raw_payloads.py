@@ -0,0 +1,132 @@
+"""
+Compact storage for the raw webhook payload kept in main.raw_data.
+
+Every payload repeats all of its segment text, which is also stored row by row
+in segments, so keeping it whole in JSONB roughly doubles ingest storage and
+WAL. RAW_PAYLOAD_STORAGE picks what is kept:
+
+  full        the whole payload in raw_data (the original behaviour)
+  compressed  the payload without its segments in raw_data, plus the original
+              payload gzip-compressed in raw_blob
+  envelope    only the payload without its segments; the segments are rebuilt
+              from the segments table when the payload is read
+
+main.raw_format records the mode of each row (NULL for rows written before it
+existed), and Main.payload returns the full payload whatever the mode. Existing
+rows are converted in batches with:
+
+    python raw_payloads.py --mode compressed --batch-size 500
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+
+from flask import Flask
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+STORAGE_MODES = ('full', 'compressed', 'envelope')
+RAW_PAYLOAD_STORAGE = os.environ.get('RAW_PAYLOAD_STORAGE', 'full')
+if RAW_PAYLOAD_STORAGE not in STORAGE_MODES:
+    raise ValueError(f"RAW_PAYLOAD_STORAGE must be one of {', '.join(STORAGE_MODES)}")
+
+# Segment fields that are stored as segments columns and can be rebuilt from them
+SEGMENT_FIELDS = ('text', 'speaker', 'speaker_id', 'is_user', 'start_time', 'end_time')
+
+def envelope(payload):
+    """The payload without its segments, plus how many there were."""
+    data = {key: value for key, value in payload.items() if key != 'segments'}
+    data['segment_count'] = len(payload.get('segments') or [])
+    return data
+
+def compress_payload(payload):
+    return gzip.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'), compresslevel=6)
+
+def decompress_payload(blob):
+    return json.loads(gzip.decompress(blob).decode('utf-8'))
+
+def encode_payload(payload, mode=None):
+    """Column values for Main (raw_data, raw_blob, raw_format) under the given storage mode."""
+    mode = mode or RAW_PAYLOAD_STORAGE
+    if mode == 'full':
+        return {'raw_data': payload, 'raw_blob': None, 'raw_format': 'full'}
+    if mode == 'compressed':
+        return {'raw_data': envelope(payload), 'raw_blob': compress_payload(payload), 'raw_format': 'compressed'}
+    return {'raw_data': envelope(payload), 'raw_blob': None, 'raw_format': 'envelope'}
+
+def decode_payload(main_entry):
+    """Reconstruct the full payload of a Main row."""
+    if main_entry.raw_format == 'compressed':
+        return decompress_payload(main_entry.raw_blob)
+    if main_entry.raw_format == 'envelope':
+        payload = {key: value for key, value in main_entry.raw_data.items() if key != 'segment_count'}
+        payload['segments'] = [
+            {field: getattr(segment, field) for field in SEGMENT_FIELDS}
+            for segment in sorted(main_entry.segments, key=lambda segment: segment.id)
+        ]
+        return payload
+    return main_entry.raw_data
+
+def stored_envelope(main_entry):
+    """The payload without its segments, read from raw_data alone."""
+    if main_entry.raw_format in ('compressed', 'envelope'):
+        return main_entry.raw_data
+    return envelope(main_entry.raw_data)
+
+def convert_existing(mode, batch_size=500, limit=None):
+    """Re-encode rows stored in another mode, one batch per transaction. Returns the number converted."""
+    from sqlalchemy.orm import selectinload
+    from models import db, Main
+
+    if mode == 'full':
+        # NULL rows predate raw_format and are already stored whole
+        needs_conversion = db.and_(Main.raw_format.isnot(None), Main.raw_format != 'full')
+    else:
+        needs_conversion = db.or_(Main.raw_format.is_(None), Main.raw_format != mode)
+
+    converted = 0
+    last_id = 0
+    while limit is None or converted < limit:
+        rows = Main.query.options(selectinload(Main.segments)).filter(
+            Main.id > last_id,
+            needs_conversion
+        ).order_by(Main.id.asc()).limit(batch_size).all()
+        if not rows:
+            break
+
+        for row in rows:
+            values = encode_payload(decode_payload(row), mode)
+            row.raw_data = values['raw_data']
+            row.raw_blob = values['raw_blob']
+            row.raw_format = values['raw_format']
+        db.session.commit()
+
+        last_id = rows[-1].id
+        converted += len(rows)
+        logger.info(f"Converted {converted} main rows to {mode} storage (last id {last_id})")
+    return converted
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=STORAGE_MODES, default=RAW_PAYLOAD_STORAGE)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--limit', type=int, help="Stop after converting this many rows")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    from database import init_database
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    init_database(app, role='worker')
+    with app.app_context():
+        converted = convert_existing(args.mode, args.batch_size, args.limit)
+    print(f"Converted {converted} rows to {args.mode} storage")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
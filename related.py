@@ -0,0 +1,209 @@
+"""
+"Related conversations": nearest neighbours of a summary across a user's history.
+
+Each user has a sparse matrix with one row per summary. A row is the hashed
+term vector of the summary's headline and bullets, with sublinear TF and L2
+normalisation. Hashing needs no fitted vocabulary, so new summaries are
+vectorised on their own and appended as rows, and the index is never refit.
+The matrix and its summary ids are stored in the related_index table as one
+uncompressed .npz per user, so every process shares it, it survives restarts,
+and it is emptied along with the summaries it indexes. Each process caches the
+matrix and reloads it only when the row's version changes. A query is one
+sparse dot product against the matrix, which gives the cosine similarity to
+every past summary without touching their text.
+
+Summary ids come from a sequence, so a summary can commit after one with a
+higher id. Each sync therefore re-checks the last RELATED_RESCAN_IDS ids
+behind the newest indexed one and adds any it has not seen. Syncs of a user
+are serialised with an advisory lock; a sync that finds it taken leaves the
+work to the holder.
+
+    python related.py [USER_ID ...]   build or catch up the indexes (all users by default)
+"""
+import argparse
+import io
+import logging
+import os
+import sys
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+from sqlalchemy import BigInteger, all_, bindparam, func, text
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.orm import undefer
+
+from cooperative import offload
+from models import RelatedIndex, User, db, summaries
+
+logger = logging.getLogger(__name__)
+
+MIN_SIMILARITY = 0.05
+# How far behind the newest indexed id a sync looks for summaries that committed late
+RELATED_RESCAN_IDS = int(os.environ.get('RELATED_RESCAN_IDS', 1000))
+# First key of the advisory lock that serialises syncs of a user's index, across dynos
+RELATED_LOCK_CLASS = 32
+
+vectorizer = HashingVectorizer(
+    n_features=2 ** 18,
+    ngram_range=(1, 2),
+    stop_words='english',
+    alternate_sign=False,
+    norm=None,
+    dtype=np.float32,
+)
+
+# user_id -> (version, ids, matrix)
+_cache = {}
+
+def summary_text(headline, bullet_points):
+    return " ".join([headline or ""] + list(bullet_points or []))
+
+def vectorize(texts):
+    matrix = vectorizer.transform(texts).tocsr()
+    np.log1p(matrix.data, out=matrix.data)
+    return normalize(matrix, norm='l2', copy=False)
+
+def _empty_index():
+    return np.empty(0, dtype=np.int64), sparse.csr_matrix((0, vectorizer.n_features), dtype=np.float32)
+
+def _decode(blob):
+    with np.load(io.BytesIO(blob)) as stored:
+        ids = stored['ids']
+        matrix = sparse.csr_matrix((stored['data'], stored['indices'], stored['indptr']), shape=tuple(stored['shape']))
+    return ids, matrix
+
+def _encode(ids, matrix):
+    buffer = io.BytesIO()
+    np.savez(buffer, ids=ids, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+             shape=np.array(matrix.shape))
+    return buffer.getvalue()
+
+def load_index(user_id):
+    """Return (ids, matrix) for a user; ids are ascending summary ids aligned with matrix rows."""
+    version = db.session.query(RelatedIndex.version).filter_by(user_id=user_id).scalar()
+    if version is None:
+        _cache.pop(user_id, None)
+        return _empty_index()
+
+    cached = _cache.get(user_id)
+    if cached and cached[0] == version:
+        return cached[1], cached[2]
+
+    version, blob = db.session.query(RelatedIndex.version, RelatedIndex.index_blob).filter_by(user_id=user_id).one()
+    ids, matrix = _decode(blob)
+    _cache[user_id] = (version, ids, matrix)
+    return ids, matrix
+
+def _save_index(user_id, ids, matrix):
+    """Write a user's index in the current transaction and return its new version."""
+    blob = _encode(ids, matrix)
+    return db.session.execute(
+        insert(RelatedIndex).values(user_id=user_id, version=1, index_blob=blob)
+        .on_conflict_do_update(index_elements=[RelatedIndex.user_id], set_={
+            'version': RelatedIndex.version + 1,
+            'index_blob': blob,
+            'updated_at': func.now(),
+        })
+        .returning(RelatedIndex.version)
+    ).scalar()
+
+def _lock_user(user_id, wait):
+    """Take the user's index lock for the rest of the transaction; without wait, False if another sync has it."""
+    function = "pg_advisory_xact_lock" if wait else "pg_try_advisory_xact_lock"
+    locked = db.session.execute(text(f"SELECT {function}(:lock_class, :user_id)"),
+                                {'lock_class': RELATED_LOCK_CLASS, 'user_id': user_id}).scalar()
+    return wait or locked
+
+def sync_user_index(user_id, wait=True, rebuild=False):
+    """
+    Add summaries missing from the index: newer ones, and late commits within RELATED_RESCAN_IDS.
+    With rebuild, vectorise every summary again. Commits db.session and returns the number added.
+    """
+    try:
+        if not _lock_user(user_id, wait):
+            db.session.rollback()
+            return 0
+        ids, matrix = _empty_index() if rebuild else load_index(user_id)
+        last_id = int(ids[-1]) if len(ids) else 0
+        since_id = max(last_id - RELATED_RESCAN_IDS, 0)
+
+        # Up to RELATED_RESCAN_IDS ids are already indexed within the window; they go in as one array parameter
+        indexed = bindparam('indexed', ids[ids > since_id].tolist(), type_=ARRAY(BigInteger))
+        new_rows = db.session.query(summaries.id, summaries.headline, summaries.bullet_points).filter(
+            summaries.user_id == user_id,
+            summaries.id > since_id,
+            summaries.id != all_(indexed)
+        ).order_by(summaries.id.asc()).all()
+        if not new_rows and not rebuild:
+            db.session.rollback()
+            return 0
+
+        new_matrix = offload(vectorize, [summary_text(headline, bullets) for _, headline, bullets in new_rows])
+        ids = np.concatenate([ids, np.array([row.id for row in new_rows], dtype=np.int64)])
+        matrix = sparse.vstack([matrix, new_matrix], format='csr', dtype=np.float32)
+        if new_rows and new_rows[0].id < last_id:
+            # A late commit landed behind indexed ids; keep rows in id order for searchsorted
+            order = np.argsort(ids, kind='stable')
+            ids, matrix = ids[order], matrix[order]
+        version = _save_index(user_id, ids, matrix)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    _cache[user_id] = (version, ids, matrix)
+    logger.info(f"Added {len(new_rows)} summaries to the related index for User {user_id}")
+    return len(new_rows)
+
+def _position(ids, summary_id):
+    row = np.searchsorted(ids, summary_id)
+    return row if row < len(ids) and ids[row] == summary_id else None
+
+def related_summaries(user_id, summary_id, limit=5):
+    """Return [(summary_id, score)] for the summaries most similar to summary_id, best first."""
+    ids, matrix = load_index(user_id)
+    row = _position(ids, summary_id)
+    if row is None:
+        # The summarizer syncs after every write, so this only runs for a summary it has not reached yet
+        sync_user_index(user_id, wait=False)
+        ids, matrix = load_index(user_id)
+        row = _position(ids, summary_id)
+        if row is None:
+            return []
+
+    scores = offload(lambda: (matrix @ matrix[row].T).toarray().ravel())
+    scores[row] = -1.0
+    limit = min(limit, len(ids) - 1)
+    if limit <= 0:
+        return []
+
+    top = np.argpartition(-scores, limit - 1)[:limit]
+    top = top[np.argsort(-scores[top])]
+    return [(int(ids[i]), float(scores[i])) for i in top if scores[i] >= MIN_SIMILARITY]
+
+def rebuild_user_index(user_id):
+    """Rebuild a user's index from scratch, for when existing summaries were rewritten in place."""
+    return sync_user_index(user_id, rebuild=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('user_ids', nargs='*', type=int, help="Users to index (default: all)")
+    parser.add_argument('--rebuild', action='store_true', help="Vectorise every summary again")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    from flask import Flask
+    from config import Config
+    from database import init_database
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    init_database(app, role='worker')
+    with app.app_context():
+        user_ids = args.user_ids or [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+        added = sum(sync_user_index(user_id, rebuild=args.rebuild) for user_id in user_ids)
+    print(f"Indexed {added} summaries for {len(user_ids)} users")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
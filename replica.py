@@ -0,0 +1,109 @@
+"""
+Read-replica routing for dashboard and history reads.
+
+Webhook ingest and the summarizer write to the primary. The heaviest reads
+(transcripts, dashboards, search and exports) used to compete with them there.
+With REPLICA_DATABASE_URL set, database.py adds a read-only 'replica' bind.
+Views decorated with @replica_reads then run their queries on it, and
+models.RoutingSession does the routing. A request stays on the primary when:
+
+    - the user wrote in the last REPLICA_READ_YOUR_WRITES_SECONDS, so they see
+      their own data (response_cache.invalidate_user_days records the writes)
+    - the replica is unreachable or more than REPLICA_MAX_LAG_SECONDS behind,
+      checked at most every REPLICA_CHECK_SECONDS per process
+    - the response cache is per-process (see response_cache.py). Writes from
+      other dynos and the CLIs would not be seen, so the replica is not used.
+
+Keep the read-your-writes window above the maximum lag. A user's reads then
+only move to the replica once it has replayed their last write.
+
+To try it with a single Postgres, point REPLICA_DATABASE_URL at the primary
+and set CACHE_TYPE to RedisCache.
+Replica sessions are read-only, so a write routed there by mistake fails, and
+the lag reads as zero.
+"""
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import g
+from flask_login import current_user
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from database import REPLICA_BIND
+from instrumentation import read_routes
+from models import db
+from response_cache import CACHE_SHARED, last_user_write
+
+logger = logging.getLogger(__name__)
+
+REPLICA_READ_YOUR_WRITES_SECONDS = int(os.environ.get('REPLICA_READ_YOUR_WRITES_SECONDS', 30))
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 10))
+REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', 5))
+
+# Zero when nothing is waiting to be replayed, so an idle primary doesn't read as lag
+REPLICA_LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+_status = {'checked_at': None, 'reason': 'replica_unavailable'}
+_status_lock = threading.Lock()
+
+def replica_lag():
+    """Seconds the replica is behind the primary."""
+    with db.engines[REPLICA_BIND].connect() as conn:
+        return float(conn.execute(REPLICA_LAG_SQL).scalar())
+
+def _check_replica():
+    try:
+        lag = replica_lag()
+    except SQLAlchemyError as e:
+        logger.warning(f"Read replica unavailable, reading from the primary: {str(e)}")
+        return 'replica_unavailable'
+    if lag > REPLICA_MAX_LAG_SECONDS:
+        logger.warning(f"Read replica is {lag:.1f}s behind, reading from the primary")
+        return 'replica_lagging'
+    return None
+
+def replica_problem():
+    """None when the replica can serve reads, else why not. Rechecked every REPLICA_CHECK_SECONDS."""
+    checked_at = _status['checked_at']
+    if checked_at is not None and time.monotonic() - checked_at < REPLICA_CHECK_SECONDS:
+        return _status['reason']
+    # One request rechecks; the others go on with the last result rather than queue behind it
+    if not _status_lock.acquire(blocking=False):
+        return _status['reason']
+    try:
+        _status['reason'] = _check_replica()
+        _status['checked_at'] = time.monotonic()
+    finally:
+        _status_lock.release()
+    return _status['reason']
+
+def _primary_reason(user_id):
+    if not CACHE_SHARED:
+        return 'local_cache'
+    last_write = last_user_write(user_id)
+    if last_write is not None and time.time() - last_write < REPLICA_READ_YOUR_WRITES_SECONDS:
+        return 'recent_write'
+    return replica_problem()
+
+def replica_reads(view):
+    """Run a login-required, read-only view against the replica when it is safe to."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if REPLICA_BIND in db.engines:
+            reason = _primary_reason(current_user.id)
+            if reason is None:
+                g.read_bind = REPLICA_BIND
+                read_routes.inc(target='replica', reason='ok')
+            else:
+                read_routes.inc(target='primary', reason=reason)
+        return view(*args, **kwargs)
+    return wrapper
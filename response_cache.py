@@ -0,0 +1,123 @@
+"""
+Response cache for the day-view endpoints (/get_summaries, /get_dashboard and
+the older /get_heatmap_data, /get_word_cloud_data, /get_dashboard_stats).
+
+Opening a date fetches the summaries and the dashboard, and each recomputes
+from raw rows, even for days that will never change again. Responses are cached
+per (endpoint, user, date, query string) under a version token for the
+user-day. After they commit, writers call invalidate_user_day() with the local
+dates they wrote. That replaces the token, so every cached view of those days
+becomes unreachable at once, and no key listing or pattern delete is needed.
+Past days are kept for CACHE_PAST_DAY_TTL and today for CACHE_TODAY_TTL.
+invalidate_user_days() also records when the user last wrote, which replica.py
+uses to keep that user's reads on the primary until the replica has caught up.
+
+Responses carry an ETag and `Cache-Control: private, no-cache`. The browser
+revalidates every time and gets a 304 with no body while the day is unchanged.
+
+The cache backend comes from CACHE_TYPE (Flask-Caching). The default
+SimpleCache is per process: the batch and archive CLIs and other web dynos
+invalidate their own copy, never the one serving requests. With a per-process
+backend past days are therefore only kept for CACHE_PAST_DAY_TTL (default 300
+seconds), which bounds how stale they can get, and replica.py keeps every read
+on the primary because it cannot see other processes' writes. A shared backend
+such as RedisCache gets the day-long TTL and the replica.
+"""
+import hashlib
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+from functools import wraps
+
+from flask import Response, current_app, make_response, request
+from flask_caching import Cache
+from flask_login import current_user
+
+from models import user_timezone
+
+logger = logging.getLogger(__name__)
+
+cache = Cache()
+
+# Backends every process and dyno sees; SimpleCache and FileSystemCache are not
+SHARED_CACHE_BACKENDS = ('redis', 'memcached')
+CACHE_SHARED = any(name in os.environ.get('CACHE_TYPE', 'SimpleCache').lower() for name in SHARED_CACHE_BACKENDS)
+
+CACHE_PAST_DAY_TTL = int(os.environ.get('CACHE_PAST_DAY_TTL', 86400 if CACHE_SHARED else 300))
+CACHE_TODAY_TTL = int(os.environ.get('CACHE_TODAY_TTL', 60))
+USER_WRITE_TTL = 300
+
+def _version_key(user_id, date_str):
+    return f"dayver:{user_id}:{date_str}"
+
+def day_version(user_id, date_str):
+    version = cache.get(_version_key(user_id, date_str))
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(_version_key(user_id, date_str), version, timeout=0)
+    return version
+
+def _write_key(user_id):
+    return f"wrote:{user_id}"
+
+def last_user_write(user_id):
+    """time.time() of the user's last recorded write in the past USER_WRITE_TTL seconds, or None."""
+    return cache.get(_write_key(user_id))
+
+def warn_if_cache_local(process):
+    """Log that process's invalidations stay in its own cache, for CLIs that write outside the web process."""
+    if not CACHE_SHARED:
+        logger.warning(f"CACHE_TYPE is per-process, so {process} cannot invalidate the web cache; "
+                       f"past days there stay stale for up to {CACHE_PAST_DAY_TTL}s")
+
+def _cache_ready():
+    return cache in current_app.extensions.get('cache', {})
+
+def invalidate_user_days(user_id, dates):
+    """Drop every cached day view of user_id for the given local dates (the user's timezone)."""
+    if not _cache_ready():
+        return
+    for date_str in {day.strftime('%Y-%m-%d') for day in dates if day is not None}:
+        cache.set(_version_key(user_id, date_str), uuid.uuid4().hex, timeout=0)
+    cache.set(_write_key(user_id), time.time(), timeout=USER_WRITE_TTL)
+
+def invalidate_user_day(user_id, day):
+    invalidate_user_days(user_id, [day])
+
+def _timeout(date_str):
+    today = datetime.now(user_timezone(current_user.timezone)).date()
+    try:
+        selected = datetime.strptime(date_str, '%Y-%m-%d').date()
+    except ValueError:
+        return CACHE_TODAY_TTL
+    return CACHE_PAST_DAY_TTL if selected < today else CACHE_TODAY_TTL
+
+def cached_day_view(view):
+    """Cache a login-required view that takes a ?date=YYYY-MM-DD parameter."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        date_str = request.args.get('date')
+        if not date_str:
+            return view(*args, **kwargs)
+
+        user_id = current_user.id
+        query = hashlib.sha1(request.query_string).hexdigest()[:16]
+        key = f"view:{request.endpoint}:{user_id}:{date_str}:{day_version(user_id, date_str)}:{query}"
+
+        cached = cache.get(key)
+        if cached is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            cached = (body, response.mimetype, hashlib.sha1(body).hexdigest())
+            cache.set(key, cached, timeout=_timeout(date_str))
+
+        body, mimetype, etag = cached
+        response = Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
+    return wrapper
@@ -0,0 +1,139 @@
+"""
+Idempotent schema upgrades for existing databases.
+
+db.create_all() only creates missing tables, so columns and indexes added to
+existing tables are applied here. Every statement is safe to re-run. Indexes are
+built CONCURRENTLY so ingest keeps running while they build. Run it before
+starting the app, e.g. as the Heroku release phase:
+
+    python schema.py
+
+Digests for summaries written before digests existed are queued once, with
+python schema.py --backfill-digests.
+"""
+import logging
+import sys
+
+from flask import Flask
+from sqlalchemy import text
+
+from config import Config
+from database import init_database
+from models import db, SEGMENT_SEARCH_VECTOR_FUNCTION, SEGMENT_SEARCH_VECTOR_TRIGGER
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_UPGRADES = [
+    # Full-text search over transcripts and summaries. The segments column is filled by a
+    # trigger and the backfill below; a generated column would rewrite the table under lock.
+    "ALTER TABLE segments ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    # Databases upgraded while the column was generated keep its values as plain data
+    "ALTER TABLE segments ALTER COLUMN search_vector DROP EXPRESSION IF EXISTS",
+    SEGMENT_SEARCH_VECTOR_FUNCTION,
+    SEGMENT_SEARCH_VECTOR_TRIGGER,
+    "ALTER TABLE summaries ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_segments_search_vector ON segments USING gin (search_vector)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_summaries_search_vector ON summaries USING gin (search_vector)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_main_uid ON main (uid)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_segments_main_id ON segments (main_id)",
+    # Compact raw payload storage
+    "ALTER TABLE main ADD COLUMN IF NOT EXISTS raw_format varchar(16)",
+    "ALTER TABLE main ADD COLUMN IF NOT EXISTS raw_blob bytea",
+    # Local day and hour in the user's timezone
+    "ALTER TABLE segments ADD COLUMN IF NOT EXISTS local_date date",
+    "ALTER TABLE segments ADD COLUMN IF NOT EXISTS local_hour smallint",
+    "ALTER TABLE summaries ADD COLUMN IF NOT EXISTS local_date date",
+    "ALTER TABLE summaries ADD COLUMN IF NOT EXISTS local_hour smallint",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_segments_local_date ON segments (local_date)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_summaries_user_local_date ON summaries (user_id, local_date)",
+    # Segments by summary
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_segments_summary_id ON segments (summary_id)",
+]
+
+# (description, statement) pairs re-run until they touch no rows, so large tables
+# are filled in short transactions instead of one long lock
+BACKFILLS = [
+    # Rows written before the trigger existed
+    ("segment search vectors", """
+        UPDATE segments SET search_vector = to_tsvector('english', coalesce(text, ''))
+        WHERE id IN (SELECT id FROM segments WHERE search_vector IS NULL LIMIT :batch_size)
+    """),
+    ("summary search vectors", """
+        UPDATE summaries SET search_vector =
+            setweight(to_tsvector('english', coalesce(headline, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(array_to_string(bullet_points, ' '), '')), 'B')
+        WHERE id IN (SELECT id FROM summaries WHERE search_vector IS NULL LIMIT :batch_size)
+    """),
+    # Local day and hour for rows written before the columns existed. Segments of a uid
+    # without a user account get the default timezone.
+    ("segment local dates", """
+        UPDATE segments s SET
+            local_date = (s.timestamp AT TIME ZONE coalesce(u.timezone, 'US/Pacific'))::date,
+            local_hour = extract(hour FROM s.timestamp AT TIME ZONE coalesce(u.timezone, 'US/Pacific'))
+        FROM main m LEFT JOIN "user" u ON u.uid = m.uid
+        WHERE m.id = s.main_id
+          AND s.id IN (SELECT id FROM segments WHERE local_date IS NULL AND timestamp IS NOT NULL LIMIT :batch_size)
+    """),
+    ("summary local dates", """
+        UPDATE summaries s SET
+            local_date = (s.timestamp AT TIME ZONE coalesce(u.timezone, 'US/Pacific'))::date,
+            local_hour = extract(hour FROM s.timestamp AT TIME ZONE coalesce(u.timezone, 'US/Pacific'))
+        FROM "user" u
+        WHERE u.id = s.user_id
+          AND s.id IN (SELECT id FROM summaries WHERE local_date IS NULL AND timestamp IS NOT NULL LIMIT :batch_size)
+    """),
+]
+
+# Queue digests for summaries written before digests existed; the digest job builds them.
+# Walks one range of summary ids per transaction, and existing rows conflict and are skipped.
+# Writing a summary queues its own digests, so this only needs to run once per database.
+DIGEST_PERIODS_BACKFILL = """
+    INSERT INTO digests (user_id, period, period_start, stale, source_count)
+    SELECT DISTINCT s.user_id, p.period,
+        date_trunc(p.period, s.timestamp AT TIME ZONE coalesce(u.timezone, 'US/Pacific'))
+            AT TIME ZONE coalesce(u.timezone, 'US/Pacific'),
+        true, 0
+    FROM summaries s
+    JOIN "user" u ON u.id = s.user_id
+    CROSS JOIN (VALUES ('hour'), ('day'), ('week')) AS p(period)
+    WHERE s.id > :after_id AND s.id <= :after_id + :batch_size
+    ON CONFLICT ON CONSTRAINT uq_digests_user_period DO NOTHING
+"""
+
+def upgrade_schema(batch_size=5000):
+    """Create missing tables, apply column and index upgrades, then run backfills."""
+    db.create_all()
+
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for statement in SCHEMA_UPGRADES:
+            logger.info(f"Applying schema upgrade: {' '.join(statement.split())[:100]}")
+            conn.execute(text(statement))
+
+        for description, statement in BACKFILLS:
+            total = 0
+            while True:
+                updated = conn.execute(text(statement), {'batch_size': batch_size}).rowcount
+                total += updated
+                if updated < batch_size:
+                    break
+            logger.info(f"Backfilled {total} rows for {description}")
+
+def backfill_digest_periods(batch_size=5000):
+    """Queue the hour, day and week digests of every existing summary. Returns the number queued."""
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        max_id = conn.execute(text("SELECT coalesce(max(id), 0) FROM summaries")).scalar()
+        total = 0
+        for after_id in range(0, max_id, batch_size):
+            total += conn.execute(text(DIGEST_PERIODS_BACKFILL), {'after_id': after_id, 'batch_size': batch_size}).rowcount
+    logger.info(f"Queued {total} digests for existing summaries")
+    return total
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    init_database(app, role='worker')
+    with app.app_context():
+        upgrade_schema()
+        if '--backfill-digests' in sys.argv[1:]:
+            backfill_digest_periods()
@@ -0,0 +1,81 @@
+"""
+Ranked full-text search over a user's transcripts and summaries.
+
+Matches use the GIN-indexed search_vector columns. ts_headline snippets are
+only built for the rows on the requested page, and has_more comes from fetching
+one extra row, so no count() over the full match set is needed.
+"""
+import logging
+
+from sqlalchemy import func
+
+from models import db, Main, Segment, summaries
+
+logger = logging.getLogger(__name__)
+
+HEADLINE_OPTIONS = "MaxWords=30, MinWords=10, MaxFragments=2, StartSel=<mark>, StopSel=</mark>"
+
+def parse_query(query_text):
+    """Parse free-form user input the way web search boxes do (quotes, OR, -exclusions)."""
+    return func.websearch_to_tsquery('english', query_text)
+
+def search_segments(uid, query_text, limit, offset):
+    ts_query = parse_query(query_text)
+    rank = func.ts_rank_cd(Segment.search_vector, ts_query)
+
+    page = db.session.query(
+        Segment.id.label('id'),
+        rank.label('rank')
+    ).join(Main).filter(
+        Main.uid == uid,
+        Segment.search_vector.op('@@')(ts_query)
+    ).order_by(rank.desc(), Segment.timestamp.desc()).limit(limit + 1).offset(offset).subquery()
+
+    rows = db.session.query(
+        Segment,
+        page.c.rank,
+        func.ts_headline('english', Segment.text, ts_query, HEADLINE_OPTIONS).label('snippet')
+    ).join(page, page.c.id == Segment.id).order_by(page.c.rank.desc(), Segment.timestamp.desc()).all()
+
+    results = [{
+        'type': 'transcript',
+        'id': segment.id,
+        'speaker': segment.speaker,
+        'text': segment.text,
+        'snippet': snippet,
+        'summary_id': segment.summary_id,
+        'timestamp': segment.to_dict()['timestamp'],
+        'rank': float(segment_rank),
+    } for segment, segment_rank, snippet in rows]
+    return results[:limit], len(results) > limit
+
+def search_summaries(user_id, query_text, limit, offset):
+    ts_query = parse_query(query_text)
+    rank = func.ts_rank_cd(summaries.search_vector, ts_query)
+
+    page = db.session.query(
+        summaries.id.label('id'),
+        rank.label('rank')
+    ).filter(
+        summaries.user_id == user_id,
+        summaries.search_vector.op('@@')(ts_query)
+    ).order_by(rank.desc(), summaries.timestamp.desc()).limit(limit + 1).offset(offset).subquery()
+
+    bullet_text = func.array_to_string(summaries.bullet_points, ' ')
+    rows = db.session.query(
+        summaries,
+        page.c.rank,
+        func.ts_headline('english', summaries.headline.op('||')(' ').op('||')(bullet_text), ts_query, HEADLINE_OPTIONS).label('snippet')
+    ).join(page, page.c.id == summaries.id).order_by(page.c.rank.desc(), summaries.timestamp.desc()).all()
+
+    results = [{
+        'type': 'summary',
+        'id': summary.id,
+        'headline': summary.headline,
+        'bullet_points': summary.bullet_points,
+        'tag': summary.tag,
+        'snippet': snippet,
+        'timestamp': summary.timestamp.isoformat(),
+        'rank': float(summary_rank),
+    } for summary, summary_rank, snippet in rows]
+    return results[:limit], len(results) > limit
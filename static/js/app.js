@@ -94,7 +94,7 @@ function fetchTranscripts(date, page = 1, hour = null) {
     const loadingIndicator = document.getElementById('loadingIndicator');
     loadingIndicator.classList.remove('hidden');
 
-    let url = `/get_transcripts?date=${date}&page=${page}`;
+    let url = `/get_transcripts?date=${date}&page=${page}&format=turns&per_page=50`;
     if (hour !== null) {
         url += `&hour=${hour}`;
     }
@@ -105,28 +105,9 @@ function fetchTranscripts(date, page = 1, hour = null) {
             const transcriptsList = document.getElementById('transcriptsList');
             transcriptsList.innerHTML = '';
             
-            // Combine segments from the same speaker
-            let combinedSegments = [];
-            let currentSpeaker = null;
-            let currentSegment = null;
-
-            data.segments.forEach(segment => {
-                if (segment.speaker !== currentSpeaker) {
-                    if (currentSegment) {
-                        combinedSegments.push(currentSegment);
-                    }
-                    currentSpeaker = segment.speaker;
-                    currentSegment = { ...segment };
-                } else {
-                    currentSegment.text += ' ' + segment.text;
-                }
-            });
-            if (currentSegment) {
-                combinedSegments.push(currentSegment);
-            }
-
-            combinedSegments.forEach(segment => {
-                const segmentElement = createSegmentElement(segment);
+            // The server merges consecutive segments from the same speaker into turns
+            data.turns.forEach(turn => {
+                const segmentElement = createSegmentElement(turn);
                 transcriptsList.appendChild(segmentElement);
             });
 
@@ -167,18 +148,17 @@ function fetchSummaries(page, date) {
 }
 
 function fetchDashboardData(date) {
-    Promise.all([
-        fetch(`/get_heatmap_data?date=${date}`).then(response => response.json()),
-        fetch(`/get_word_cloud_data?date=${date}`).then(response => response.json()),
-        fetch(`/get_dashboard_stats?date=${date}`).then(response => response.json())
-    ]).then(([heatmapData, wordCloudData, dashboardStats]) => {
-        renderHeatmap(heatmapData);
-        renderWordCloud(wordCloudData);
-        renderDashboardStats(dashboardStats);
-    }).catch(error => {
-        console.error('Error fetching dashboard data:', error);
-        // Handle the error appropriately, e.g., display an error message to the user
-    });
+    fetch(`/get_dashboard?date=${date}`)
+        .then(response => response.json())
+        .then(data => {
+            renderHeatmap(data.heatmap);
+            renderWordCloud(data.word_cloud);
+            renderDashboardStats(data.stats);
+        })
+        .catch(error => {
+            console.error('Error fetching dashboard data:', error);
+            // Handle the error appropriately, e.g., display an error message to the user
+        });
 }
 
 function addMessage(data) {
@@ -556,6 +536,77 @@ function renderSummaries(summaries) {
     setupTranscriptViewers();
 }
 
+function getStreamingSummaryElement(streamId, timestamp) {
+    const summariesList = document.getElementById('summariesList');
+    if (!summariesList) {
+        return null;
+    }
+
+    let summaryItem = document.getElementById(`streaming-summary-${streamId}`);
+    if (!summaryItem) {
+        summaryItem = document.createElement('div');
+        summaryItem.id = `streaming-summary-${streamId}`;
+        summaryItem.className = 'bg-white rounded-lg shadow-md p-4 mb-4 relative group opacity-75';
+        summaryItem.innerHTML = `
+            <div class="flex items-center justify-between mb-2">
+                <h3 class="text-lg font-semibold streaming-headline"></h3>
+                <span class="px-3 py-1 bg-gray-100 text-gray-600 text-xs font-semibold rounded-full uppercase">
+                    <i class="fas fa-spinner fa-spin mr-1"></i> Summarizing
+                </span>
+            </div>
+            <p class="text-gray-500 text-sm mb-2">${dayjs(timestamp).format('MMMM D, YYYY h:mm A')}</p>
+            <ul class="list-disc pl-5 text-gray-700 streaming-bullets"></ul>
+        `;
+        summariesList.prepend(summaryItem);
+    }
+    return summaryItem;
+}
+
+function updateStreamingSummary(data) {
+    const summaryItem = getStreamingSummaryElement(data.stream_id, data.timestamp);
+    if (!summaryItem) {
+        return;
+    }
+
+    if (data.reset) {
+        // The summarizer switched providers mid-stream and is starting over
+        summaryItem.querySelector('.streaming-headline').textContent = '';
+        summaryItem.querySelector('.streaming-bullets').innerHTML = '';
+    }
+    if (data.headline !== undefined) {
+        summaryItem.querySelector('.streaming-headline').textContent = data.headline;
+    }
+    if (data.bullet !== undefined) {
+        const bulletItem = document.createElement('li');
+        bulletItem.textContent = data.bullet;
+        summaryItem.querySelector('.streaming-bullets').appendChild(bulletItem);
+    }
+}
+
+function completeStreamingSummary(summary) {
+    removeStreamingSummary(summary.stream_id);
+
+    const summariesList = document.getElementById('summariesList');
+    if (!summariesList) {
+        return;
+    }
+
+    // Render the persisted row with the same markup as the rest of the list
+    const existingItems = Array.from(summariesList.children);
+    renderSummaries([summary]);
+    const completedItem = summariesList.firstElementChild;
+    summariesList.innerHTML = '';
+    summariesList.appendChild(completedItem);
+    existingItems.forEach(item => summariesList.appendChild(item));
+}
+
+function removeStreamingSummary(streamId) {
+    const summaryItem = document.getElementById(`streaming-summary-${streamId}`);
+    if (summaryItem) {
+        summaryItem.remove();
+    }
+}
+
 function initializeFlatpickr() {
     flatpickr("#calendar", {
         inline: true,
@@ -665,6 +716,19 @@ document.addEventListener('DOMContentLoaded', function() {
         return false;
     });
 
+    // Summaries stream in while the model is still writing them
+    socket.on('summary_progress', (data) => {
+        updateStreamingSummary(data);
+    });
+
+    socket.on('summary_complete', (data) => {
+        completeStreamingSummary(data);
+    });
+
+    socket.on('summary_discarded', (data) => {
+        removeStreamingSummary(data.stream_id);
+    });
+
     initializeApp();
 
     // Event listeners
@@ -989,7 +1053,7 @@ function fetchAndDisplayTranscripts(summaryId) {
     modalContent.innerHTML = '<p class="text-center">Loading transcripts...</p>';
     modal.classList.remove('hidden');
 
-    fetch(`/get_summary_transcripts/${summaryId}`)
+    fetch(`/get_summary_segments/${summaryId}`)
         .then(response => response.json())
         .then(data => {
             if (data.error) {
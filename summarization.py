@@ -3,19 +3,25 @@ from langchain_openai import ChatOpenAI
 from langchain.chat_models.base import BaseChatModel
 from langchain.prompts import ChatPromptTemplate
 from langchain.output_parsers import PydanticOutputParser
+from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from config import Config
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Callable, List, Optional
 import logging
 import os
 from datetime import datetime, timezone
 import pytz
 from sqlalchemy import text
 from models import summaries as SummaryModel
+from llm_router import LLMRouter
+from fake_llm import get_fake_llm
+from instrumentation import LLMUsageCallback
+from rate_limiter import RateLimited, RateLimitCallback, limiter_for
+from text_processing import estimate_tokens
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'DEBUG').upper())
 logger = logging.getLogger(__name__)
 
 CATEGORIES = [
@@ -42,7 +48,7 @@ Categories for classification:
 {categories}
 </categories>
 
-Conversation fragments:
+Conversation fragments (each line is one speaker turn, prefixed with a short speaker tag such as S0; tags tell speakers apart but are not names):
 <conversation_fragments>
 {text}
 </conversation_fragments>
@@ -120,6 +126,32 @@ If no factual errors are found, return:
 ```
 """
 
+DIGEST_PROMPT = """
+Current date and time: {current_datetime}
+
+Below are summaries of {user}'s conversations during one {period}, each marked with the {unit} it covers.
+
+<summaries>
+{text}
+</summaries>
+
+Write a digest of this {period}:
+1. Start the headline with an emoji that fits the {period} overall, then a 5-10 word headline in headline capitalization.
+2. Write bullet points for the main threads of the {period}, merging summaries that cover the same topic. Keep names, numbers, decisions and follow-ups exactly as stated.
+3. Leave out minor or one-off items. Use at most {max_bullets} bullet points.
+
+Provide the digest in the following JSON format:
+```json
+{{
+    "headline": "[Emoji] [Your headline here]",
+    "bullet_points": [
+        "[Thread 1]",
+        "[Thread 2]"
+    ]
+}}
+```
+"""
+
 class PartialSummary(BaseModel):
     headline: str = Field(..., description="The headline of the summary")
     bullet_points: List[str] = Field(..., description="List of key points in the summary")
@@ -134,44 +166,151 @@ class Summary(BaseModel):
     tag: Optional[str] = Field(None, description="One-word tag for the summary")
     fact_checker: Optional[List[str]] = Field(None, description="List of incorrect or fake facts found in the conversation")
 
+class Digest(BaseModel):
+    headline: str = Field(..., description="The headline of the digest")
+    bullet_points: List[str] = Field(..., description="Main threads of the period")
+
+# Model behind each provider; rate limits are tracked per provider and model
+LLM_MODELS = {
+    'anthropic': 'claude-3-5-sonnet-20240620',
+    'openai': 'gpt-4o',
+    'fake': 'fake',
+}
+
+# Completion tokens reserved per call in the tokens-per-minute bucket; provider headers correct the estimate
+LLM_COMPLETION_TOKENS = int(os.environ.get('LLM_COMPLETION_TOKENS', 1000))
+
 def get_llm(model_name: str) -> BaseChatModel:
     if model_name == "anthropic":
         return ChatAnthropic(
-            model="claude-3-5-sonnet-20240620",
+            model=LLM_MODELS['anthropic'],
             anthropic_api_key=os.environ['ANTHROPIC_API_KEY'],
             max_tokens=3000,
             temperature=0.5
         )
     elif model_name == "openai":
         return ChatOpenAI(
-            model="gpt-4o",
+            model=LLM_MODELS['openai'],
             #model="gpt-4o-mini",
             openai_api_key=os.environ['OPENAI_API_KEY'],
             max_tokens=2000,
-            temperature=0.5
+            temperature=0.5,
+            stream_usage=True,
+            # Rate-limit headers for rate_limiter; the Anthropic client doesn't expose them
+            include_response_headers=True
         )
+    elif model_name == "fake":
+        # Offline stand-in for benchmarks and local runs without API keys
+        return get_fake_llm()
     else:
         raise ValueError(f"Unsupported model: {model_name}")
 
 # Update these variables to easily switch models
-SUMMARY_MODEL = "openai"
-FACT_CHECK_MODEL = "openai"
+SUMMARY_MODEL = os.environ.get('SUMMARY_MODEL', 'openai')
+FACT_CHECK_MODEL = os.environ.get('FACT_CHECK_MODEL', 'openai')
+
+# Providers the router may fail over to, in preference order after the configured model
+LLM_PROVIDER_KEYS = {
+    'openai': 'OPENAI_API_KEY',
+    'anthropic': 'ANTHROPIC_API_KEY',
+}
+LLM_PROVIDERS = [provider for provider, key in LLM_PROVIDER_KEYS.items() if os.environ.get(key)]
+
+# Hedge slow requests by racing a second provider once the first passes its p95 latency
+LLM_HEDGE_REQUESTS = os.environ.get('LLM_HEDGE_REQUESTS', 'false').lower() == 'true'
+LLM_HEDGE_DELAY = float(os.environ['LLM_HEDGE_DELAY']) if os.environ.get('LLM_HEDGE_DELAY') else None
+
+def provider_limiter(provider):
+    return limiter_for(provider, LLM_MODELS.get(provider, provider))
+
+llm_router = LLMRouter(LLM_PROVIDERS or [SUMMARY_MODEL], hedge=LLM_HEDGE_REQUESTS, hedge_delay=LLM_HEDGE_DELAY,
+                       limiter=provider_limiter)
+
+def llm_callbacks(provider, purpose):
+    return [LLMUsageCallback(provider, purpose), RateLimitCallback(provider_limiter(provider))]
+
+def call_tokens(prompt, text):
+    """Estimated tokens for one call, as the provider counts them against its per-minute quota."""
+    return estimate_tokens(prompt) + estimate_tokens(text) + LLM_COMPLETION_TOKENS
+
+# Stream the summary completion and publish the headline and bullets as they arrive
+STREAM_SUMMARIES = os.environ.get('STREAM_SUMMARIES', 'true').lower() == 'true'
 
 def generate_summary_part(text: str) -> PartialSummary:
-    llm = get_llm(SUMMARY_MODEL)
     summary_prompt = ChatPromptTemplate.from_messages([("human", SUMMARY_PROMPT)])
-    summary_chain = summary_prompt | llm | PydanticOutputParser(pydantic_object=PartialSummary)
     pacific_tz = pytz.timezone('US/Pacific')
     current_datetime = datetime.now(pacific_tz).strftime("%Y-%m-%d %H:%M:%S %Z")
-    return summary_chain.invoke({"categories": FORMATTED_CATEGORIES, "text": text, "current_datetime": current_datetime})
+
+    def call(provider):
+        summary_chain = summary_prompt | get_llm(provider) | PydanticOutputParser(pydantic_object=PartialSummary)
+        return summary_chain.invoke({"categories": FORMATTED_CATEGORIES, "text": text, "current_datetime": current_datetime},
+                                    config={"callbacks": llm_callbacks(provider, 'summary')})
+
+    return llm_router.invoke(SUMMARY_MODEL, call, tokens=call_tokens(SUMMARY_PROMPT, text))
+
+def stream_summary_part(text: str, on_partial: Callable[[dict], None]) -> PartialSummary:
+    """
+    Stream the summary completion and call on_partial with each completed field.
+
+    The incremental JSON parser yields the partial object after every chunk. A field
+    is only published once the model has moved past it: the headline when the
+    bullet_points key appears, and each bullet when the next one starts or the list closes.
+    If a provider fails mid-stream the router retries on the next one, and a reset
+    event tells the live view to drop what it has shown so far.
+    """
+    summary_prompt = ChatPromptTemplate.from_messages([("human", SUMMARY_PROMPT)])
+    pacific_tz = pytz.timezone('US/Pacific')
+    current_datetime = datetime.now(pacific_tz).strftime("%Y-%m-%d %H:%M:%S %Z")
+    attempts = []
+
+    def call(provider):
+        if attempts:
+            on_partial({'reset': True})
+        attempts.append(provider)
+        summary_chain = summary_prompt | get_llm(provider) | JsonOutputParser(pydantic_object=PartialSummary)
+
+        partial = {}
+        headline_sent = False
+        bullets_sent = 0
+        stream = summary_chain.stream({"categories": FORMATTED_CATEGORIES, "text": text, "current_datetime": current_datetime},
+                                      config={"callbacks": llm_callbacks(provider, 'summary')})
+        for partial in stream:
+            if not isinstance(partial, dict):
+                continue
+            headline = partial.get('headline')
+            if headline == "INSUFFICIENT_CONTEXT":
+                continue
+            if not headline_sent and headline and 'bullet_points' in partial:
+                on_partial({'headline': headline})
+                headline_sent = True
+            bullets = partial.get('bullet_points') or []
+            completed = len(bullets) if 'tag' in partial else len(bullets) - 1
+            while headline_sent and bullets_sent < completed:
+                on_partial({'bullet_index': bullets_sent, 'bullet': bullets[bullets_sent]})
+                bullets_sent += 1
+
+        summary_part = PartialSummary(**partial)
+        if summary_part.headline != "INSUFFICIENT_CONTEXT":
+            if not headline_sent:
+                on_partial({'headline': summary_part.headline})
+            for index in range(bullets_sent, len(summary_part.bullet_points)):
+                on_partial({'bullet_index': index, 'bullet': summary_part.bullet_points[index]})
+        return summary_part
+
+    # Hedging would interleave two streams in the live view, so streamed calls only fail over
+    return llm_router.invoke(SUMMARY_MODEL, call, hedge=False, tokens=call_tokens(SUMMARY_PROMPT, text))
 
 def generate_fact_check_part(text: str) -> FactCheck:
-    llm = get_llm(FACT_CHECK_MODEL)
     fact_check_prompt = ChatPromptTemplate.from_messages([("human", FACT_CHECK_PROMPT)])
-    fact_check_chain = fact_check_prompt | llm | PydanticOutputParser(pydantic_object=FactCheck)
     pacific_tz = pytz.timezone('US/Pacific')
     current_datetime = datetime.now(pacific_tz).strftime("%Y-%m-%d %H:%M:%S %Z")
-    return fact_check_chain.invoke({"text": text, "current_datetime": current_datetime})
+
+    def call(provider):
+        fact_check_chain = fact_check_prompt | get_llm(provider) | PydanticOutputParser(pydantic_object=FactCheck)
+        return fact_check_chain.invoke({"text": text, "current_datetime": current_datetime},
+                                       config={"callbacks": llm_callbacks(provider, 'fact_check')})
+
+    return llm_router.invoke(FACT_CHECK_MODEL, call, tokens=call_tokens(FACT_CHECK_PROMPT, text))
 
 def combine_results(summary_part: PartialSummary, fact_check_part: FactCheck) -> Summary:
     return Summary(
@@ -181,11 +320,21 @@ def combine_results(summary_part: PartialSummary, fact_check_part: FactCheck) ->
         fact_checker=fact_check_part.fact_checks
     )
 
-def generate_summary(text: str, session, user_id: int, first_segment_timestamp: datetime) -> Optional[Summary]:
+def generate_summary(text: str, on_partial: Optional[Callable[[dict], None]] = None) -> Optional[Summary]:
+    """
+    Generate the summary and fact check for a chunk of text.
+
+    When on_partial is given and STREAM_SUMMARIES is enabled, the headline and bullets
+    are passed to it as they stream in. Persisting the summaries row is left to the caller.
+    RateLimited is re-raised so the caller can retry later rather than count a failed attempt.
+    """
     logger.debug(f"Starting generate_summary for text of length: {len(text)}")
     try:
         logger.debug("Generating summary part")
-        summary_part = generate_summary_part(text)
+        if on_partial and STREAM_SUMMARIES:
+            summary_part = stream_summary_part(text, on_partial)
+        else:
+            summary_part = generate_summary_part(text)
         
         if summary_part.headline == "INSUFFICIENT_CONTEXT":
             logger.debug("Insufficient context detected, returning None")
@@ -200,28 +349,27 @@ def generate_summary(text: str, session, user_id: int, first_segment_timestamp:
         result = combine_results(summary_part, fact_check_part)
         logger.debug(f"Combined result: {result}")
         
-        # Remove or comment out the reset_sequence call
-        # reset_sequence(session, 'summaries', start_from=2000)
-        
-        # Create a new SummaryModel instance
-        new_summary = SummaryModel(
-            user_id=user_id,
-            headline=result.headline,
-            bullet_points=result.bullet_points,
-            tag=result.tag,
-            fact_checker=result.fact_checker,
-            timestamp=first_segment_timestamp  # Use the timestamp of the first segment
-        )
-        
-        session.add(new_summary)
-        session.flush()
-        # No need to commit here, as it's handled in the calling function
-        
         return result
+    except RateLimited:
+        raise
     except Exception as e:
         logger.error(f"Unexpected error in generate_summary: {str(e)}", exc_info=True)
         return None
 
+def generate_digest(text: str, period: str, unit: str, user: str, max_bullets: int = 8) -> Digest:
+    """Reduce lower-level summaries (one per line, prefixed with their hour or day) into a digest."""
+    digest_prompt = ChatPromptTemplate.from_messages([("human", DIGEST_PROMPT)])
+    pacific_tz = pytz.timezone('US/Pacific')
+    current_datetime = datetime.now(pacific_tz).strftime("%Y-%m-%d %H:%M:%S %Z")
+
+    def call(provider):
+        digest_chain = digest_prompt | get_llm(provider) | PydanticOutputParser(pydantic_object=Digest)
+        return digest_chain.invoke({"text": text, "period": period, "unit": unit, "max_bullets": max_bullets,
+                                    "user": user, "current_datetime": current_datetime},
+                                   config={"callbacks": llm_callbacks(provider, 'digest')})
+
+    return llm_router.invoke(SUMMARY_MODEL, call, tokens=call_tokens(DIGEST_PROMPT, text))
+
 def reset_sequence(session, table_name, id_column='id', start_from=2000):
     """Reset the auto-incrementing sequence for a given table."""
     conn = session.connection()
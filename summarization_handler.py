@@ -1,18 +1,61 @@
 import emoji
 from datetime import datetime, timedelta
 import pytz
-from models import db, temp_segments, Segment, summaries, User
+from models import temp_segments, Segment, summaries, User
+from database import worker_binding, worker_session
+from fair_scheduler import FairScheduler
 from summarization import generate_summary
+from rate_limiter import RateLimited
+from related import sync_user_index
+from response_cache import invalidate_user_day
 import traceback
 from sqlalchemy import func
 import logging
 import os
 import requests
-from sqlalchemy.orm import sessionmaker
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from flask import current_app
+from instrumentation import span, chunk_segments, chunk_chars, chunk_tokens, chunk_reduction, chunks_processed
+from text_processing import compact_transcript
 from sqlalchemy.exc import SQLAlchemyError
 
 logger = logging.getLogger(__name__)
 
+# Number of users whose backlogs are summarized in parallel
+SUMMARIZATION_CONCURRENCY = int(os.environ.get('SUMMARIZATION_CONCURRENCY', 1))
+
+# Merge fragments into speaker turns and drop filler before summarizing
+COMPACT_TRANSCRIPTS = os.environ.get('COMPACT_TRANSCRIPTS', 'true').lower() == 'true'
+TRANSCRIPT_TOKEN_BUDGET = int(os.environ.get('TRANSCRIPT_TOKEN_BUDGET', 6000))
+
+# Length of the transcript window behind each summary
+CHUNK_SIZE_MINUTES = 10
+
+# Batch jobs claim backlog segments by setting processed_at; claims older than this are
+# handed back to the scheduler, covering jobs that were abandoned or crashed before applying
+BATCH_CLAIM_TTL_HOURS = int(os.environ.get('BATCH_CLAIM_TTL_HOURS', 48))
+
+# Rate-limited chunks in a row, with no success between them, before a run gives up until the next one
+SUMMARIZATION_RATE_LIMIT_STREAK = int(os.environ.get('SUMMARIZATION_RATE_LIMIT_STREAK', 5))
+
+# Callable(user_id, event, data) used to push summary progress to the user's live view.
+# Processes that run the summarizer set it to notifications.notify_summary_event;
+# summaries are still persisted when it is not set.
+summary_publisher = None
+
+def set_summary_publisher(publisher):
+    global summary_publisher
+    summary_publisher = publisher
+
+def publish_summary_event(user_id, event, data):
+    if summary_publisher is None:
+        return
+    try:
+        summary_publisher(user_id, event, data)
+    except Exception as e:
+        logger.warning(f"Failed to publish {event} for User {user_id}: {str(e)}")
+
 def increment_processing_attempts(session, segments):
     for seg in segments:
         seg.processing_attempts += 1
@@ -30,15 +73,16 @@ def remove_exceeded_attempts_segments(session, segments, max_attempts=3):
 
 def process_segments_for_summary(user_id, start_time, end_time):
     logger.info(f"Processing segments for User {user_id} from {start_time} to {end_time}")
-    Session = sessionmaker(bind=db.engine)
-    session = Session()
+    stream_id = uuid.uuid4().hex
+    session = worker_session()
     try:
-        segments_to_process = session.query(temp_segments).filter(
-            temp_segments.user_id == user_id,
-            temp_segments.processed_at.is_(None),
-            temp_segments.timestamp >= start_time,
-            temp_segments.timestamp < end_time
-        ).order_by(temp_segments.timestamp.asc()).all()
+        with span('summarize.fetch'):
+            segments_to_process = session.query(temp_segments).filter(
+                temp_segments.user_id == user_id,
+                temp_segments.processed_at.is_(None),
+                temp_segments.timestamp >= start_time,
+                temp_segments.timestamp < end_time
+            ).order_by(temp_segments.timestamp.asc()).all()
 
         logger.info(f"Found {len(segments_to_process)} segments to process for User {user_id}")
 
@@ -47,42 +91,84 @@ def process_segments_for_summary(user_id, start_time, end_time):
             return "no_segments", None
 
         total_text = " ".join([seg.text for seg in segments_to_process])
+        chunk_segments.observe(len(segments_to_process))
+        chunk_chars.observe(len(total_text))
+
+        if COMPACT_TRANSCRIPTS:
+            compacted = compact_transcript([(seg.speaker, seg.text) for seg in segments_to_process],
+                                           token_budget=TRANSCRIPT_TOKEN_BUDGET)
+            chunk_tokens.observe(compacted.original_tokens, stage='raw')
+            chunk_tokens.observe(compacted.compacted_tokens, stage='compacted')
+            chunk_reduction.observe(compacted.reduction_ratio)
+            logger.info(f"Compacted transcript for User {user_id} from {compacted.original_tokens} to "
+                        f"{compacted.compacted_tokens} tokens ({compacted.reduction_ratio:.0%} smaller, "
+                        f"{compacted.dropped_fragments} fragments and {compacted.dropped_turns} turns dropped)")
+            total_text = compacted.text
 
         if len(total_text.strip()) < 50:
             logger.info(f"Text too short for summarization: {total_text}")
             return "insufficient_context", None
 
         logger.info(f"Generating summary for User {user_id}")
-        summary = generate_summary(total_text, session, user_id, segments_to_process[0].timestamp)
+        first_timestamp = segments_to_process[0].timestamp
+
+        def on_partial(data):
+            publish_summary_event(user_id, 'summary_progress', {
+                'stream_id': stream_id,
+                'timestamp': first_timestamp.isoformat(),
+                **data
+            })
+
+        with span('summarize.llm'):
+            summary = generate_summary(total_text, on_partial=on_partial)
 
         if summary:
             logger.info(f"Summary generated for User {user_id}. Creating database entry.")
-            new_summary = summaries(
-                user_id=user_id,
-                headline=summary.headline,
-                bullet_points=summary.bullet_points,
-                tag=summary.tag,
-                fact_checker=summary.fact_checker,
-                timestamp=segments_to_process[0].timestamp,
-                created_at=datetime.utcnow()
-            )
-            session.add(new_summary)
-            session.flush()
-            logger.info(f"New summary added with ID: {new_summary.id}")
-
-            segment_ids = [seg.segment_id for seg in segments_to_process]
-            update_result = session.query(Segment).filter(Segment.id.in_(segment_ids)).update({
-                Segment.processed: True,
-                Segment.summary_id: new_summary.id
-            }, synchronize_session=False)
-            logger.info(f"Updated {update_result} Segment records")
+            with span('summarize.persist'):
+                new_summary = summaries(
+                    user_id=user_id,
+                    headline=summary.headline,
+                    bullet_points=summary.bullet_points,
+                    tag=summary.tag,
+                    fact_checker=summary.fact_checker,
+                    timestamp=segments_to_process[0].timestamp,
+                    created_at=datetime.utcnow()
+                )
+                session.add(new_summary)
+                session.flush()
+                logger.info(f"New summary added with ID: {new_summary.id}")
 
-            delete_result = session.query(temp_segments).filter(temp_segments.segment_id.in_(segment_ids)).delete(synchronize_session=False)
-            logger.info(f"Deleted {delete_result} temp_segments records")
+                segment_ids = [seg.segment_id for seg in segments_to_process]
+                update_result = session.query(Segment).filter(Segment.id.in_(segment_ids)).update({
+                    Segment.processed: True,
+                    Segment.summary_id: new_summary.id
+                }, synchronize_session=False)
+                logger.info(f"Updated {update_result} Segment records")
 
-            logger.info("Committing changes to database")
-            session.commit()
-            logger.info(f"Successfully created summary for User {user_id}")
+                delete_result = session.query(temp_segments).filter(temp_segments.segment_id.in_(segment_ids)).delete(synchronize_session=False)
+                logger.info(f"Deleted {delete_result} temp_segments records")
+
+                logger.info("Committing changes to database")
+                summary_day = new_summary.local_date
+                session.commit()
+                logger.info(f"Successfully created summary for User {user_id}")
+            invalidate_user_day(user_id, summary_day)
+
+            publish_summary_event(user_id, 'summary_complete', {
+                'stream_id': stream_id,
+                'id': new_summary.id,
+                'headline': new_summary.headline,
+                'bullet_points': new_summary.bullet_points,
+                'tag': new_summary.tag,
+                'fact_checker': new_summary.fact_checker,
+                'timestamp': new_summary.timestamp.isoformat()
+            })
+
+            try:
+                sync_user_index(user_id)
+            except Exception as e:
+                # The index catches up on the next sync, so this never fails the summary
+                logger.warning(f"Failed to update related index for User {user_id}: {str(e)}")
 
             user = session.query(User).get(user_id)
             if user and user.email:
@@ -97,12 +183,20 @@ def process_segments_for_summary(user_id, start_time, end_time):
             return "success", new_summary.id
         else:
             logger.info(f"No summary generated for User {user_id}")
+            publish_summary_event(user_id, 'summary_discarded', {'stream_id': stream_id})
             return "insufficient_context", None
 
+    except RateLimited as e:
+        # Not the chunk's fault: leave it for a later run without spending an attempt
+        logger.warning(f"LLM rate limited while summarizing for User {user_id}, will retry later: {str(e)}")
+        session.rollback()
+        publish_summary_event(user_id, 'summary_discarded', {'stream_id': stream_id})
+        return "rate_limited", None
     except Exception as e:
         logger.error(f"Error during summary creation for User {user_id}: {str(e)}")
         logger.error(traceback.format_exc())
         session.rollback()
+        publish_summary_event(user_id, 'summary_discarded', {'stream_id': stream_id})
         return "error", None
     finally:
         session.close()
@@ -169,7 +263,7 @@ def send_to_reflect(summary, email):
 
 def cleanup_locked_segments():
     logger.info("Starting cleanup of locked segments")
-    with db.session() as session:
+    with worker_session() as session:
         try:
             lock_expiry = datetime.utcnow() - timedelta(minutes=30)
             updated = session.query(temp_segments).filter(
@@ -181,73 +275,139 @@ def cleanup_locked_segments():
             }, synchronize_session=False)
             session.commit()
             logger.info(f"Cleaned up {updated} old locked segments")
+
+            claim_expiry = datetime.now(pytz.UTC) - timedelta(hours=BATCH_CLAIM_TTL_HOURS)
+            released = session.query(temp_segments).filter(
+                temp_segments.processed_at < claim_expiry
+            ).update({
+                'processed_at': None,
+                'processing_attempts': temp_segments.processing_attempts + 1
+            }, synchronize_session=False)
+            session.commit()
+            if released:
+                logger.warning(f"Released {released} segments claimed by batch jobs more than {BATCH_CLAIM_TTL_HOURS}h ago")
         except Exception as e:
             logger.error(f"Error cleaning up locked segments: {str(e)}")
             logger.error(traceback.format_exc())
             session.rollback()
 
-def process_user_segments_in_chunks(user_id, chunk_size_minutes=10, max_attempts=3):
-    Session = sessionmaker(bind=db.engine)
-    with Session() as session:
+def process_user_chunk(user_id, current_start, chunk_size_minutes=CHUNK_SIZE_MINUTES, max_attempts=3):
+    """
+    Summarize one chunk_size_minutes window of a user's backlog starting at current_start.
+    Returns (status, start of the user's next chunk or None when nothing is left after this one).
+    A rate-limited chunk doesn't count as an attempt and is returned as the next chunk to retry.
+    """
+    current_end = current_start + timedelta(minutes=chunk_size_minutes)
+    with span('summarize.chunk'):
+        status, summary_id = process_segments_for_summary(user_id, current_start, current_end)
+    chunks_processed.inc(status=status)
+    if status == "rate_limited":
+        return status, current_start
+
+    with worker_session() as session:
         try:
-            earliest_segment = session.query(temp_segments).filter(
-                temp_segments.user_id == user_id,
-                temp_segments.processed_at.is_(None)
-            ).order_by(temp_segments.timestamp.asc()).first()
-
-            if not earliest_segment:
-                logger.info(f"No unprocessed segments for User {user_id}")
-                return
-
-            current_start = earliest_segment.timestamp
-            while True:
-                current_end = current_start + timedelta(minutes=chunk_size_minutes)
-                
-                status, summary_id = process_segments_for_summary(user_id, current_start, current_end)
-                
-                if status in ["insufficient_context", "no_segments", "error"]:
-                    # Increment processing attempts for these segments
-                    segments_to_update = session.query(temp_segments).filter(
-                        temp_segments.user_id == user_id,
-                        temp_segments.timestamp >= current_start,
-                        temp_segments.timestamp < current_end
-                    ).all()
-                    
-                    for segment in segments_to_update:
-                        segment.processing_attempts += 1
-                        if segment.processing_attempts >= max_attempts:
-                            session.delete(segment)
-                        else:
-                            session.add(segment)
-                    
-                    session.commit()
-                    logger.info(f"Incremented processing attempts for segments of User {user_id} from {current_start} to {current_end}")
-                
-                # Move to the next chunk
-                current_start = current_end
-                
-                # Check if there are more segments to process
-                next_segment = session.query(temp_segments).filter(
+            if status in ["insufficient_context", "no_segments", "error"]:
+                # Increment processing attempts for these segments; rows claimed by a batch job aren't ours
+                segments_to_update = session.query(temp_segments).filter(
                     temp_segments.user_id == user_id,
-                    temp_segments.timestamp >= current_end,
+                    temp_segments.timestamp >= current_start,
+                    temp_segments.timestamp < current_end,
                     temp_segments.processed_at.is_(None)
-                ).first()
-                
-                if not next_segment:
-                    break  # No more segments to process
+                ).all()
+
+                for segment in segments_to_update:
+                    segment.processing_attempts += 1
+                    if segment.processing_attempts >= max_attempts:
+                        session.delete(segment)
+                    else:
+                        session.add(segment)
+
+                session.commit()
+                logger.info(f"Incremented processing attempts for segments of User {user_id} from {current_start} to {current_end}")
+
+            # Check if there are more segments to process
+            next_segment = session.query(temp_segments).filter(
+                temp_segments.user_id == user_id,
+                temp_segments.timestamp >= current_end,
+                temp_segments.processed_at.is_(None)
+            ).first()
+            return status, current_end if next_segment else None
 
         except SQLAlchemyError as e:
             logger.error(f"Database error processing segments for User {user_id}: {str(e)}")
             session.rollback()
-        except Exception as e:
-            logger.error(f"Error processing segments for User {user_id}: {str(e)}")
-            logger.error(traceback.format_exc())
+            return "error", None
 
-def summarization_task():
+def process_user_segments_in_chunks(user_id, chunk_size_minutes=CHUNK_SIZE_MINUTES, max_attempts=3):
+    """Drain one user's whole backlog, oldest chunk first."""
+    with worker_session() as session:
+        current_start = session.query(func.min(temp_segments.timestamp)).filter(
+            temp_segments.user_id == user_id,
+            temp_segments.processed_at.is_(None)
+        ).scalar()
+    if current_start is None:
+        logger.info(f"No unprocessed segments for User {user_id}")
+        return
+    try:
+        while current_start is not None:
+            status, current_start = process_user_chunk(user_id, current_start, chunk_size_minutes, max_attempts)
+            if status == "rate_limited":
+                logger.warning(f"LLM rate limited; leaving the rest of User {user_id}'s backlog for the next run")
+                break
+    except Exception as e:
+        logger.error(f"Error processing segments for User {user_id}: {str(e)}")
+        logger.error(traceback.format_exc())
+
+def summarization_task(max_workers=None):
+    """Summarize every user's backlog, interleaving chunks across users (see fair_scheduler.py)."""
     logger.info("Starting Summarization Task")
-    users = User.query.all()
+    max_workers = max_workers or SUMMARIZATION_CONCURRENCY
+    scheduler = FairScheduler()
+    with worker_session() as session:
+        scheduler.scan(session)
+
+    app = current_app._get_current_object()
+
+    def run_chunk(user_id, start):
+        with app.app_context(), worker_binding():
+            return process_user_chunk(user_id, start)
+
+    running = {}
+    # The limiter already slows calls down after a 429; a streak of them means the quota is spent for now
+    rate_limit_streak = 0
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='summarizer') as executor:
+        while True:
+            while len(running) < max_workers and rate_limit_streak < SUMMARIZATION_RATE_LIMIT_STREAK:
+                chunk = scheduler.next_chunk()
+                if chunk is None:
+                    break
+                user_id, start, _ = chunk
+                running[executor.submit(run_chunk, user_id, start)] = (user_id, start)
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                user_id, start = running.pop(future)
+                try:
+                    status, next_start = future.result()
+                    if status != "rate_limited":
+                        rate_limit_streak = 0
+                    else:
+                        rate_limit_streak += 1
+                        if rate_limit_streak == SUMMARIZATION_RATE_LIMIT_STREAK:
+                            logger.warning(f"{rate_limit_streak} chunks in a row were rate limited; "
+                                           f"leaving the rest of the backlog for the next run")
+                except Exception as e:
+                    logger.error(f"Error processing segments for User {user_id}: {str(e)}")
+                    logger.error(traceback.format_exc())
+                    next_start = None
+                scheduler.complete(user_id, next_start, chunk_end=start + timedelta(minutes=CHUNK_SIZE_MINUTES))
 
-    for user in users:
-        process_user_segments_in_chunks(user.id)
+            if scheduler.rescan_due():
+                with worker_session() as session:
+                    scheduler.scan(session)
 
+    with worker_session() as session:
+        scheduler.log_run(session)
     logger.info("Finished Summarization Task")
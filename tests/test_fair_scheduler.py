@@ -0,0 +1,93 @@
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytz
+
+import fair_scheduler
+from fair_scheduler import FairScheduler, parse_weights
+
+def make_scheduler(monkeypatch, pending, **kwargs):
+    """A scheduler whose scan sees pending ({user_id: oldest timestamp}) instead of the database."""
+    monkeypatch.setattr(fair_scheduler, 'pending_backlogs',
+                        lambda session, since=None: {user_id: (oldest, 1) for user_id, oldest in pending.items()})
+    kwargs.setdefault('weights', {})
+    scheduler = FairScheduler(**kwargs)
+    scheduler.scan(None)
+    return scheduler
+
+def hours_ago(hours):
+    return datetime.now(pytz.UTC) - timedelta(hours=hours)
+
+def run_chunks(scheduler, count):
+    """Hand out count chunks, completing each before the next, and count them per user."""
+    served = Counter()
+    for _ in range(count):
+        user_id, start, _ = scheduler.next_chunk()
+        served[user_id] += 1
+        scheduler.complete(user_id, start + timedelta(minutes=5))
+    return served
+
+def test_parse_weights():
+    assert parse_weights("12:2, 7:0.5") == {12: 2.0, 7: 0.5}
+    assert parse_weights("3:0,4:-1,x:2,5:abc,6") == {}
+    assert parse_weights(None) == {}
+
+def test_equal_weights_alternate(monkeypatch):
+    scheduler = make_scheduler(monkeypatch, {1: hours_ago(48), 2: hours_ago(48)})
+    order = []
+    for _ in range(4):
+        user_id, start, lane = scheduler.next_chunk()
+        assert lane == 'backfill'
+        order.append(user_id)
+        scheduler.complete(user_id, start + timedelta(minutes=5))
+    assert order == [1, 2, 1, 2]
+
+def test_weights_share_chunks(monkeypatch):
+    scheduler = make_scheduler(monkeypatch, {1: hours_ago(48), 2: hours_ago(48)}, weights={1: 2.0})
+    assert run_chunks(scheduler, 9) == {1: 6, 2: 3}
+
+def test_fractional_weight(monkeypatch):
+    scheduler = make_scheduler(monkeypatch, {1: hours_ago(48), 2: hours_ago(48)}, weights={1: 0.5})
+    served = run_chunks(scheduler, 9)
+    assert served == {1: 3, 2: 6}
+
+def test_fresh_lane_served_first(monkeypatch):
+    scheduler = make_scheduler(monkeypatch, {1: hours_ago(48), 2: hours_ago(0.1)})
+    assert scheduler.next_chunk()[::2] == (2, 'fresh')
+    # The fresh user has a chunk in flight, so the backfill lane gets a turn
+    assert scheduler.next_chunk()[::2] == (1, 'backfill')
+
+def test_one_chunk_in_flight_per_user(monkeypatch):
+    scheduler = make_scheduler(monkeypatch, {1: hours_ago(48)})
+    user_id, start, _ = scheduler.next_chunk()
+    assert scheduler.next_chunk() is None
+    scheduler.complete(user_id, start + timedelta(minutes=5))
+    assert scheduler.next_chunk()[0] == 1
+
+def test_quota_limits_chunks_per_run(monkeypatch):
+    scheduler = make_scheduler(monkeypatch, {1: hours_ago(48), 2: hours_ago(48)}, quota=2)
+    assert run_chunks(scheduler, 4) == {1: 2, 2: 2}
+    assert scheduler.next_chunk() is None
+
+def test_finished_user_drops_out(monkeypatch):
+    scheduler = make_scheduler(monkeypatch, {1: hours_ago(48), 2: hours_ago(48)})
+    user_id, start, _ = scheduler.next_chunk()
+    scheduler.complete(user_id, None, chunk_end=start + timedelta(minutes=5))
+    assert run_chunks(scheduler, 3) == {2: 3}
+    assert scheduler.backlogs[user_id].deficit == 0.0
+
+def test_rescan_only_resumes_after_last_chunk(monkeypatch):
+    start = hours_ago(48)
+    scheduler = make_scheduler(monkeypatch, {1: start})
+    user_id, chunk_start, _ = scheduler.next_chunk()
+    chunk_end = chunk_start + timedelta(minutes=5)
+    scheduler.complete(user_id, None, chunk_end=chunk_end)
+
+    # A late segment from before the finished chunk waits for the next run
+    monkeypatch.setattr(fair_scheduler, 'pending_backlogs', lambda session, since=None: {1: (start, 1)})
+    scheduler.scan(None)
+    assert scheduler.next_chunk() is None
+
+    monkeypatch.setattr(fair_scheduler, 'pending_backlogs', lambda session, since=None: {1: (chunk_end, 1)})
+    scheduler.scan(None)
+    assert scheduler.next_chunk()[:2] == (1, chunk_end)
@@ -0,0 +1,58 @@
+import hashlib
+
+from idempotency import RecentKeyFilter, delivery_key
+
+def keys(prefix, count):
+    return [hashlib.sha256(f"{prefix}-{i}".encode('utf-8')).hexdigest() for i in range(count)]
+
+def test_added_keys_are_found():
+    bloom = RecentKeyFilter(capacity=1000)
+    added = keys('added', 500)
+    for key in added:
+        bloom.add(key)
+    assert all(bloom.might_contain(key) for key in added)
+
+def test_false_positive_rate_near_target():
+    bloom = RecentKeyFilter(capacity=1000, false_positive_rate=0.01)
+    for key in keys('added', 1000):
+        bloom.add(key)
+    false_positives = sum(bloom.might_contain(key) for key in keys('unseen', 5000))
+    assert false_positives < 5000 * 0.03
+
+def test_previous_generation_is_still_checked():
+    bloom = RecentKeyFilter(capacity=100)
+    first = keys('first', 100)
+    for key in first:
+        bloom.add(key)
+    # The next key fills a fresh generation; the first hundred move to the previous one
+    bloom.add(keys('second', 1)[0])
+    assert bloom.count == 1
+    assert all(bloom.might_contain(key) for key in first)
+
+def test_keys_expire_after_two_rotations():
+    bloom = RecentKeyFilter(capacity=100)
+    first = keys('first', 100)
+    for key in first + keys('second', 100) + keys('third', 1):
+        bloom.add(key)
+    # Only false positives remain from the first generation
+    assert sum(bloom.might_contain(key) for key in first) < 10
+
+def test_memory_is_fixed():
+    bloom = RecentKeyFilter(capacity=100)
+    size = len(bloom.current)
+    for key in keys('many', 1000):
+        bloom.add(key)
+    assert len(bloom.current) == len(bloom.previous) == size
+
+def test_delivery_key_from_content():
+    segments = [{'speaker': 'SPEAKER_0', 'text': 'hello', 'start_time': 0.0, 'end_time': 1.0}]
+    key = delivery_key('uid-a', 's1', segments)
+    assert key == delivery_key('uid-a', 's1', [dict(segments[0], is_user=True)])
+    assert key != delivery_key('uid-a', 's2', segments)
+    assert key != delivery_key('uid-b', 's1', segments)
+    assert key != delivery_key('uid-a', 's1', [dict(segments[0], text='hello!')])
+
+def test_delivery_key_prefers_client_key():
+    first = delivery_key('uid-a', 's1', [{'text': 'one'}], client_key='abc')
+    assert first == delivery_key('uid-a', 's2', [{'text': 'two'}], client_key='abc')
+    assert first != delivery_key('uid-b', 's1', [{'text': 'one'}], client_key='abc')
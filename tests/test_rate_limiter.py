@@ -0,0 +1,166 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from rate_limiter import (ProviderLimiter, RateLimited, TokenBucket, parse_limits, parse_rate_limit_headers,
+                          parse_reset)
+
+class TooManyRequests(Exception):
+    """Stands in for an SDK's 429 error."""
+    status_code = 429
+
+    def __init__(self, retry_after='0'):
+        super().__init__("rate limited")
+        self.headers = {'retry-after': retry_after}
+
+def test_parse_limits():
+    assert parse_limits("gpt-4o=500/30000, claude-3-5-sonnet-20240620=50/") == {
+        'gpt-4o': (500, 30000),
+        'claude-3-5-sonnet-20240620': (50, None),
+    }
+    assert 'bad' not in parse_limits("bad=abc/10,gpt-4o=1/2")
+
+def test_parse_reset_durations():
+    assert parse_reset("1m30s") == 90
+    assert parse_reset("120ms") == pytest.approx(0.12)
+    assert parse_reset("1h2m3.5s") == pytest.approx(3723.5)
+    assert parse_reset("2") == 2.0
+    assert parse_reset("-3") == 0.0
+
+def test_parse_reset_timestamps():
+    now = datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+    later = (now + timedelta(seconds=42)).isoformat().replace('+00:00', 'Z')
+    assert parse_reset(later, now=now.timestamp()) == pytest.approx(42)
+    assert parse_reset(now.isoformat(), now=now.timestamp() + 10) == 0.0
+
+def test_parse_reset_rejects_garbage():
+    assert parse_reset(None) is None
+    assert parse_reset("soon") is None
+    assert parse_reset("5s later") is None
+
+def test_parse_openai_headers():
+    parsed = parse_rate_limit_headers({
+        'X-RateLimit-Limit-Requests': '500',
+        'x-ratelimit-remaining-requests': '499',
+        'x-ratelimit-reset-requests': '120ms',
+        'x-ratelimit-limit-tokens': '30000',
+        'x-ratelimit-remaining-tokens': 'n/a',
+        'retry-after-ms': '1500',
+    })
+    assert parsed['requests'] == {'limit': 500, 'remaining': 499, 'reset': pytest.approx(0.12)}
+    assert parsed['tokens'] == {'limit': 30000, 'remaining': None, 'reset': None}
+    assert parsed['retry_after'] == pytest.approx(1.5)
+
+def test_parse_anthropic_headers():
+    reset = (datetime.now(timezone.utc) + timedelta(seconds=30)).isoformat()
+    parsed = parse_rate_limit_headers({
+        'anthropic-ratelimit-requests-limit': '50',
+        'anthropic-ratelimit-requests-remaining': '10',
+        'anthropic-ratelimit-requests-reset': reset,
+        'retry-after': '7',
+    })
+    assert parsed['requests']['limit'] == 50
+    assert parsed['requests']['remaining'] == 10
+    assert 25 < parsed['requests']['reset'] <= 30
+    assert 'tokens' not in parsed
+    assert parsed['retry_after'] == 7.0
+
+def test_parse_no_headers():
+    assert parse_rate_limit_headers(None) == {}
+
+def test_token_bucket_refills_over_a_minute():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    assert bucket.wait_time(60, now) == 0.0
+    bucket.take(60)
+    assert bucket.wait_time(1, now) == pytest.approx(1.0)
+    assert bucket.wait_time(1, now + 1.0) == pytest.approx(0.0)
+    # Refills never go past a minute's worth
+    assert bucket.wait_time(1, now + 600) == 0.0
+    assert bucket.available == 60
+
+def test_token_bucket_oversized_call_waits_for_a_full_bucket():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    bucket.take(30)
+    assert bucket.wait_time(1000, now) == pytest.approx(30.0)
+    bucket.take(1000)
+    assert bucket.available == pytest.approx(-30.0)
+
+def test_token_bucket_sync():
+    bucket = TokenBucket(60)
+    bucket.sync(limit=120, remaining=5)
+    assert bucket.per_minute == 120
+    assert bucket.available == pytest.approx(5, abs=0.1)
+    # Remaining only ever lowers the local count
+    bucket.sync(remaining=100)
+    assert bucket.available < 6
+
+def test_aimd_halves_on_429_and_grows_per_window():
+    limiter = ProviderLimiter('test:halve', max_concurrency=8)
+    limiter.acquire(max_wait=0)
+    limiter.release(TooManyRequests())
+    assert limiter.concurrency == 4
+
+    # About one more slot after a window of successes at the current limit
+    for _ in range(4):
+        limiter.acquire(max_wait=0)
+        limiter.release()
+    assert int(limiter.concurrency) == 4
+    limiter.acquire(max_wait=0)
+    limiter.release()
+    assert int(limiter.concurrency) == 5
+
+    for _ in range(100):
+        limiter.acquire(max_wait=0)
+        limiter.release()
+    assert limiter.concurrency == 8
+
+def test_aimd_never_drops_below_one():
+    limiter = ProviderLimiter('test:floor', max_concurrency=4)
+    for _ in range(5):
+        limiter.acquire(max_wait=0)
+        limiter.release(TooManyRequests())
+    assert limiter.concurrency == 1
+    assert limiter.in_flight == 0
+
+def test_other_errors_leave_concurrency_alone():
+    limiter = ProviderLimiter('test:error', max_concurrency=4)
+    limiter.acquire(max_wait=0)
+    limiter.release(ValueError("boom"))
+    assert limiter.concurrency == 4
+
+def test_full_limiter_raises_after_max_wait():
+    limiter = ProviderLimiter('test:full', max_concurrency=1)
+    limiter.acquire(max_wait=0)
+    with pytest.raises(RateLimited):
+        limiter.acquire(max_wait=0.05)
+    limiter.release()
+    limiter.acquire(max_wait=0)
+
+def test_429_pauses_for_retry_after():
+    limiter = ProviderLimiter('test:pause', max_concurrency=4)
+    limiter.acquire(max_wait=0)
+    limiter.release(TooManyRequests(retry_after='30'))
+    with pytest.raises(RateLimited) as raised:
+        limiter.acquire(max_wait=1)
+    assert 29 < raised.value.retry_after <= 30
+
+def test_request_bucket_spaces_calls():
+    limiter = ProviderLimiter('test:rpm', requests_per_minute=2, max_concurrency=4)
+    limiter.acquire(max_wait=0)
+    limiter.acquire(max_wait=0)
+    with pytest.raises(RateLimited) as raised:
+        limiter.acquire(max_wait=1)
+    assert raised.value.retry_after == pytest.approx(30, abs=0.5)
+
+def test_observe_headers_creates_and_follows_buckets():
+    limiter = ProviderLimiter('test:headers', max_concurrency=4)
+    limiter.observe_headers({'x-ratelimit-limit-tokens': '1000', 'x-ratelimit-remaining-tokens': '10'})
+    assert limiter.requests is None
+    assert limiter.tokens.per_minute == 1000
+    started = time.monotonic()
+    with pytest.raises(RateLimited):
+        limiter.acquire(tokens=500, max_wait=0.1)
+    assert time.monotonic() - started < 0.5
@@ -0,0 +1,84 @@
+from collections import Counter
+
+from text_processing import (WORD_CLOUD_PATTERN, clean_fragment, compact_transcript, estimate_tokens,
+                             is_near_duplicate, normalize_words, speaker_tag, word_cloud_data)
+
+def test_clean_fragment_strips_hesitations():
+    assert clean_fragment("Um, so we, uh, shipped it") == "so we shipped it"
+    assert clean_fragment("hmm") == ""
+    assert clean_fragment(None) == ""
+
+def test_clean_fragment_collapses_stutters_only():
+    assert clean_fragment("I I I think so") == "I think so"
+    assert clean_fragment("I I think so") == "I think so"
+    assert clean_fragment("the the the plan") == "the plan"
+    # Words said twice are often grammatical
+    assert clean_fragment("he said that that was fine") == "he said that that was fine"
+    assert clean_fragment("she had had enough") == "she had had enough"
+
+def test_speaker_tag():
+    assert speaker_tag("SPEAKER_01") == "S1"
+    assert speaker_tag("speaker_10") == "S10"
+    assert speaker_tag("Alice ") == "Alice"
+    assert speaker_tag(None) == "S?"
+
+def test_near_duplicates():
+    words = normalize_words("we should book the flight to Seattle")
+    assert is_near_duplicate(words, normalize_words("book the flight to Seattle"))
+    assert is_near_duplicate(normalize_words("okay"), normalize_words("okay"))
+    assert not is_near_duplicate(normalize_words("book it"), words)
+    assert not is_near_duplicate(words, normalize_words("call the vet on Thursday afternoon"))
+
+def test_compact_merges_turns_and_drops_noise():
+    compacted = compact_transcript([
+        ("SPEAKER_00", "We should book the flight to Seattle"),
+        ("SPEAKER_00", "um, before Friday"),
+        ("SPEAKER_01", "yeah okay"),
+        ("SPEAKER_01", "The conference starts Monday"),
+        ("SPEAKER_01", "the conference starts Monday morning"),
+        ("SPEAKER_00", "Right."),
+    ])
+    assert compacted.turns == [
+        ("S0", "We should book the flight to Seattle before Friday"),
+        ("S1", "the conference starts Monday morning"),
+    ]
+    assert compacted.text == "S0: We should book the flight to Seattle before Friday\n" \
+                             "S1: the conference starts Monday morning"
+    assert compacted.dropped_fragments == 3
+    assert compacted.dropped_turns == 0
+    assert 0 < compacted.reduction_ratio < 1
+
+def test_same_words_from_another_speaker_are_kept():
+    compacted = compact_transcript([("SPEAKER_00", "see you on Friday then"), ("SPEAKER_01", "see you on Friday then")])
+    assert [tag for tag, _ in compacted.turns] == ["S0", "S1"]
+
+def test_budget_drops_turns_with_fewest_content_words():
+    fragments = [
+        ("SPEAKER_00", "Quarterly pipeline numbers look strong across every region this month"),
+        ("SPEAKER_01", "that is what it is"),
+        ("SPEAKER_00", "Pricing for the enterprise customer needs legal review before signing"),
+    ]
+    full = compact_transcript(fragments)
+    budget = full.compacted_tokens - 3
+    compacted = compact_transcript(fragments, token_budget=budget)
+    assert compacted.dropped_turns == 1
+    assert [text for _, text in compacted.turns] == [fragments[0][1], fragments[2][1]]
+    assert compacted.compacted_tokens <= budget
+
+def test_budget_truncates_a_single_long_turn():
+    compacted = compact_transcript([("SPEAKER_00", "budget " * 200)], token_budget=20)
+    assert estimate_tokens(compacted.text) <= 20
+
+def test_empty_transcript():
+    compacted = compact_transcript([])
+    assert compacted.text == ""
+    assert compacted.reduction_ratio == 0.0
+
+def test_word_cloud_pattern_splits_clitics():
+    assert WORD_CLOUD_PATTERN.findall("gizmo's bowl") == ["gizmo", "'s", "bowl"]
+    assert WORD_CLOUD_PATTERN.findall("i don't think we'll") == ["i", "do", "n't", "think", "we", "'ll"]
+    assert WORD_CLOUD_PATTERN.findall("a well-known o'clock show") == ["a", "well-known", "o'clock", "show"]
+
+def test_word_cloud_data_drops_dominant_words():
+    counter = Counter({'budget': 10, 'seattle': 3, 'friday': 2})
+    assert word_cloud_data(counter) == [{'text': 'seattle', 'value': 3}, {'text': 'friday', 'value': 2}]
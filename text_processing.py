@@ -0,0 +1,235 @@
+"""
+Shared transcript text handling: stop words, filler and pre-compaction of
+transcripts before they are sent to the summarization model.
+
+ASR output for a chunk is mostly short fragments. Many of them are filler
+("um", "yeah") or repeats of the previous fragment, and consecutive fragments
+from one speaker are split apart. compact_transcript() merges the fragments
+into speaker turns, drops the noise and keeps the result within a token budget.
+That cuts the input tokens, and so the latency and cost, of every chunk.
+"""
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from collections import Counter
+from functools import lru_cache
+from typing import Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Used when the NLTK stopwords corpus is not available
+FALLBACK_STOP_WORDS = {'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're", "you've", "you'll", "you'd", 'your', 'yours', 'yourself', 'yourselves', 'he', 'him', 'his', 'himself', 'she', "she's", 'her', 'hers', 'herself', 'it', "it's", 'its', 'itself', 'they', 'them', 'their', 'theirs', 'themselves', 'what', 'which', 'who', 'whom', 'this', 'that', "that'll", 'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'having', 'do', 'does', 'did', 'doing', 'a', 'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'until', 'while', 'of', 'at', 'by', 'for', 'with', 'about', 'against', 'between', 'into', 'through', 'during', 'before', 'after', 'above', 'below', 'to', 'from', 'up', 'down', 'in', 'out', 'on', 'off', 'over', 'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when', 'where', 'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more', 'most', 'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 's', 't', 'can', 'will', 'just', 'don', "don't", 'should', "should've", 'now', 'd', 'll', 'm', 'o', 're', 've', 'y', 'ain', 'aren', "aren't", 'couldn', "couldn't", 'didn', "didn't", 'doesn', "doesn't", 'hadn', "hadn't", 'hasn', "hasn't", 'haven', "haven't", 'isn', "isn't", 'ma', 'mightn', "mightn't", 'mustn', "mustn't", 'needn', "needn't", 'shan', "shan't", 'shouldn', "shouldn't", 'wasn', "wasn't", 'weren', "weren't", 'won', "won't", 'wouldn', "wouldn't"}
+
+# Words that carry no topic in conversation; excluded from the word cloud
+FILLER_WORDS = {'um', 'uh', 'like', 'yeah', 'okay', 'oh', 'just', 'know', 'think', 'going', 'really', 'get', 'well', 'thing', 'things', 'way', 'kind', 'lot'}
+
+# Word cloud: how many words are returned, and words above this share of all counted words are dropped
+WORD_CLOUD_SIZE = 50
+WORD_CLOUD_MAX_SHARE = 0.5
+# 'nltk' (word_tokenize when its data is installed) or 'regex', which is several times faster on large days
+WORD_CLOUD_TOKENIZER = os.environ.get('WORD_CLOUD_TOKENIZER', 'nltk').lower()
+# Tokens as word_tokenize splits them: clitics ('s, n't, 're, 'll, 've, 'd, 'm) come off as their own
+# tokens ("gizmo's" -> "gizmo", "'s"), while other inner apostrophes and hyphens keep a word whole,
+# so isalnum() still drops "o'clock" and "well-known"
+WORD_CLOUD_PATTERN = re.compile(
+    r"[^\W_]+(?=n't\b)|n't\b|'(?:s|re|ll|ve|d|m)\b|[^\W_]+(?:-[^\W_]+|'(?!(?:s|re|ll|ve|d|m|t)\b)[^\W_]+)*",
+    re.IGNORECASE)
+
+# Hesitations removed wherever they appear in a fragment
+DISFLUENCY_PATTERN = re.compile(r",?\s*\b(?:u+m+|u+h+|u+h+m+|e+r+m+|h+m+|m+h*m+|a+h+)\b[,.]?", re.IGNORECASE)
+# Stutters: a single letter repeated ("I I think") or any word said three or more times in a row.
+# A word said twice is left alone, since "that that" and "had had" are often grammatical.
+REPEATED_WORD_PATTERN = re.compile(r"\b(?:(\w)(?:[\s,]+\1\b)+|(\w+)(?:[\s,]+\2\b){2,})", re.IGNORECASE)
+# Fragments made only of these words are backchannel and dropped entirely
+BACKCHANNEL_WORDS = {'yeah', 'yes', 'yep', 'yup', 'no', 'nope', 'okay', 'ok', 'oh', 'right', 'sure', 'mhm', 'uh-huh',
+                     'huh', 'wow', 'cool', 'nice', 'alright', 'so', 'and', 'but', 'like', 'well', 'hey', 'hi', 'bye'}
+WORD_PATTERN = re.compile(r"\w[\w'-]*")
+SPEAKER_LABEL_PATTERN = re.compile(r"^SPEAKER_0*(\d+)$", re.IGNORECASE)
+
+# How many earlier fragments a new one is compared with for near-duplicates
+DUPLICATE_WINDOW = 4
+# Fragments shorter than this many words only count as duplicates when repeated exactly
+DUPLICATE_MIN_WORDS = 3
+
+def estimate_tokens(text):
+    # Roughly four characters per token, the usual rule of thumb for English text
+    return (len(text) + 3) // 4
+
+def normalize_words(text):
+    return WORD_PATTERN.findall(text.lower())
+
+def speaker_tag(speaker):
+    """Short tag for a speaker label, e.g. SPEAKER_01 -> S1."""
+    if not speaker:
+        return "S?"
+    match = SPEAKER_LABEL_PATTERN.match(speaker.strip())
+    return f"S{match.group(1)}" if match else speaker.strip()
+
+def clean_fragment(text):
+    text = DISFLUENCY_PATTERN.sub(" ", text or "")
+    text = REPEATED_WORD_PATTERN.sub(lambda match: match.group(1) or match.group(2), text)
+    return " ".join(text.split()).strip(" ,")
+
+def contains_words(longer, shorter):
+    """True when shorter appears in longer as a run of whole words."""
+    size = len(shorter)
+    return any(longer[start:start + size] == shorter for start in range(len(longer) - size + 1))
+
+def is_near_duplicate(words, previous_words):
+    """True when one fragment repeats (or is contained in) the other, as ASR retries often do."""
+    if not words or not previous_words:
+        return False
+    if words == previous_words:
+        return True
+    shorter, longer = sorted((words, previous_words), key=len)
+    if len(shorter) < DUPLICATE_MIN_WORDS:
+        return False
+    if contains_words(longer, shorter):
+        return True
+    overlap = len(set(shorter) & set(longer))
+    return len(shorter) >= 4 and overlap / len(set(shorter)) >= 0.9
+
+@lru_cache(maxsize=None)
+def word_cloud_setup(tokenizer=WORD_CLOUD_TOKENIZER):
+    """
+    (tokenize, stop_words) for word clouds.
+
+    NLTK's tokenizer and stop words when its data is installed, otherwise plain
+    splitting and FALLBACK_STOP_WORDS. The 'regex' tokenizer uses NLTK's stop
+    words if they are available but never its tokenizer.
+    """
+    try:
+        from nltk.corpus import stopwords
+        stop_words = set(stopwords.words('english'))
+    except LookupError:
+        stop_words = set(FALLBACK_STOP_WORDS)
+    stop_words.update(FILLER_WORDS)
+
+    if tokenizer == 'regex':
+        return WORD_CLOUD_PATTERN.findall, frozenset(stop_words)
+    try:
+        from nltk.tokenize import word_tokenize
+        word_tokenize("probe")
+        tokenize = word_tokenize
+    except LookupError:
+        tokenize = str.split
+    return tokenize, frozenset(stop_words)
+
+def count_words(counter, text, tokenizer=WORD_CLOUD_TOKENIZER):
+    """Add the word-cloud words of one piece of text to counter."""
+    tokenize, stop_words = word_cloud_setup(tokenizer)
+    counter.update(word for word in tokenize(text.lower())
+                   if word.isalnum() and word not in stop_words and len(word) > 2)
+
+def word_frequencies(texts, tokenizer=WORD_CLOUD_TOKENIZER):
+    """
+    Count word-cloud words over an iterable of texts, one text at a time.
+
+    Only the counter grows with the input, so memory stays flat when texts is
+    a streamed query result.
+    """
+    counter = Counter()
+    for text in texts:
+        count_words(counter, text, tokenizer)
+    return counter
+
+def word_cloud_data(counter, limit=WORD_CLOUD_SIZE):
+    total_words = sum(counter.values())
+    return [
+        {"text": word, "value": count}
+        for word, count in counter.most_common(limit)
+        if count < total_words * WORD_CLOUD_MAX_SHARE
+    ]
+
+@dataclass
+class CompactedTranscript:
+    text: str
+    turns: List[Tuple[str, str]] = field(default_factory=list)
+    original_tokens: int = 0
+    compacted_tokens: int = 0
+    dropped_fragments: int = 0
+    dropped_turns: int = 0
+
+    @property
+    def reduction_ratio(self):
+        """Fraction of the original tokens removed, from 0.0 to 1.0."""
+        if not self.original_tokens:
+            return 0.0
+        return 1.0 - self.compacted_tokens / self.original_tokens
+
+def compact_transcript(fragments: Iterable[Tuple[str, str]], token_budget: int = None,
+                       stop_words=FALLBACK_STOP_WORDS) -> CompactedTranscript:
+    """
+    Turn ordered (speaker, text) fragments into compact speaker turns.
+
+    Filler and stutters are removed, backchannel-only fragments and near-duplicates
+    of the same speaker's recent fragments are dropped, and consecutive fragments from one speaker are
+    joined into a single "S0: ..." line. If the result is over token_budget, the turns
+    with the fewest content words are dropped first, keeping the original order.
+    """
+    fragments = list(fragments)
+    original_text = " ".join(text for _, text in fragments if text)
+    kept = []  # [speaker_tag, text, words]
+    dropped_fragments = 0
+
+    for speaker, text in fragments:
+        cleaned = clean_fragment(text)
+        words = normalize_words(cleaned)
+        if not words or all(word in BACKCHANNEL_WORDS for word in words):
+            dropped_fragments += 1
+            continue
+
+        tag = speaker_tag(speaker)
+        duplicate = False
+        for index in range(len(kept) - 1, max(len(kept) - DUPLICATE_WINDOW, 0) - 1, -1):
+            # Another speaker saying the same words is not an ASR retry
+            if kept[index][0] == tag and is_near_duplicate(words, kept[index][2]):
+                # Keep the fuller of the two versions
+                if len(words) > len(kept[index][2]):
+                    kept[index] = [kept[index][0], cleaned, words]
+                duplicate = True
+                break
+        if duplicate:
+            dropped_fragments += 1
+            continue
+        kept.append([tag, cleaned, words])
+
+    turns = []
+    for tag, text, _ in kept:
+        if turns and turns[-1][0] == tag:
+            turns[-1] = (tag, f"{turns[-1][1]} {text}")
+        else:
+            turns.append((tag, text))
+
+    dropped_turns = 0
+    if token_budget:
+        total = sum(estimate_tokens(f"{tag}: {text}\n") for tag, text in turns)
+        if total > token_budget:
+            def content_words(turn):
+                return sum(1 for word in normalize_words(turn[1]) if word not in stop_words)
+
+            by_value = sorted(range(len(turns)), key=lambda i: (content_words(turns[i]), len(turns[i][1])))
+            removed = set()
+            for index in by_value:
+                if total <= token_budget or len(removed) == len(turns) - 1:
+                    break
+                removed.add(index)
+                total -= estimate_tokens(f"{turns[index][0]}: {turns[index][1]}\n")
+            turns = [turn for i, turn in enumerate(turns) if i not in removed]
+            dropped_turns = len(removed)
+
+            # A single remaining turn can still exceed the budget
+            if total > token_budget and turns:
+                tag, text = turns[-1]
+                turns[-1] = (tag, text[:max(token_budget * 4 - len(tag) - 3, 0)])
+
+    text = "\n".join(f"{tag}: {text}" for tag, text in turns)
+    return CompactedTranscript(
+        text=text,
+        turns=turns,
+        original_tokens=estimate_tokens(original_text),
+        compacted_tokens=estimate_tokens(text),
+        dropped_fragments=dropped_fragments,
+        dropped_turns=dropped_turns,
+    )
@@ -0,0 +1,143 @@
+"""
+Speaker turns for transcript responses, and batched segment lookups by summary.
+
+A turn is a run of consecutive segments from the same speaker. The database
+does the grouping. lag() marks each segment where the speaker changes, and a
+running sum of those marks numbers the turns. The turns are then aggregated
+and paged, with count(*) OVER () giving the total in the same query. Only the
+fields the transcript view renders are returned, and a page never splits a
+turn.
+"""
+from datetime import timedelta
+
+import pytz
+from sqlalchemy import Integer, case, func, literal, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from archive import read_archived_summary_segments
+from models import db, Main, Segment, summaries
+
+def _utc_isoformat(timestamp):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=pytz.UTC)
+    return timestamp.astimezone(pytz.UTC).isoformat()
+
+def turn_dict(turn_id, speaker, text, start, end, segment_count, is_user):
+    return {
+        'id': turn_id,
+        'speaker': speaker,
+        'text': text,
+        'timestamp': _utc_isoformat(start),
+        'end_timestamp': _utc_isoformat(end),
+        'segment_count': segment_count,
+        'is_user': is_user,
+    }
+
+def fetch_turns(uid, local_date, local_hour, limit, offset):
+    """Return (turns, total_turns) for a user's segments on a local date, optionally one local hour."""
+    ordering = (Segment.timestamp, Segment.id)
+    marked = select(
+        Segment.id, Segment.speaker, Segment.text, Segment.timestamp, Segment.is_user,
+        case((Segment.speaker.is_distinct_from(func.lag(Segment.speaker).over(order_by=ordering)), 1),
+             else_=0).label('new_turn')
+    ).join(Main).where(
+        Main.uid == uid,
+        Segment.local_date == local_date
+    )
+    if local_hour is not None:
+        marked = marked.where(Segment.local_hour == local_hour)
+    marked = marked.subquery()
+
+    numbered = select(
+        marked,
+        func.sum(marked.c.new_turn).over(order_by=(marked.c.timestamp, marked.c.id)).cast(Integer).label('turn')
+    ).subquery()
+
+    within_turn = (numbered.c.timestamp, numbered.c.id)
+    stmt = select(
+        func.min(numbered.c.id),
+        func.min(numbered.c.speaker),
+        func.string_agg(numbered.c.text, aggregate_order_by(literal(' '), *within_turn)),
+        func.min(numbered.c.timestamp),
+        func.max(numbered.c.timestamp),
+        func.count(),
+        func.bool_or(numbered.c.is_user),
+        func.count().over().label('total_turns')
+    ).group_by(numbered.c.turn).order_by(numbered.c.turn).limit(limit).offset(offset)
+
+    rows = db.session.execute(stmt).all()
+    total = rows[0].total_turns if rows else 0
+    return [turn_dict(*row[:7]) for row in rows], total
+
+def merge_turns(segments):
+    """The same grouping in one pass over Segment.to_dict() dicts already in timestamp order."""
+    turns = []
+    for segment in segments:
+        if turns and turns[-1]['speaker'] == segment['speaker']:
+            turn = turns[-1]
+            turn['text'] = f"{turn['text']} {segment['text']}"
+            turn['end_timestamp'] = segment['timestamp']
+            turn['segment_count'] += 1
+            turn['is_user'] = turn['is_user'] or segment['is_user']
+        else:
+            turns.append({
+                'id': segment['id'],
+                'speaker': segment['speaker'],
+                'text': segment['text'],
+                'timestamp': segment['timestamp'],
+                'end_timestamp': segment['timestamp'],
+                'segment_count': 1,
+                'is_user': segment['is_user'],
+            })
+    return turns
+
+def summary_segments(user, summary_ids, limit=None, after=None):
+    """
+    Segments of several of a user's summaries, in two queries whatever the number of ids, plus one
+    when some of them are archived.
+
+    Returns {summary_id: (segments, has_more)} for the ids the user owns; ids of other
+    users' summaries are left out. Each summary gets at most `limit` segments in id order,
+    starting after segment id `after`, so a long one can be paged lazily.
+    """
+    owned = dict(db.session.query(summaries.id, summaries.timestamp).filter(
+        summaries.id.in_(summary_ids),
+        summaries.user_id == user.id
+    ).all())
+    if not owned:
+        return {}
+
+    rank = func.row_number().over(partition_by=Segment.summary_id, order_by=Segment.id).label('rank')
+    ranked = select(Segment.id, rank).where(Segment.summary_id.in_(owned.keys()))
+    if after is not None:
+        ranked = ranked.where(Segment.id > after)
+    ranked = ranked.subquery()
+
+    query = db.session.query(Segment).join(ranked, ranked.c.id == Segment.id)
+    if limit is not None:
+        # One extra row per summary tells whether there is another page
+        query = query.filter(ranked.c.rank <= limit + 1)
+    grouped = {summary_id: [] for summary_id in owned}
+    for segment in query.order_by(Segment.summary_id, Segment.id):
+        grouped[segment.summary_id].append(segment.to_dict())
+
+    # Archived summaries have no live rows; their segments fall within a day of the summary
+    windows = {}
+    for summary_id, rows in grouped.items():
+        if not rows:
+            timestamp = owned[summary_id]
+            if timestamp.tzinfo is None:
+                timestamp = pytz.UTC.localize(timestamp)
+            windows[summary_id] = (timestamp - timedelta(days=1), timestamp + timedelta(days=1))
+    archived = read_archived_summary_segments(user.id, windows) if windows else {}
+
+    result = {}
+    for summary_id, rows in grouped.items():
+        if summary_id in archived:
+            rows = sorted((row for row in archived[summary_id] if after is None or row['id'] > after),
+                          key=lambda row: row['id'])
+        if limit is not None and len(rows) > limit:
+            result[summary_id] = (rows[:limit], True)
+        else:
+            result[summary_id] = (rows, False)
+    return result
@@ -0,0 +1,51 @@
+"""
+Background worker process for the scheduled jobs in jobs.py.
+
+    worker: python worker.py
+
+It uses the worker database role, so its jobs get the worker pool and no
+statement timeout, and publishes summary events through Postgres so the web
+processes can pass them on (see notifications.py). Run exactly one; the jobs
+are not safe to run twice at once.
+"""
+import logging
+import os
+import sys
+
+from apscheduler.schedulers.blocking import BlockingScheduler
+from flask import Flask
+
+from config import Config
+from database import init_database
+from jobs import add_jobs
+from notifications import notify_summary_event
+from response_cache import cache, warn_if_cache_local
+from summarization_handler import set_summary_publisher
+
+logger = logging.getLogger(__name__)
+
+def create_worker_app():
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    init_database(app, role='worker')
+    cache.init_app(app)
+    return app
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=os.environ.get('LOG_LEVEL', 'INFO').upper())
+    logging.getLogger('apscheduler').setLevel(logging.WARNING)
+    app = create_worker_app()
+    warn_if_cache_local("the worker")
+    set_summary_publisher(notify_summary_event)
+
+    scheduler = BlockingScheduler()
+    add_jobs(scheduler, app)
+    logger.info(f"Worker started with jobs: {', '.join(job.id for job in scheduler.get_jobs())}")
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())